@@ -0,0 +1,87 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+MAX_UPDATES_PER_RESPONSE = 100
+
+
+class FakeTelegram:
+    """
+    Local stand-in for Telegram Bot API: serves scripted updates by getUpdates
+    and answers sendMessage/editMessageText/editMessageReplyMarkup/answerCallbackQuery.
+    Each API call (except getUpdates) takes `latency` seconds and fails with 429
+    with probability `error_rate`.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.updates = asyncio.Queue()
+        self.calls = Counter()
+        self.throttled = 0
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._runner = None
+
+    def push(self, update: dict):
+        update['update_id'] = next(self._update_ids)
+        self.updates.put_nowait(update)
+
+    def new_message_id(self):
+        return next(self._message_ids)
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        params = await request.post()
+        if method == 'getUpdates':
+            return web.json_response({'ok': True, 'result': await self.get_updates(float(params.get('timeout', 0)))})
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self.throttled += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+        self.calls[method] += 1
+        if method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+            result = {
+                'message_id': int(params.get('message_id') or self.new_message_id()),
+                'date': int(time.time()),
+                'chat': {'id': int(params['chat_id'])},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def get_updates(self, timeout: float):
+        try:
+            updates = [await asyncio.wait_for(self.updates.get(), timeout or None)]
+        except asyncio.TimeoutError:
+            return []
+        while len(updates) < MAX_UPDATES_PER_RESPONSE and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def start(self, host='127.0.0.1', port=0) -> str:
+        app = web.Application()
+        app.router.add_route('POST', '/bot{token:[^/]*}/{method}', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = site._server.sockets[0].getsockname()[:2]
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
@@ -0,0 +1,279 @@
+"""
+Load test of the bot against local fake Telegram Bot API (benchmarks/fake_telegram.py).
+
+    python -m benchmarks.run --db-url postgresql://localhost/tgbot_bench --chats 1000 --tasks 10000
+
+WARNING: all rows of chat and task tables in the given DB are deleted - never point it to real DB.
+
+Runs three phases:
+ - conversations: scripted dialogs (/start, new task, period, /menu, one more task) in new chats,
+   sent to the bot by getUpdates;
+ - returning chats: /start in seeded chats which are not in chat cache (as after restart of the bot);
+ - reminder burst: all seeded chats and tasks are made due, remind_all is run once
+   and then outbox is flushed until it is empty.
+Results are saved to benchmarks/results/<time>.json and compared with the previous run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import asyncpg
+
+from benchmarks.fake_telegram import FakeTelegram
+from tasksbot import clock, sender
+from tasksbot.bot import bot
+from tasksbot.cache import chat_cache
+from tasksbot.database import db, connect
+from tasksbot.models import Chat, Task
+from tasksbot.outbox import flush_outbox, OUTBOX_FLUSHERS
+from tasksbot.reminder import remind_all
+from tasksbot.scheduler import task_fire_at
+
+RESULTS_DIR = Path(__file__).parent / 'results'
+INSERT_CHUNK = 1000
+CONVERSATION_CHAT_ID_START = 10 ** 9
+MENU_TAPS = 3
+
+
+class QueryCounter:
+    """
+    Counts statements sent to Postgres by all connections
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._do_execute = asyncpg.Connection._do_execute
+        self._prepare = asyncpg.Connection.prepare
+
+    def install(self):
+        counter = self
+
+        def _do_execute(conn, *args, **kwargs):
+            counter.count += 1
+            return counter._do_execute(conn, *args, **kwargs)
+
+        def prepare(conn, *args, **kwargs):
+            counter.count += 1
+            return counter._prepare(conn, *args, **kwargs)
+
+        asyncpg.Connection._do_execute = _do_execute
+        asyncpg.Connection.prepare = prepare
+
+    def uninstall(self):
+        asyncpg.Connection._do_execute = self._do_execute
+        asyncpg.Connection.prepare = self._prepare
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def seed(chats: int, tasks: int):
+    await db.gino.create_all()
+    await db.status(db.text('UPDATE chat SET editing_task_id = NULL'))
+    await db.status(db.text('DELETE FROM outbox'))
+    await db.status(db.text('DELETE FROM task'))
+    await db.status(db.text('DELETE FROM chat'))
+    # chats are in UTC, so wall times are the same as fire times
+    notify_time = clock.now() + timedelta(days=1)
+    tasks_fire_at = task_fire_at(notify_time, False, 'UTC')
+    for start in range(0, chats, INSERT_CHUNK):
+        await Chat.insert().values([
+            dict(bot_id=bot.bot_id, chat_id=str(i), chat_name=f'chat {i}', chat_state=0,
+                 notify_next_date_time=notify_time, fire_at=notify_time, timezone='UTC')
+            for i in range(start, min(chats, start + INSERT_CHUNK))
+        ]).gino.status()
+    for start in range(0, tasks, INSERT_CHUNK):
+        await Task.insert().values([
+            dict(bot_id=bot.bot_id, chat_id=str(i % chats), content=f'task {i}', message_id='', last_notify_id='',
+                 period_days=1 + i % 7, notify_time=notify_time, fire_at=tasks_fire_at, exact_in_time=False,
+                 done_mark_user_id='')
+            for i in range(start, min(tasks, start + INSERT_CHUNK))
+        ]).gino.status()
+
+
+def message_update(telegram: FakeTelegram, chat_id: int, text: str):
+    chat = {'id': chat_id, 'type': 'private', 'username': f'user{chat_id}'}
+    return {'message': {
+        'message_id': telegram.new_message_id(), 'date': int(time.time()),
+        'chat': chat, 'from': {'id': chat_id, 'username': f'user{chat_id}'}, 'text': text,
+    }}
+
+
+def callback_update(telegram: FakeTelegram, chat_id: int, data: str, message_id: int = None):
+    chat = {'id': chat_id, 'type': 'private', 'username': f'user{chat_id}'}
+    return {'callback_query': {
+        'id': str(telegram.new_message_id()), 'data': data, 'from': {'id': chat_id, 'username': f'user{chat_id}'},
+        'message': {'message_id': message_id or telegram.new_message_id(), 'date': int(time.time()), 'chat': chat,
+                    'text': ''},
+    }}
+
+
+def conversation(telegram: FakeTelegram, chat_id: int) -> list:
+    menu_message_id = telegram.new_message_id()
+    return [
+        message_update(telegram, chat_id, '/start'),
+        message_update(telegram, chat_id, f'task of {chat_id}'),
+        message_update(telegram, chat_id, '3'),
+        message_update(telegram, chat_id, '/menu'),
+        # quick taps on the same menu message
+        *[callback_update(telegram, chat_id, 'page/0', menu_message_id) for _ in range(MENU_TAPS)],
+        callback_update(telegram, chat_id, 'new'),
+        message_update(telegram, chat_id, f'second task of {chat_id}'),
+        message_update(telegram, chat_id, '5'),
+    ]
+
+
+async def run_scripts(telegram: FakeTelegram, queries: QueryCounter, scripts: list[list]) -> dict:
+    expected = sum(len(script) for script in scripts)
+    latencies = []
+    finished = asyncio.Event()
+    process_update = bot.process_update
+
+    async def timed_process_update(update, *args):
+        start = time.perf_counter()
+        await process_update(update, *args)
+        latencies.append(time.perf_counter() - start)
+        if len(latencies) == expected:
+            finished.set()
+
+    bot.process_update = timed_process_update
+    # updates of different chats are interleaved - as they come in reality
+    for step in range(max(len(script) for script in scripts)):
+        for script in scripts:
+            if step < len(script):
+                telegram.push(script[step])
+
+    queries_before = queries.count
+    calls_before = sum(telegram.calls.values())
+    start = time.perf_counter()
+    await finished.wait()
+    elapsed = time.perf_counter() - start
+    bot.process_update = process_update
+    await bot.sender.drain()
+    return {
+        'updates': expected,
+        'updates_per_sec': expected / elapsed,
+        'handler_latency_p50': percentile(latencies, 0.5),
+        'handler_latency_p99': percentile(latencies, 0.99),
+        'db_queries_per_update': (queries.count - queries_before) / expected,
+        'api_calls_per_update': (sum(telegram.calls.values()) - calls_before) / expected,
+    }
+
+
+async def run_conversations(telegram: FakeTelegram, queries: QueryCounter, conversations: int) -> dict:
+    scripts = [conversation(telegram, CONVERSATION_CHAT_ID_START + i) for i in range(conversations)]
+    metrics = await run_scripts(telegram, queries, scripts)
+    metrics['edits_coalesced'] = bot.sender.coalesced
+    return metrics
+
+
+async def run_returning_chats(telegram: FakeTelegram, queries: QueryCounter, chats: int) -> dict:
+    chat_cache.clear()
+    scripts = [[message_update(telegram, chat_id, '/start')] for chat_id in range(chats)]
+    metrics = await run_scripts(telegram, queries, scripts)
+    return {f'returning_{key}': value for key, value in metrics.items() if key != 'updates'}
+
+
+async def run_reminder_burst(telegram: FakeTelegram, queries: QueryCounter) -> dict:
+    await db.status(db.text(
+        "UPDATE chat SET notify_next_date_time = now() AT TIME ZONE 'UTC' - interval '1 minute', "
+        "fire_at = now() AT TIME ZONE 'UTC' - interval '1 minute', lease_until = NULL"
+    ))
+    await db.status(db.text(
+        "UPDATE task SET notify_time = now() AT TIME ZONE 'UTC' - interval '1 day', "
+        "fire_at = now() AT TIME ZONE 'UTC' - interval '1 day', lease_until = NULL"
+    ))
+    sent_before = telegram.calls['sendMessage']
+    queries_before = queries.count
+    start = time.perf_counter()
+    await remind_all()
+    queued = time.perf_counter() - start
+
+    async def drain():
+        while await flush_outbox():
+            pass
+
+    await asyncio.gather(*[drain() for _ in range(OUTBOX_FLUSHERS)])
+    elapsed = time.perf_counter() - start
+    notifications = telegram.calls['sendMessage'] - sent_before
+    return {
+        'notifications': notifications,
+        'notifications_per_sec': notifications / elapsed,
+        'remind_all_seconds': queued,
+        'outbox_flush_seconds': elapsed - queued,
+        'db_queries_per_notification': (queries.count - queries_before) / max(notifications, 1),
+    }
+
+
+def save_results(results: dict):
+    RESULTS_DIR.mkdir(exist_ok=True)
+    previous = sorted(RESULTS_DIR.glob('*.json'))
+    path = RESULTS_DIR / f'{datetime.now():%Y%m%d-%H%M%S}.json'
+    path.write_text(json.dumps(results, indent=2))
+    print(f'Results saved to {path}')
+    if not previous:
+        for key, value in results['metrics'].items():
+            print(f'{key:32} {value:12.4f}')
+        return
+    before = json.loads(previous[-1].read_text())
+    print(f'Compared with {previous[-1].name} {before["params"]}')
+    for key, value in results['metrics'].items():
+        old = before['metrics'].get(key)
+        if old is None:
+            print(f'{key:32} {"-":>12} -> {value:12.4f}')
+            continue
+        change = f'{(value - old) / old * 100:+8.1f}%' if old else ''
+        print(f'{key:32} {old:12.4f} -> {value:12.4f} {change}')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url', default=os.environ.get('BENCH_DB_URL', 'postgresql://localhost/tgbot_bench'))
+    parser.add_argument('--chats', type=int, default=1000, help='chats to seed')
+    parser.add_argument('--tasks', type=int, default=10000, help='tasks to seed')
+    parser.add_argument('--conversations', type=int, default=200, help='scripted dialogs in new chats')
+    parser.add_argument('--returning', type=int, default=500, help='/start in that many seeded chats')
+    parser.add_argument('--latency', type=float, default=0.01, help='fake Telegram API latency, sec')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after of injected 429')
+    parser.add_argument('--no-rate-limit', action='store_true', help='disable outbound rate limits of the bot')
+    args = parser.parse_args()
+
+    if args.no_rate_limit:
+        sender.CHAT_RATE = sender.GROUP_RATE = sender.CHAT_BURST = sender.GROUP_BURST = 10 ** 9
+        bot.sender.global_bucket = sender.TokenBucket(10 ** 9, 10 ** 9)
+
+    telegram = FakeTelegram(args.latency, args.error_rate, args.retry_after)
+    bot.api_url = await telegram.start()
+    queries = QueryCounter()
+    async with connect(args.db_url):
+        await seed(args.chats, args.tasks)
+        queries.install()
+        # one polling loop for all phases - getUpdates of a stopped loop would still take updates from the fake
+        polling = asyncio.ensure_future(bot.loop())
+        try:
+            metrics = await run_conversations(telegram, queries, args.conversations)
+            metrics.update(await run_returning_chats(telegram, queries, min(args.returning, args.chats)))
+            metrics.update(await run_reminder_burst(telegram, queries))
+        finally:
+            bot.stop()
+            polling.cancel()
+            queries.uninstall()
+    metrics['throttled'] = telegram.throttled
+    bot.sender.stop()
+    await bot.close()
+    await telegram.stop()
+    params = {key: value for key, value in vars(args).items() if key != 'db_url'}
+    save_results({'params': params, 'metrics': metrics})
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
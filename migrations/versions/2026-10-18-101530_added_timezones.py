@@ -0,0 +1,71 @@
+"""added timezones
+
+Times were local times of the server, now instants are UTC and wall times are local times of the chat.
+Existing times are taken as local times of DEFAULT_TIMEZONE - set it to the zone the bot ran in before
+upgrade (and keep it set, it is the zone of new chats). Stop the bot for the upgrade: leases are dropped.
+
+Revision ID: 28e47efbb6a2
+Revises: 9838537370c6
+Create Date: 2026-10-18 10:15:30.118274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from tasksbot.clock import DEFAULT_TIMEZONE
+
+
+# revision identifiers, used by Alembic.
+revision = '28e47efbb6a2'
+down_revision = '9838537370c6'
+branch_labels = None
+depends_on = None
+
+TO_UTC = "({} AT TIME ZONE :zone) AT TIME ZONE 'UTC'"
+TO_LOCAL = "({} AT TIME ZONE 'UTC') AT TIME ZONE :zone"
+
+
+def execute(sql):
+    op.execute(sa.text(sql).bindparams(zone=DEFAULT_TIMEZONE))
+
+
+def convert(table, columns, template):
+    execute(f"UPDATE {table} SET " + ', '.join(f"{column} = {template.format(column)}" for column in columns))
+
+
+def upgrade():
+    op.add_column('chat', sa.Column('fire_at', sa.DateTime(), nullable=True))
+    op.add_column('chat', sa.Column('timezone', sa.String(length=64), server_default=DEFAULT_TIMEZONE, nullable=True))
+    op.add_column('task', sa.Column('fire_at', sa.DateTime(), nullable=True))
+    execute(f"UPDATE chat SET fire_at = {TO_UTC.format('notify_next_date_time')}, lease_until = NULL")
+    # not exact task is due from the local midnight after its notify_time (see scheduler.task_fire_at)
+    day_after = "CASE WHEN exact_in_time OR notify_time = date_trunc('day', notify_time) THEN notify_time " \
+                "ELSE date_trunc('day', notify_time) + interval '1 day' END"
+    execute(f"UPDATE task SET fire_at = {TO_UTC.format(day_after)}, "
+            f"last_done_time = {TO_UTC.format('last_done_time')}, lease_until = NULL")
+    convert('outbox', ['due_time', 'created_at', 'sent_at'], TO_UTC)
+    op.execute("UPDATE outbox SET lease_until = NULL")
+    op.drop_index('ix_chat_notify_next_date_time', table_name='chat')
+    op.drop_index('ix_task_exact_in_time_notify_time', table_name='task')
+    op.drop_index('ix_task_chat_id_notify_time', table_name='task')
+    op.create_index(op.f('ix_chat_fire_at'), 'chat', ['fire_at'], unique=False)
+    op.create_index('ix_task_exact_in_time_fire_at', 'task', ['exact_in_time', 'fire_at'], unique=False)
+    op.create_index('ix_task_chat_id_fire_at', 'task', ['chat_id', 'fire_at'], unique=False, postgresql_where=sa.text('NOT exact_in_time'))
+
+
+def downgrade():
+    op.drop_index('ix_task_chat_id_fire_at', table_name='task')
+    op.drop_index('ix_task_exact_in_time_fire_at', table_name='task')
+    op.drop_index(op.f('ix_chat_fire_at'), table_name='chat')
+    op.create_index('ix_task_chat_id_notify_time', 'task', ['chat_id', 'notify_time'], unique=False, postgresql_where=sa.text('NOT exact_in_time'))
+    op.create_index('ix_task_exact_in_time_notify_time', 'task', ['exact_in_time', 'notify_time'], unique=False)
+    op.create_index('ix_chat_notify_next_date_time', 'chat', ['notify_next_date_time'], unique=False)
+    # wall times of chats in other zones are kept as they are - as times of DEFAULT_TIMEZONE
+    convert('task', ['last_done_time'], TO_LOCAL)
+    convert('outbox', ['due_time', 'created_at', 'sent_at'], TO_LOCAL)
+    op.execute("UPDATE chat SET lease_until = NULL")
+    op.execute("UPDATE task SET lease_until = NULL")
+    op.execute("UPDATE outbox SET lease_until = NULL")
+    op.drop_column('task', 'fire_at')
+    op.drop_column('chat', 'timezone')
+    op.drop_column('chat', 'fire_at')
@@ -0,0 +1,67 @@
+"""added bot_id
+
+Chats, tasks and outbox messages belong to a bot - one process can serve several bots (TG_BOT_TOKENS).
+Existing rows are given to the bot of TG_BOT_TOKEN (or the first of TG_BOT_TOKENS) - set it for the upgrade.
+
+Revision ID: 5c1f0e7d9a3b
+Revises: 28e47efbb6a2
+Create Date: 2026-10-18 11:30:42.503116
+
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1f0e7d9a3b'
+down_revision = '28e47efbb6a2'
+branch_labels = None
+depends_on = None
+
+TABLES = ('chat', 'task', 'outbox')
+
+
+def existing_bot_id() -> str:
+    token = os.environ.get('TG_BOT_TOKENS', os.environ.get('TG_BOT_TOKEN', '')).split(',')[0].strip()
+    bot_id = token.split(':', 1)[0]
+    if not bot_id:
+        rows = op.get_bind().execute(sa.text('SELECT EXISTS (SELECT 1 FROM chat)')).scalar()
+        if rows:
+            raise RuntimeError('TG_BOT_TOKEN is needed to assign existing chats to the bot')
+    return bot_id
+
+
+def upgrade():
+    bot_id = existing_bot_id()
+    for table in TABLES:
+        op.add_column(table, sa.Column('bot_id', sa.String(length=32), server_default=bot_id, nullable=False))
+        op.alter_column(table, 'bot_id', server_default=None)
+    op.drop_constraint('task_chat_id_fkey', 'task', type_='foreignkey')
+    op.drop_constraint('chat_pkey', 'chat', type_='primary')
+    op.create_primary_key('chat_pkey', 'chat', ['bot_id', 'chat_id'])
+    op.create_foreign_key('task_bot_id_chat_id_fkey', 'task', 'chat', ['bot_id', 'chat_id'], ['bot_id', 'chat_id'])
+    op.drop_index('ix_task_chat_id_fire_at', table_name='task')
+    op.drop_index('ix_task_chat_id', table_name='task')
+    op.create_index('ix_task_bot_id_chat_id', 'task', ['bot_id', 'chat_id'], unique=False)
+    op.create_index('ix_task_bot_id_chat_id_fire_at', 'task', ['bot_id', 'chat_id', 'fire_at'], unique=False,
+                    postgresql_where=sa.text('NOT exact_in_time'))
+
+
+def downgrade():
+    # chats of other bots would collide by chat_id - only one bot can be downgraded
+    bots = op.get_bind().execute(sa.text('SELECT count(DISTINCT bot_id) FROM chat')).scalar()
+    if bots > 1:
+        raise RuntimeError(f'chats of {bots} bots can not be downgraded to one bot')
+    op.drop_index('ix_task_bot_id_chat_id_fire_at', table_name='task')
+    op.drop_index('ix_task_bot_id_chat_id', table_name='task')
+    op.create_index('ix_task_chat_id', 'task', ['chat_id'], unique=False)
+    op.create_index('ix_task_chat_id_fire_at', 'task', ['chat_id', 'fire_at'], unique=False,
+                    postgresql_where=sa.text('NOT exact_in_time'))
+    op.drop_constraint('task_bot_id_chat_id_fkey', 'task', type_='foreignkey')
+    op.drop_constraint('chat_pkey', 'chat', type_='primary')
+    op.create_primary_key('chat_pkey', 'chat', ['chat_id'])
+    op.create_foreign_key('task_chat_id_fkey', 'task', 'chat', ['chat_id'], ['chat_id'])
+    for table in TABLES:
+        op.drop_column(table, 'bot_id')
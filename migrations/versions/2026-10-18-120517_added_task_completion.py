@@ -0,0 +1,52 @@
+"""added task_completion
+
+Log of done marks, partitioned by month - partitions are created (and dropped) by the bot,
+see tasksbot.completions.maintain_partitions. completion_stats is its rollup.
+
+Revision ID: 7d2e4b9c1f60
+Revises: 5c1f0e7d9a3b
+Create Date: 2026-10-18 12:05:17.264381
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2e4b9c1f60'
+down_revision = '5c1f0e7d9a3b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('task_completion',
+    sa.Column('id', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('done_at', sa.DateTime(), nullable=False),
+    sa.Column('bot_id', sa.String(length=32), nullable=False),
+    sa.Column('chat_id', sa.String(length=255), nullable=False),
+    sa.Column('task_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.String(length=128), nullable=False),
+    sa.PrimaryKeyConstraint('id', 'done_at'),
+    postgresql_partition_by='RANGE (done_at)'
+    )
+    op.create_index('ix_task_completion_bot_id_chat_id_done_at', 'task_completion', ['bot_id', 'chat_id', 'done_at'], unique=False)
+    op.create_table('completion_stats',
+    sa.Column('bot_id', sa.String(length=32), nullable=False),
+    sa.Column('chat_id', sa.String(length=255), nullable=False),
+    sa.Column('user_id', sa.String(length=128), nullable=False),
+    sa.Column('user_name', sa.String(length=255), server_default='', nullable=True),
+    sa.Column('completions', sa.BigInteger(), server_default='0', nullable=True),
+    sa.Column('first_day', sa.Date(), nullable=True),
+    sa.Column('last_day', sa.Date(), nullable=True),
+    sa.Column('streak', sa.Integer(), server_default='0', nullable=True),
+    sa.Column('best_streak', sa.Integer(), server_default='0', nullable=True),
+    sa.PrimaryKeyConstraint('bot_id', 'chat_id', 'user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('completion_stats')
+    # partitions go with it
+    op.drop_index('ix_task_completion_bot_id_chat_id_done_at', table_name='task_completion')
+    op.drop_table('task_completion')
@@ -1,30 +1,128 @@
-import asyncio
+import atexit
 import logging
-from functools import partial
+import os
+import sys
+import threading
+from collections import deque
 
+from tasksbot.metrics import GaugeCallback
 
-class ToAsync:
-    def __init__(self, sync_logger):
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# what to do when queue is full: 'drop_new' - drop record being logged, 'drop_old' - drop the oldest queued record
+LOG_OVERFLOW = os.environ.get('LOG_OVERFLOW', 'drop_new')
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 0.2))
+LOG_BATCH_SIZE = 500
+
+
+class LogQueue:
+    """
+    Records are appended to a bounded deque without any blocking,
+    a single background thread takes them out in batches and passes to the handlers.
+    """
+
+    def __init__(self, size=LOG_QUEUE_SIZE, overflow=LOG_OVERFLOW, flush_interval=LOG_FLUSH_INTERVAL):
+        self.size = size
+        self.drop_old = overflow == 'drop_old'
+        self.flush_interval = flush_interval
+        self._records = deque(maxlen=size)
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._running = False
+        self.written = 0
+        self.dropped = 0
+        self.skipped = 0
+
+    def put(self, record: logging.LogRecord):
+        if self._thread is None:
+            self.start()
+        if len(self._records) >= self.size:
+            self.dropped += 1
+            if not self.drop_old:
+                return
+        self._records.append(record)
+        if len(self._records) >= LOG_BATCH_SIZE:
+            self._wakeup.set()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._write_loop, name='log-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def flush(self):
+        while self._records:
+            record = self._records.popleft()
+            logging.getLogger(record.name).handle(record)
+            self.written += 1
+
+    def _write_loop(self):
+        while self._running:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+        self.flush()
+
+    def stats(self):
+        return {
+            'queued': len(self._records),
+            'written': self.written,
+            'dropped': self.dropped,
+            'skipped': self.skipped,
+        }
+
+
+log_queue = LogQueue()
+GaugeCallback('tasksbot_log_queue', 'Queue of log records', log_queue.stats, ['stat'])
+
+
+class AsyncLogger:
+    """
+    Logger which doesn't block caller - checks level, makes record and queues it.
+    Message is formatted later by the writer thread.
+    """
+
+    def __init__(self, sync_logger: logging.Logger, queue: LogQueue = log_queue):
         self._logger = sync_logger
-        self.loop = asyncio.get_event_loop()
+        self._queue = queue
+
+    def log(self, level, msg, *args, exc_info=None, extra=None):
+        if not self._logger.isEnabledFor(level):
+            self._queue.skipped += 1
+            return
+        if isinstance(exc_info, BaseException):
+            exc_info = (type(exc_info), exc_info, exc_info.__traceback__)
+        elif exc_info and not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+        record = self._logger.makeRecord(
+            self._logger.name, level, "(unknown file)", 0, msg, args, exc_info, extra=extra
+        )
+        self._queue.put(record)
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
 
-    def __getattr__(self, item):
-        if not hasattr(self._logger, item):
-            super().__getattr__(item)
+    def error(self, msg, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
 
-        attr = getattr(self._logger, item)
-        if not callable(attr):
-            return attr
-        # result of calling can be awaitable or not - anyway it starts doing action an "backgroud".
-        #  if need result of that action or need to wait when action has been done - use "await"
-        #  if don't need wait when action done - can call without await
-        async_method = lambda *args, **kwargs: self.loop.run_in_executor(None, partial(
-            self._logger.info, *args, **kwargs))
+    def exception(self, msg, *args, exc_info=True, **kwargs):
+        self.log(logging.ERROR, msg, *args, exc_info=exc_info, **kwargs)
 
-        setattr(self, item, async_method)
-        return async_method
+    def critical(self, msg, *args, **kwargs):
+        self.log(logging.CRITICAL, msg, *args, **kwargs)
 
 
 def get_async_logger(name):
     logger = logging.getLogger(name)
-    return ToAsync(logger)
+    return AsyncLogger(logger)
@@ -1,21 +1,51 @@
 import asyncio
 import os
 import re
+import tempfile
 from datetime import datetime, timedelta
 from enum import IntEnum
 from functools import partial
-from typing import Union
+from typing import Optional
 
 import aiotg
-from sqlalchemy.sql.functions import now
 
+from tasksbot import clock
+from tasksbot.cache import chat_cache, get_chat, update_chat, menu_cache, task_cache, prefetch_chats, prefetch_tasks
+from tasksbot.completions import record_completion, load_stats, make_stats_text
+from tasksbot.database import db, DB_QUERY_SECONDS, Statement, read_bind
+from tasksbot.digest import make_digest, load_digest_tasks
+from tasksbot.dispatcher import update_key
+from tasksbot.metrics import GaugeCallback
 from tasksbot.models import Task
 from tasksbot.models.chat import Chat
-
-bot = aiotg.Bot(
-    api_token=os.environ.get('TG_BOT_TOKEN', ''),
+from tasksbot.profiling import toggle_profiling, dump_slow_calls, slow_calls
+from tasksbot.scheduler import scheduler, schedule_chat, schedule_task, discard_task, task_fire_at, RESYNC_INTERVAL
+from tasksbot.telegram import TasksBot
+from tasksbot.transfer import download, import_tasks, imported_exact_tasks, export_tasks, is_json, \
+    TasksFileError, IMPORT_MAX_FILE_SIZE, COLUMNS
+
+# several bots can be served by one process - TG_BOT_TOKENS is comma separated list of their tokens
+BOT_TOKENS = [
+    token.strip() for token in os.environ.get('TG_BOT_TOKENS', os.environ.get('TG_BOT_TOKEN', '')).split(',')
+    if token.strip()
+] or ['']
+
+# handlers are registered on the first bot, the others get them at the end of the module (see TasksBot.tenant)
+bot = TasksBot(
+    api_token=BOT_TOKENS[0],
     default_in_groups=True,
 )
+# all bots of the process by bot_id
+bots = {bot.bot_id: bot}
+
+GaugeCallback('tasksbot_sender', 'Outbound queue of Telegram API calls', lambda: {
+    (bot_id, stat): value for bot_id, tenant in bots.items() for stat, value in tenant.sender.stats().items()
+}, ['bot', 'stat'])
+GaugeCallback('tasksbot_dispatcher', 'Incoming updates dispatcher', bot.dispatcher.stats, ['stat'])
+
+MENU_PAGE_SIZE = int(os.environ.get('MENU_PAGE_SIZE', 10))
+# Telegram user ids which can use admin commands (/profile), comma separated
+ADMIN_IDS = {user_id.strip() for user_id in os.environ.get('TG_ADMIN_IDS', '').split(',') if user_id.strip()}
 
 
 class ChatState(IntEnum):
@@ -24,29 +54,194 @@ class ChatState(IntEnum):
     EXPECT_PERIOD = 2
     EXPECT_TIME_WHEN_SEND_NOTIFY = 3
     EXPECT_TASK_TIME_WHEN_SEND_NOTIFY = 4
+    EXPECT_IMPORT = 5
 
 
 GREETING_BY_STATE = [
     '',
     'Вводи новое дело',
     "Вводи период",
-    "Введи время когда присылать уведомление (ЧЧ:ММ)"
-    "Введи время когда присылать уведомление (ЧЧ:ММ)"
+    "Введи время когда присылать уведомление (ЧЧ:ММ)",
+    "Введи время когда присылать уведомление (ЧЧ:ММ)",
+    "Пришли файл с задачами (CSV или JSON)",
 ]
 
+IMPORT_HELP = (
+    'Пришли файл с задачами - CSV с колонками ' + ', '.join(COLUMNS) + ' в первой строке '
+    'или JSON - список объектов с такими ключами. Обязательна только content, '
+    'notify_time - "ГГГГ-ММ-ДД ЧЧ:ММ" или "ЧЧ:ММ", exact_in_time - 1, если напоминать точно в это время.'
+)
+
+TIMEZONE_HELP = 'Чтобы сменить часовой пояс, пришли /timezone и его название, например /timezone Europe/Moscow'
+
 
 @bot.command(r"^/start")
 async def start(chat: aiotg.Chat, match):
-    db_chat: Chat = await Chat.get(str(chat.id))
+    db_chat: Chat = await get_chat(chat.bot.bot_id, str(chat.id))
     if not db_chat:
         db_chat: Chat = await create_chat_in_db(chat)
         return chat.reply('Привет. Начни с того что сразу введи дело.')
     return chat.reply(f'Рад видеть тебя снова {GREETING_BY_STATE[db_chat.chat_state]}')
 
 
-async def make_menu_markup(chat: aiotg.Chat):
-    t: Union[Task, None] = None
-    return {
+@bot.command(r"^/digest")
+async def toggle_digest(chat: aiotg.Chat, match):
+    db_chat: Chat = await get_chat(chat.bot.bot_id, str(chat.id))
+    if not db_chat:
+        db_chat: Chat = await create_chat_in_db(chat)
+    await update_chat(db_chat, digest=not db_chat.digest)
+    if db_chat.digest:
+        return chat.reply('Теперь все напоминания дня будут приходить одним сообщением.')
+    return chat.reply('Теперь каждое напоминание будет приходить отдельным сообщением.')
+
+
+@bot.command(r"^/stats")
+async def stats_command(chat: aiotg.Chat, match):
+    bot_id, chat_id = chat.bot.bot_id, str(chat.id)
+    rows = await load_stats(bot_id, chat_id)
+    today = clock.to_local(clock.now(), await chat_timezone(bot_id, chat_id)).date()
+    return chat.reply(make_stats_text(rows, today))
+
+
+@bot.command(r"^/profile(?:\s+(slow))?$")
+async def profile_command(chat: aiotg.Chat, match):
+    # not a command for others - no answer
+    if str(chat.sender.get('id')) not in ADMIN_IDS:
+        return
+    if match.group(1):
+        slowest = sorted(slow_calls, key=lambda call: call.seconds, reverse=True)[:5]
+        path = dump_slow_calls()
+        if not path:
+            return chat.reply('Медленных вызовов нет.')
+        lines = [f'{call.route}: {call.seconds:.2f} сек' for call in slowest]
+        return chat.reply(f'Медленных вызовов: {len(slow_calls)}, записаны в {path}\n' + '\n'.join(lines))
+    running, paths = toggle_profiling()
+    if running:
+        return chat.reply('Профилирование запущено, /profile - остановить.')
+    return chat.reply('Профилирование остановлено, отчёты:\n' + '\n'.join(paths))
+
+
+@bot.command(r"^/timezone(?:\s+(\S+))?")
+async def timezone_command(chat: aiotg.Chat, match):
+    db_chat: Chat = await get_chat(chat.bot.bot_id, str(chat.id))
+    if not db_chat:
+        db_chat: Chat = await create_chat_in_db(chat)
+    zone = match.group(1)
+    if not zone:
+        return chat.reply(f'Часовой пояс: {db_chat.timezone}.\n{TIMEZONE_HELP}')
+    try:
+        clock.get_zone(zone)
+    except (KeyError, ValueError):
+        return chat.reply(f'Не знаю часового пояса "{zone}".\n{TIMEZONE_HELP}')
+    await change_timezone(db_chat, zone)
+    local_now = clock.to_local(clock.now(), zone)
+    return chat.reply(f'Часовой пояс: {zone}, там сейчас {local_now:%H:%M}. '
+                      f'Напоминания будут приходить в то же время по местным часам.')
+
+
+@bot.command(r"^/import")
+async def import_command(chat: aiotg.Chat, match):
+    db_chat: Chat = await get_chat(chat.bot.bot_id, str(chat.id))
+    if not db_chat:
+        db_chat: Chat = await create_chat_in_db(chat)
+    await update_chat(db_chat, chat_state=ChatState.EXPECT_IMPORT)
+    return chat.reply(IMPORT_HELP)
+
+
+@bot.handle("document")
+async def document_message(chat: aiotg.Chat, document: dict):
+    db_chat: Chat = await get_chat(chat.bot.bot_id, str(chat.id))
+    by_caption = chat.message.get('caption', '').startswith('/import')
+    if not by_caption and (not db_chat or db_chat.chat_state != ChatState.EXPECT_IMPORT):
+        return
+    if not db_chat:
+        db_chat: Chat = await create_chat_in_db(chat)
+    await update_chat(db_chat, chat_state=ChatState.NORMAL)
+    if document.get('file_size', 0) > IMPORT_MAX_FILE_SIZE:
+        return chat.reply(f'Файл больше {IMPORT_MAX_FILE_SIZE // 1024 // 1024}МБ, такие я скачать не могу.')
+
+    bot_id, chat_id = db_chat.bot_id, db_chat.chat_id
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as file:
+        await download(chat.bot, document['file_id'], file)
+        try:
+            result = await import_tasks(bot_id, chat_id, db_chat.timezone, file,
+                                        is_json(document.get('file_name'), document.get('mime_type')))
+        except (TasksFileError, UnicodeDecodeError) as e:
+            return chat.reply(f'Не получилось загрузить задачи: {e}')
+    invalidate_menu(bot_id, chat_id)
+    for task_id, fire_at in await imported_exact_tasks(bot_id, chat_id, clock.now() + RESYNC_INTERVAL):
+        scheduler.schedule(('task', task_id), fire_at)
+    text = f'Загружено задач: {result.imported}.'
+    if result.error_count:
+        text += f'\nПропущено строк с ошибками: {result.error_count}\n' + '\n'.join(result.errors)
+    return chat.reply(text)
+
+
+@bot.command(r"^/export(?:\s+(json))?")
+async def export_command(chat: aiotg.Chat, match):
+    json_format = bool(match.group(1))
+    with tempfile.TemporaryDirectory() as directory:
+        # file name is taken from the path when uploading
+        path = os.path.join(directory, 'tasks.json' if json_format else 'tasks.csv')
+        with open(path, 'w', encoding='utf-8', newline='') as file:
+            count = await export_tasks(chat.bot.bot_id, str(chat.id), file, json_format)
+        if not count:
+            return chat.reply('Задач пока нет.')
+        with open(path, 'rb') as file:
+            return await chat.send_document(file, caption=f'Задач: {count}')
+
+
+_menu_page_query = db.select([Task.id, Task.content]).where(
+    (Task.bot_id == db.bindparam('bot_id')) & (Task.chat_id == db.bindparam('chat_id'))
+)
+MENU_PAGE = Statement(
+    _menu_page_query.where(Task.id >= db.bindparam('from_id')).order_by(Task.id).limit(MENU_PAGE_SIZE + 1)
+)
+MENU_PREV_PAGE = Statement(
+    _menu_page_query.where(Task.id < db.bindparam('before_id')).order_by(Task.id.desc()).limit(MENU_PAGE_SIZE + 1)
+)
+
+
+async def load_menu_page(bot_id: str, chat_id: str, from_id: int = 0, before_id: int = None):
+    """
+    Keyset pagination: page of tasks with id >= from_id, or (if before_id is set) the page right before before_id.
+    Returns tasks (id, content) of the page and whether there are previous/next pages.
+    """
+    with DB_QUERY_SECONDS.time(query='menu_page'):
+        if before_id is None:
+            tasks = await MENU_PAGE.all(read_bind(), bot_id=bot_id, chat_id=chat_id, from_id=from_id)
+        else:
+            tasks = await MENU_PREV_PAGE.all(read_bind(), bot_id=bot_id, chat_id=chat_id, before_id=before_id)
+    has_more = len(tasks) > MENU_PAGE_SIZE
+    tasks = tasks[:MENU_PAGE_SIZE]
+    if before_id is None:
+        return tasks, from_id > 0, has_more
+    return tasks[::-1], has_more, True
+
+
+async def make_menu_markup(bot_id: str, chat_id: str, from_id: int = 0, before_id: int = None):
+    page_key = (from_id, before_id)
+    pages = menu_cache.get((bot_id, chat_id))
+    if pages is None:
+        pages = {}
+        menu_cache.put((bot_id, chat_id), pages)
+    if page_key in pages:
+        return pages[page_key]
+
+    tasks, has_prev, has_next = await load_menu_page(bot_id, chat_id, from_id, before_id)
+    page_from_id = tasks[0].id if tasks else from_id
+    navigation = []
+    if has_prev:
+        navigation.append({
+            'text': "⬅️",
+            'callback_data': f'prev/{page_from_id}'
+        })
+    if has_next:
+        navigation.append({
+            'text': "➡️",
+            'callback_data': f'page/{tasks[-1].id + 1}'
+        })
+    markup = {
         'inline_keyboard':
             [
                 [
@@ -71,21 +266,132 @@ async def make_menu_markup(chat: aiotg.Chat):
                     },
                     {
                         'text': "🗑",
-                        'callback_data': f'delete/{t.id}'
+                        'callback_data': f'delete/{t.id}/{page_from_id}'
                     }
                 ]
-                for t in await Task.query.where(Task.chat_id == str(chat.id)).gino.all()
-
-            ]
+                for t in tasks
+            ] + ([navigation] if navigation else [])
     }
+    pages[page_key] = markup
+    return markup
+
+
+async def get_task(task_id: int) -> Task:
+    task = task_cache.pop(task_id)
+    if task is not None:
+        return task
+    with DB_QUERY_SECONDS.time(query='task_get'):
+        return await Task.get(task_id)
+
+
+def invalidate_menu(bot_id: str, chat_id: str):
+    menu_cache.pop((bot_id, chat_id))
+
+
+# Button handlers change the task in one statement, which also checks that the task belongs to the chat
+async def mark_task_done(task_id: int, bot_id: str, chat_id: str, user_id: str) -> Optional[Task]:
+    with DB_QUERY_SECONDS.time(query='task_mark'):
+        return await Task.update.values(
+            done_mark_user_id=user_id,
+            last_done_time=clock.now()
+        ).where(
+            (Task.id == task_id) & (Task.bot_id == bot_id) & (Task.chat_id == chat_id)
+        ).returning(*Task).gino.first()
+
+
+async def delete_task(task_id: int, bot_id: str, chat_id: str) -> Optional[str]:
+    """
+    Deletes the task (and resets it as editing task of the chat), returns message_id of the task
+    """
+    with DB_QUERY_SECONDS.time(query='task_delete'):
+        row = await db.first(db.text(
+            'WITH unset_editing AS ('
+            '  UPDATE chat SET editing_task_id = NULL'
+            '  WHERE editing_task_id = :task_id AND bot_id = :bot_id AND chat_id = :chat_id'
+            '  RETURNING chat_id'
+            ')'
+            'DELETE FROM task WHERE id = :task_id AND bot_id = :bot_id AND chat_id = :chat_id '
+            'RETURNING message_id, EXISTS(SELECT 1 FROM unset_editing)'
+        ), task_id=task_id, bot_id=bot_id, chat_id=chat_id)
+    task_cache.pop(task_id)
+    if row is None:
+        return None
+    message_id, editing_unset = row
+    if editing_unset:
+        chat_cache.pop((bot_id, chat_id))
+    return message_id
+
+
+async def start_period_edit(task_id: int, bot_id: str, chat_id: str) -> Optional[tuple[Chat, str]]:
+    """
+    Makes chat expect period of the task, returns the chat and content of the task
+    """
+    with DB_QUERY_SECONDS.time(query='task_period_edit'):
+        row = await Chat.update.values(
+            chat_state=ChatState.EXPECT_PERIOD,
+            editing_task_id=Task.id
+        ).where(
+            (Chat.bot_id == bot_id) & (Chat.chat_id == chat_id) &
+            (Task.id == task_id) & (Task.bot_id == bot_id) & (Task.chat_id == chat_id)
+        ).returning(*Chat, Task.content).gino.load((Chat, Task.content)).first()
+    if row is not None:
+        chat_cache.put((bot_id, chat_id), row[0])
+    return row
+
+
+async def change_timezone(db_chat: Chat, zone: str):
+    """
+    Wall times of the chat and its tasks stay the same, their UTC instants are computed for the new time zone
+    """
+    with DB_QUERY_SECONDS.time(query='chat_timezone'):
+        async with db.transaction():
+            await update_chat(db_chat, timezone=zone, fire_at=clock.to_utc(db_chat.notify_next_date_time, zone))
+            tasks = await db.select([Task.id, Task.notify_time, Task.exact_in_time]).where(
+                (Task.bot_id == db_chat.bot_id) & (Task.chat_id == db_chat.chat_id)
+            ).gino.all()
+            fire_ats = [(task_id, task_fire_at(notify_time, exact_in_time, zone), exact_in_time)
+                        for task_id, notify_time, exact_in_time in tasks]
+            await db.status(db.text(
+                'UPDATE task SET fire_at = v.fire_at '
+                'FROM unnest(CAST(:ids AS integer[]), CAST(:fire_ats AS timestamp[])) AS v(id, fire_at) '
+                'WHERE task.id = v.id'
+            ), ids=[task_id for task_id, _, _ in fire_ats], fire_ats=[fire_at for _, fire_at, _ in fire_ats])
+    schedule_chat(db_chat)
+    horizon = clock.now() + RESYNC_INTERVAL
+    for task_id, fire_at, exact_in_time in fire_ats:
+        if exact_in_time and fire_at <= horizon:
+            scheduler.schedule(('task', task_id), fire_at)
+
+
+async def chat_timezone(bot_id: str, chat_id: str) -> str:
+    db_chat: Chat = await get_chat(bot_id, chat_id)
+    return db_chat.timezone if db_chat else clock.DEFAULT_TIMEZONE
 
 
 @bot.command(r"^/menu")
 async def menu(chat: aiotg.Chat, match):
-    markup = await make_menu_markup(chat)
+    markup = await make_menu_markup(chat.bot.bot_id, str(chat.id))
     chat.reply("Выбери действие:", markup=markup)
 
 
+@bot.callback(r'^page/(\d+)$')
+async def callback_menu_page(chat: aiotg.Chat, cb: aiotg.CallbackQuery, match: re.Match):
+    markup = await make_menu_markup(chat.bot.bot_id, str(chat.id), from_id=int(match.group(1)))
+    await asyncio.gather(
+        chat.edit_reply_markup(chat.message['message_id'], markup=markup),
+        cb.answer()
+    )
+
+
+@bot.callback(r'^prev/(\d+)$')
+async def callback_menu_prev_page(chat: aiotg.Chat, cb: aiotg.CallbackQuery, match: re.Match):
+    markup = await make_menu_markup(chat.bot.bot_id, str(chat.id), before_id=int(match.group(1)))
+    await asyncio.gather(
+        chat.edit_reply_markup(chat.message['message_id'], markup=markup),
+        cb.answer()
+    )
+
+
 def plural(number: int, one: str, two: str, many: str):
     if 5 < number < 20:
         return many
@@ -106,7 +412,7 @@ def get_chat_title(chat: aiotg.Chat):
 
 @bot.default
 async def message(chat: aiotg.Chat, match):
-    db_chat: Chat = await Chat.get(str(chat.id))
+    db_chat: Chat = await get_chat(chat.bot.bot_id, str(chat.id))
     if not db_chat:
         db_chat: Chat = await create_chat_in_db(chat)
     if chat.message['chat']['type'] == 'group':
@@ -118,35 +424,55 @@ async def message(chat: aiotg.Chat, match):
             time = time(hours, minutes, 0)
         except Exception:
             return chat.reply('Что-то не очень похоже на время. что то типа "12:22" я бы понял.')
-        await db_chat.update(
+        # the date is read from DB: the reminder (maybe of other worker) could have moved the notification
+        # to the next day since the chat was cached, a stale date would make the reminder due right away
+        with DB_QUERY_SECONDS.time(query='chat_notify_date'):
+            notify_next_date_time = await db.select([Chat.notify_next_date_time]).where(
+                (Chat.bot_id == db_chat.bot_id) & (Chat.chat_id == db_chat.chat_id)
+            ).gino.scalar()
+        notify_next_date_time = datetime.combine(notify_next_date_time.date(), time)
+        await update_chat(
+            db_chat,
             chat_state=ChatState.NORMAL,
-            notify_next_date_time=datetime.combine(
-                db_chat.notify_next_date_time.date(), time
-            ),
+            notify_next_date_time=notify_next_date_time,
+            fire_at=clock.to_utc(notify_next_date_time, db_chat.timezone),
             editing_task_id=None
-        ).apply()
+        )
+        schedule_chat(db_chat)
         return chat.reply(f'Устновлено время уведомления - {time:%H:%M}')
     elif db_chat.chat_state == ChatState.EXPECT_TASK:
-        editing_task = await Task.create(
-            content=chat.message['text'],
-            message_id=str(chat.message['message_id']),
-            chat_id=str(chat.id)
-        )
-        await db_chat.update(
+        notify_time = clock.to_local(clock.now(), db_chat.timezone) + timedelta(days=1)
+        with DB_QUERY_SECONDS.time(query='task_create'):
+            editing_task = await Task.create(
+                content=chat.message['text'],
+                message_id=str(chat.message['message_id']),
+                bot_id=db_chat.bot_id,
+                chat_id=db_chat.chat_id,
+                notify_time=notify_time,
+                fire_at=task_fire_at(notify_time, False, db_chat.timezone)
+            )
+        schedule_task(editing_task)
+        invalidate_menu(editing_task.bot_id, editing_task.chat_id)
+        await update_chat(
+            db_chat,
             chat_state=ChatState.EXPECT_PERIOD,
             editing_task_id=editing_task.id
-        ).apply()
+        )
         return chat.reply('Теперь введите периодичность в днях (просто целое число!)')
     elif db_chat.chat_state == ChatState.EXPECT_PERIOD and db_chat.editing_task_id:
         try:
             period = int(chat.message['text'])
         except Exception:
             return chat.reply('Что-то не очень похоже на число. что то типа "5" я бы понял, но не это.')
-        task: Task = await Task.get(db_chat.editing_task_id)
-        await db_chat.update(chat_state=ChatState.NORMAL, editing_task_id=None).apply()
+        if period < 1:
+            return chat.reply('Период должен быть не меньше 1 дня. Введите целое число, например "5".')
+        task: Task = await get_task(db_chat.editing_task_id)
+        await update_chat(db_chat, chat_state=ChatState.NORMAL, editing_task_id=None)
         if not task:
             chat.reply(f"Уже такой задачи нет. ({db_chat.editing_task_id})")
-        await task.update(period_days=period).apply()
+        with DB_QUERY_SECONDS.time(query='task_period'):
+            await task.update(period_days=period).apply()
+        schedule_task(task)
 
         return chat.send_text(
             f'Устанавливлен период {period} {plural_days(period)}.',
@@ -160,84 +486,122 @@ async def message(chat: aiotg.Chat, match):
 
 @bot.callback(r'new')
 async def callback_new(chat: aiotg.Chat, cb, match):
-    db_chat: Chat = await Chat.get(str(chat.id))
-    await db_chat.update(chat_state=ChatState.EXPECT_TASK).apply()
+    db_chat: Chat = await get_chat(chat.bot.bot_id, str(chat.id))
+    await update_chat(db_chat, chat_state=ChatState.EXPECT_TASK)
     text = GREETING_BY_STATE[db_chat.chat_state]
     await asyncio.gather(chat.send_text(text), cb.answer(text=text, show_alert=False))
 
 
 @bot.callback(r'setup/time')
 async def callback_new(chat: aiotg.Chat, cb, match):
-    db_chat: Chat = await Chat.get(str(chat.id))
-    await db_chat.update(chat_state=ChatState.EXPECT_TIME_WHEN_SEND_NOTIFY).apply()
+    db_chat: Chat = await get_chat(chat.bot.bot_id, str(chat.id))
+    await update_chat(db_chat, chat_state=ChatState.EXPECT_TIME_WHEN_SEND_NOTIFY)
     text = f"Сейчас время уведомлений {db_chat.notify_next_date_time.time():%H:%M}.\nВведи новое время уведомлений в формате Ч:М"
     await asyncio.gather(chat.send_text(text), cb.answer(text=text, show_alert=False))
 
 
-@bot.callback(r'mark/(\d+)')
+@bot.callback(r'mark/(\d+)(/digest)?')
 async def callback_mark_task_as_done(chat: aiotg.Chat, cb: aiotg.CallbackQuery, match: re.Match):
-    task: Task = await Task.get(int(match.group(1)))
+    task: Task = await mark_task_done(int(match.group(1)), chat.bot.bot_id, str(chat.id), str(cb.src['from']['id']))
     if not task:
-        text = f"Странно, но такой задачи у меня нет (ИД={task.id})"
+        text = f"Странно, но такой задачи у меня нет (ИД={match.group(1)})"
         return await cb.answer(text=text, show_alert=True)
 
-    await task.update(
-        done_mark_user_id=str(cb.src['from']['id']),
-        last_done_time=now()
-    ).apply()
+    schedule_task(task)
+    timezone = await chat_timezone(task.bot_id, task.chat_id)
+    record_completion(task, str(cb.src['from']['id']), cb.src['from'].get('username', ''), timezone)
     text = f'Задача "{task.content}" отмечена как выполнена. ' \
            f'Следующий раз напомню через {task.period_days} {plural_days(task.period_days)}'
 
     await cb.answer(text=text, show_alert=True)
+    if match.group(2):
+        # digest - the whole message is rendered again with done marks of its tasks
+        message_id = chat.message['message_id']
+        tasks = await load_digest_tasks(chat.bot.bot_id, str(chat.id), str(message_id))
+        if not tasks:
+            # message_id is not written back by outbox flusher yet
+            return
+        digest_text, markup = make_digest(tasks, done_since=clock.from_timestamp(chat.message['date']))
+        return await chat.edit_text(message_id, digest_text, markup=markup)
     message_part_who_done = ""
     if cb.src['from']['id'] != chat.id:
         message_part_who_done = f"\nby {cb.src['from']['username']}"
-    await bot.edit_message_text(
+    last_done_time = clock.to_local(task.last_done_time, timezone)
+    await chat.bot.edit_message_text(
         chat.id, chat.message['message_id'],
         text=task.content
-             + f"\n\nСделано ️✅\n{task.last_done_time:%d.%m.%Y %H:%M}"
+             + f"\n\nСделано ️✅\n{last_done_time:%d.%m.%Y %H:%M}"
              + message_part_who_done
     )
 
 
 @bot.callback(r'time/(\d+)')
 async def callback_set_new_perio(chat: aiotg.Chat, cb: aiotg.CallbackQuery, match: re.Match):
-    task: Task = await Task.get(int(match.group(1)))
-    db_chat: Chat = await Chat.get(str(chat.id))
-    if not task:
-        text = f"Странно, но такой задачи у меня нет (ИД={task.id})"
+    edit = await start_period_edit(int(match.group(1)), chat.bot.bot_id, str(chat.id))
+    if not edit:
+        text = f"Странно, но такой задачи у меня нет (ИД={match.group(1)})"
         return await cb.answer(text=text, show_alert=True)
 
-    await db_chat.update(
-        chat_state=ChatState.EXPECT_PERIOD,
-        editing_task_id=task.id
-    ).apply()
-    text = f"Теперь введите периодичность в днях (просто целое число!) для задачи \"{task.content}\""
+    _, content = edit
+    text = f"Теперь введите периодичность в днях (просто целое число!) для задачи \"{content}\""
     await asyncio.gather(chat.send_text(text), cb.answer(text=text, show_alert=False))
 
 
-@bot.callback(r'delete/(\d+)')
+@bot.callback(r'delete/(\d+)(?:/(\d+))?')
 async def callback_delete_task(chat: aiotg.Chat, cb: aiotg.CallbackQuery, match: re.Match):
-    task: Task = await Task.get(int(match.group(1)))
-    if not task:
-        text = f"Странно, но такой задачи у меня нет (ИД={task.id})"
+    task_id = int(match.group(1))
+    message_id = await delete_task(task_id, chat.bot.bot_id, str(chat.id))
+    if message_id is None:
+        text = f"Странно, но такой задачи у меня нет (ИД={task_id})"
         return await cb.answer(text=text, show_alert=True)
 
-    await task.delete()
+    discard_task(task_id)
+    invalidate_menu(chat.bot.bot_id, str(chat.id))
     text = f'Задача удалена'
-    markup = await make_menu_markup(chat)
+    markup = await make_menu_markup(chat.bot.bot_id, str(chat.id), from_id=int(match.group(2) or 0))
+    # imported tasks have no message to reply to
+    reply = {'reply_to_message_id': message_id} if message_id else {}
     await asyncio.gather(
         chat.edit_reply_markup(chat.message['message_id'], markup=markup),
         cb.answer(text=text, show_alert=True),
-        chat.send_text(text, reply_to_message_id=task.message_id)
+        chat.send_text(text, **reply)
     )
 
 
+@bot.prefetch
+async def prefetch_batch(bot_id: str, updates: list[dict]):
+    """
+    Chats of getUpdates batch, and tasks whose period they wait for, are loaded into caches by one query per table
+    instead of a query in each handler
+    """
+    chats = await prefetch_chats(bot_id, {str(update_key(update)) for update in updates})
+    task_ids = [db_chat.editing_task_id for db_chat in chats
+                if db_chat.chat_state == ChatState.EXPECT_PERIOD and db_chat.editing_task_id]
+    if task_ids:
+        await prefetch_tasks(task_ids)
+
+
 async def create_chat_in_db(chat: aiotg.Chat, chat_state=ChatState.EXPECT_TASK) -> Chat:
-    db_chat: Chat = await Chat.create(
-        chat_id=str(chat.id),
-        chat_name=get_chat_title(chat),
-        chat_state=chat_state,
-        notify_next_date_time=datetime.now() + timedelta(days=1)
-    )
+    notify_next_date_time = clock.to_local(clock.now(), clock.DEFAULT_TIMEZONE) + timedelta(days=1)
+    with DB_QUERY_SECONDS.time(query='chat_create'):
+        db_chat: Chat = await Chat.create(
+            bot_id=chat.bot.bot_id,
+            chat_id=str(chat.id),
+            chat_name=get_chat_title(chat),
+            chat_state=chat_state,
+            notify_next_date_time=notify_next_date_time,
+            fire_at=clock.to_utc(notify_next_date_time, clock.DEFAULT_TIMEZONE),
+            timezone=clock.DEFAULT_TIMEZONE
+        )
+    chat_cache.put((db_chat.bot_id, db_chat.chat_id), db_chat)
+    schedule_chat(db_chat)
     return db_chat
+
+
+for _token in BOT_TOKENS[1:]:
+    _tenant = bot.tenant(_token)
+    bots[_tenant.bot_id] = _tenant
+
+
+def get_bot(bot_id: str) -> TasksBot:
+    return bots[bot_id]
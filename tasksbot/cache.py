@@ -0,0 +1,162 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+from tasksbot.database import db, DB_QUERY_SECONDS, Statement
+from tasksbot.metrics import GaugeCallback
+from tasksbot.models import Chat, Task
+
+CHAT_CACHE_SIZE = int(os.environ.get('CHAT_CACHE_SIZE', 100000))
+CHAT_CACHE_TTL = float(os.environ.get('CHAT_CACHE_TTL', 600))
+MENU_CACHE_SIZE = int(os.environ.get('MENU_CACHE_SIZE', 10000))
+MENU_CACHE_TTL = float(os.environ.get('MENU_CACHE_TTL', 600))
+# tasks loaded ahead for handlers of getUpdates batch, each is taken once - TTL only cleans up not taken ones
+TASK_CACHE_SIZE = int(os.environ.get('TASK_CACHE_SIZE', 10000))
+TASK_CACHE_TTL = float(os.environ.get('TASK_CACHE_TTL', 10))
+
+
+class LRUCache:
+    """
+    Values loaded from DB are put by put_loaded() with `generation` read before the load: the value is dropped
+    if the key was put or popped meanwhile, so a slow load doesn't bring back a row which was invalidated
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        # counter of puts and pops, and the last one of each key (of not more than maxsize recently changed keys,
+        # changes of older ones are known to be not later than _forgotten)
+        self.generation = 0
+        self._changed = OrderedDict()
+        self._forgotten = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        # doesn't count as hit or miss
+        item = self._data.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def get(self, key: Hashable):
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            self.misses += 1
+            if item is not None:
+                del self._data[key]
+            return None
+        self.hits += 1
+        self._data.move_to_end(key)
+        return item[1]
+
+    def put(self, key: Hashable, value):
+        self._change(key)
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def put_loaded(self, key: Hashable, value, generation: int) -> bool:
+        """
+        Puts value loaded from DB if the key wasn't changed since `generation` (read before the load started)
+        """
+        if self._changed.get(key, self._forgotten) > generation:
+            return False
+        self.put(key, value)
+        return True
+
+    def pop(self, key: Hashable):
+        self._change(key)
+        item = self._data.pop(key, None)
+        return item[1] if item else None
+
+    def clear(self):
+        self._data.clear()
+        self._changed.clear()
+        self.generation += 1
+        self._forgotten = self.generation
+
+    def _change(self, key: Hashable):
+        self.generation += 1
+        self._changed[key] = self.generation
+        self._changed.move_to_end(key)
+        while len(self._changed) > self.maxsize:
+            _, self._forgotten = self._changed.popitem(last=False)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+CHAT_GET = Statement(
+    Chat.query.where((Chat.bot_id == db.bindparam('bot_id')) & (Chat.chat_id == db.bindparam('chat_id'))), Chat
+)
+CHATS_GET = Statement(
+    Chat.query.where((Chat.bot_id == db.bindparam('bot_id')) & (Chat.chat_id == db.func.any(db.bindparam('chat_ids')))),
+    Chat
+)
+TASKS_GET = Statement(Task.query.where(Task.id == db.func.any(db.bindparam('task_ids'))), Task)
+
+# both caches are keyed by (bot_id, chat_id)
+chat_cache = LRUCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL)
+# rendered /menu pages of chat: key -> {page key: markup}
+menu_cache = LRUCache(MENU_CACHE_SIZE, MENU_CACHE_TTL)
+# task id -> Task
+task_cache = LRUCache(TASK_CACHE_SIZE, TASK_CACHE_TTL)
+
+
+async def get_chat(bot_id: str, chat_id: str) -> Optional[Chat]:
+    db_chat = chat_cache.get((bot_id, chat_id))
+    if db_chat is None:
+        generation = chat_cache.generation
+        with DB_QUERY_SECONDS.time(query='chat_get'):
+            db_chat = await CHAT_GET.first(bot_id=bot_id, chat_id=chat_id)
+        if db_chat:
+            chat_cache.put_loaded((bot_id, chat_id), db_chat, generation)
+    return db_chat
+
+
+async def prefetch_chats(bot_id: str, chat_ids: set[str]) -> list[Chat]:
+    """
+    Loads chats which are not in cache yet by one query and puts them to cache, returns loaded chats
+    """
+    missing = [chat_id for chat_id in chat_ids if (bot_id, chat_id) not in chat_cache]
+    if not missing:
+        return []
+    generation = chat_cache.generation
+    with DB_QUERY_SECONDS.time(query='chats_prefetch'):
+        chats = await CHATS_GET.all(bot_id=bot_id, chat_ids=missing)
+    for db_chat in chats:
+        # a handler could have cached the chat (with newer state) or the reminder invalidated it while the query ran
+        chat_cache.put_loaded((bot_id, db_chat.chat_id), db_chat, generation)
+    return chats
+
+
+async def prefetch_tasks(task_ids: list[int]):
+    generation = task_cache.generation
+    with DB_QUERY_SECONDS.time(query='tasks_prefetch'):
+        tasks = await TASKS_GET.all(task_ids=task_ids)
+    for task in tasks:
+        task_cache.put_loaded(task.id, task, generation)
+
+
+async def update_chat(db_chat: Chat, **values) -> Chat:
+    with DB_QUERY_SECONDS.time(query='chat_update'):
+        await db_chat.update(**values).apply()
+    chat_cache.put((db_chat.bot_id, db_chat.chat_id), db_chat)
+    return db_chat
+
+
+for _cache_name, _cache in (('chat', chat_cache), ('menu', menu_cache), ('task', task_cache)):
+    GaugeCallback(f'tasksbot_{_cache_name}_cache', f'Size and counters of {_cache_name} cache',
+                  _cache.stats, ['stat'])
@@ -0,0 +1,92 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+# time zone of chats which didn't choose their own
+DEFAULT_TIMEZONE = os.environ.get('DEFAULT_TIMEZONE', 'UTC')
+
+
+class Clock:
+    """
+    Source of the current time for reminder engine and handlers - wall clock by default.
+    Time is UTC, naive - as all instants in DB. Local time of a chat is got by to_local().
+    """
+
+    def now(self) -> datetime:
+        return datetime.now(timezone.utc).replace(tzinfo=None)
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    """
+    Clock which time moves only when it is told to - by advance()/set() or by sleep(),
+    which jumps to the end of the sleep instantly.
+    """
+
+    def __init__(self, start: datetime):
+        self._now = start
+
+    def now(self) -> datetime:
+        return self._now
+
+    def set(self, when: datetime):
+        # time never goes back
+        if when > self._now:
+            self._now = when
+
+    def advance(self, delta: timedelta):
+        self.set(self._now + delta)
+
+    async def sleep(self, seconds: float):
+        self.advance(timedelta(seconds=max(seconds, 0)))
+        await asyncio.sleep(0)
+
+
+_clock = Clock()
+
+
+def get_clock() -> Clock:
+    return _clock
+
+
+def set_clock(clock: Clock) -> Clock:
+    """
+    Replaces the clock used by `now()` and `sleep()`, returns the previous one
+    """
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+def now() -> datetime:
+    return _clock.now()
+
+
+async def sleep(seconds: float):
+    await _clock.sleep(seconds)
+
+
+@lru_cache(maxsize=None)
+def get_zone(name: str) -> ZoneInfo:
+    """
+    Raises KeyError (ZoneInfoNotFoundError) or ValueError (malformed name) if there is no such time zone
+    """
+    return ZoneInfo(name)
+
+
+def to_utc(local: datetime, zone: str) -> datetime:
+    # local time which happens twice (DST ends) is the first of them, time which is skipped (DST starts)
+    # is moved forward by the DST shift
+    return local.replace(tzinfo=get_zone(zone)).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def to_local(utc: datetime, zone: str) -> datetime:
+    return utc.replace(tzinfo=timezone.utc).astimezone(get_zone(zone)).replace(tzinfo=None)
+
+
+def from_timestamp(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,240 @@
+"""
+History of done marks: append-only task_completion log, partitioned by month, and completion_stats rollups.
+
+Marks are buffered in memory and written by batches (every COMPLETIONS_FLUSH_INTERVAL or COMPLETIONS_BATCH_SIZE
+marks) - the mark handler doesn't wait for them. Rollups are updated in the same transaction as the log is written,
+so /stats reads one row per user of the chat, however long the history is.
+Marks buffered by a process which crashed are lost (not more than COMPLETIONS_FLUSH_INTERVAL of them).
+"""
+import asyncio
+import os
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from tasksbot import clock
+from tasksbot.async_logger import get_async_logger
+from tasksbot.database import db, DB_QUERY_SECONDS, Statement, read_bind
+from tasksbot.metrics import Counter, GaugeCallback, Histogram, SIZE_BUCKETS
+from tasksbot.models import Task, CompletionStats
+
+async_logger = get_async_logger(__name__)
+loop = asyncio.get_event_loop()
+
+COMPLETIONS_BATCH = Histogram('tasksbot_completions_batch_size', 'Done marks written by one flush',
+                              buckets=SIZE_BUCKETS)
+COMPLETIONS_DROPPED = Counter('tasksbot_completions_dropped_total', 'Done marks dropped from overflowed buffer')
+
+COMPLETIONS_FLUSH_INTERVAL = float(os.environ.get('COMPLETIONS_FLUSH_INTERVAL', 5))
+COMPLETIONS_BATCH_SIZE = int(os.environ.get('COMPLETIONS_BATCH_SIZE', 1000))
+# while DB is unavailable marks are kept in memory, the oldest are dropped above that
+COMPLETIONS_MAX_BUFFERED = int(os.environ.get('COMPLETIONS_MAX_BUFFERED', 100000))
+# monthly partitions are created that many months ahead,
+# and dropped when older than COMPLETIONS_RETENTION_MONTHS (0 - history is kept forever, rollups are kept anyway)
+COMPLETIONS_PARTITIONS_AHEAD = int(os.environ.get('COMPLETIONS_PARTITIONS_AHEAD', 2))
+COMPLETIONS_RETENTION_MONTHS = int(os.environ.get('COMPLETIONS_RETENTION_MONTHS', 0))
+PARTITIONS_CHECK_INTERVAL = timedelta(hours=12)
+STATS_TOP_USERS = int(os.environ.get('STATS_TOP_USERS', 10))
+
+LOG_COLUMNS = ('done_at', 'bot_id', 'chat_id', 'task_id', 'user_id')
+
+# (bot_id, chat_id, task_id, user_id, user_name, done_at, local day)
+_buffer: list[tuple] = []
+_wakeup: Optional[asyncio.Event] = None
+
+BUFFERED = GaugeCallback('tasksbot_completions_buffered', 'Done marks waiting to be written', lambda: len(_buffer))
+
+# Rows of one day: counter is added, and the streak goes on if the day is the next one after last_day.
+# Days older than last_day (marks buffered by other process for long) are counted, but don't change streaks
+UPDATE_STATS = db.text(
+    'INSERT INTO completion_stats AS s '
+    '(bot_id, chat_id, user_id, user_name, completions, first_day, last_day, streak, best_streak) '
+    'SELECT v.bot_id, v.chat_id, v.user_id, v.user_name, v.completions, :day, :day, 1, 1 '
+    'FROM unnest(CAST(:bot_ids AS varchar[]), CAST(:chat_ids AS varchar[]), CAST(:user_ids AS varchar[]), '
+    'CAST(:user_names AS varchar[]), CAST(:counts AS bigint[])) AS v(bot_id, chat_id, user_id, user_name, completions) '
+    'ON CONFLICT (bot_id, chat_id, user_id) DO UPDATE SET '
+    'completions = s.completions + excluded.completions, '
+    "user_name = CASE WHEN excluded.user_name = '' THEN s.user_name ELSE excluded.user_name END, "
+    'first_day = LEAST(s.first_day, excluded.first_day), '
+    'last_day = GREATEST(s.last_day, excluded.last_day), '
+    'streak = CASE WHEN excluded.last_day = s.last_day + 1 THEN s.streak + 1 '
+    '  WHEN excluded.last_day > s.last_day THEN 1 ELSE s.streak END, '
+    'best_streak = GREATEST(s.best_streak, CASE WHEN excluded.last_day = s.last_day + 1 THEN s.streak + 1 '
+    '  WHEN excluded.last_day > s.last_day THEN 1 ELSE s.streak END)'
+)
+# the chat row goes first: its counter is not less than counter of any user
+LOAD_STATS = Statement(
+    CompletionStats.query.where(
+        (CompletionStats.bot_id == db.bindparam('bot_id')) & (CompletionStats.chat_id == db.bindparam('chat_id'))
+    ).order_by(CompletionStats.completions.desc(), CompletionStats.user_id).limit(STATS_TOP_USERS + 1),
+    CompletionStats
+)
+
+
+def record_completion(task: Task, user_id: str, user_name: str, timezone: str):
+    """
+    Buffers done mark of the task (made at task.last_done_time), it is written by completions flusher
+    """
+    day = clock.to_local(task.last_done_time, timezone).date()
+    _buffer.append((task.bot_id, task.chat_id, task.id, user_id, user_name, task.last_done_time, day))
+    overflow = len(_buffer) - COMPLETIONS_MAX_BUFFERED
+    if overflow > 0:
+        del _buffer[:overflow]
+        COMPLETIONS_DROPPED.inc(overflow)
+    if len(_buffer) >= COMPLETIONS_BATCH_SIZE and _wakeup is not None:
+        _wakeup.set()
+
+
+def completions_loop():
+    return loop.create_task(run_completions(), name="completions")
+
+
+async def run_completions():
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    check_at = clock.now()
+    while True:
+        try:
+            if clock.now() >= check_at:
+                await maintain_partitions(clock.now())
+                check_at = clock.now() + PARTITIONS_CHECK_INTERVAL
+        except Exception:
+            async_logger.exception("Partitions maintenance failed")
+        try:
+            while await flush_completions() >= COMPLETIONS_BATCH_SIZE:
+                pass
+        except Exception:
+            async_logger.exception("Completions flush failed")
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), COMPLETIONS_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def drain_completions():
+    """
+    Writes everything buffered - on shutdown
+    """
+    while _buffer:
+        await flush_completions()
+
+
+async def flush_completions() -> int:
+    """
+    Writes one batch of buffered marks to the log and rollups. If it fails the batch is kept for the next flush.
+    Returns number of written marks
+    """
+    batch = _buffer[:COMPLETIONS_BATCH_SIZE]
+    if not batch:
+        return 0
+    del _buffer[:len(batch)]
+    try:
+        with DB_QUERY_SECONDS.time(query='completions_flush'):
+            await write_completions(batch)
+    except BaseException:
+        _buffer[:0] = batch
+        raise
+    COMPLETIONS_BATCH.observe(len(batch))
+    return len(batch)
+
+
+def stats_by_day(batch: list[tuple]) -> list[tuple[date, dict]]:
+    """
+    Counters of the batch by day: day -> {(bot_id, chat_id, user_id): [count, user_name]}, the chat itself
+    is counted with user_id ''. Days go in order - the streak grows by one day at a time
+    """
+    days = defaultdict(dict)
+    for bot_id, chat_id, _, user_id, user_name, _, day in batch:
+        for key, name in (((bot_id, chat_id, ''), ''), ((bot_id, chat_id, user_id), user_name)):
+            counter = days[day].setdefault(key, [0, name])
+            counter[0] += 1
+            counter[1] = name or counter[1]
+    return sorted(days.items())
+
+
+async def write_completions(batch: list[tuple]):
+    async with db.acquire(reuse=True) as conn:
+        async with conn.transaction():
+            await conn.raw_connection.copy_records_to_table('task_completion', columns=LOG_COLUMNS, records=[
+                (done_at, bot_id, chat_id, task_id, user_id)
+                for bot_id, chat_id, task_id, user_id, _, done_at, _ in batch
+            ])
+            # one statement a day - ON CONFLICT can't change the same row twice
+            for day, counters in stats_by_day(batch):
+                keys = list(counters)
+                await conn.status(
+                    UPDATE_STATS,
+                    day=day,
+                    bot_ids=[bot_id for bot_id, _, _ in keys],
+                    chat_ids=[chat_id for _, chat_id, _ in keys],
+                    user_ids=[user_id for _, _, user_id in keys],
+                    user_names=[counters[key][1] for key in keys],
+                    counts=[counters[key][0] for key in keys],
+                )
+
+
+def add_months(month: date, months: int) -> date:
+    years, month_index = divmod(month.month - 1 + months, 12)
+    return date(month.year + years, month_index + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f'task_completion_y{month:%Y}m{month:%m}'
+
+
+async def maintain_partitions(now: datetime):
+    """
+    Creates partitions of task_completion for this month and COMPLETIONS_PARTITIONS_AHEAD next ones,
+    drops partitions older than COMPLETIONS_RETENTION_MONTHS
+    """
+    this_month = now.date().replace(day=1)
+    with DB_QUERY_SECONDS.time(query='completions_partitions'):
+        for i in range(COMPLETIONS_PARTITIONS_AHEAD + 1):
+            month = add_months(this_month, i)
+            await db.status(db.text(
+                f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF task_completion "
+                f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"
+            ))
+        if not COMPLETIONS_RETENTION_MONTHS:
+            return
+        oldest = partition_name(add_months(this_month, -COMPLETIONS_RETENTION_MONTHS))
+        partitions = await db.all(db.text(
+            "SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = 'task_completion'::regclass"
+        ))
+        # names sort as months
+        for name, in partitions:
+            if name < oldest:
+                await db.status(db.text(f'DROP TABLE {name}'))
+                async_logger.info("Dropped completions partition %s", name)
+
+
+async def load_stats(bot_id: str, chat_id: str) -> list[CompletionStats]:
+    with DB_QUERY_SECONDS.time(query='completion_stats'):
+        return await LOAD_STATS.all(read_bind(), bot_id=bot_id, chat_id=chat_id)
+
+
+def current_streak(stats: CompletionStats, today: date) -> int:
+    # streak which ended before yesterday is over
+    return stats.streak if stats.last_day >= today - timedelta(days=1) else 0
+
+
+def make_stats_text(rows: list[CompletionStats], today: date) -> str:
+    """
+    Text of /stats: counters of the chat, and of its users if there are several of them
+    """
+    chat_stats = next((row for row in rows if row.user_id == ''), None)
+    if chat_stats is None:
+        return 'Пока ни одной задачи не сделано.'
+    lines = [
+        f'Сделано задач: {chat_stats.completions} (с {chat_stats.first_day:%d.%m.%Y})',
+        f'Дней подряд: {current_streak(chat_stats, today)}, рекорд: {chat_stats.best_streak}',
+    ]
+    users = [row for row in rows if row.user_id != ''][:STATS_TOP_USERS]
+    if len(users) > 1:
+        lines.append('\nКто сколько сделал:')
+        for row in users:
+            lines.append(f'▫️ {row.user_name or row.user_id} - {row.completions}, '
+                         f'дней подряд: {current_streak(row, today)}')
+    return '\n'.join(lines)
@@ -1,3 +1,170 @@
-from gino import Gino
+import os
+import socket
+import time
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from functools import partial
+from typing import Optional
+
+import asyncpg
+from gino import Gino, create_engine
+from gino.dialects.asyncpg import AsyncpgDialect, Pool
+from gino.engine import GinoEngine
+
+from tasksbot.metrics import Histogram, GaugeCallback
+from tasksbot.profiling import note
 
 db = Gino()
+
+
+class QueryHistogram(Histogram):
+    """
+    Durations of queries also go to the trace of the call which runs them (see profiling.trace)
+    """
+
+    def observe(self, value: float, **labels):
+        super().observe(value, **labels)
+        note('db', labels['query'], value)
+
+
+DB_QUERY_SECONDS = QueryHistogram('tasksbot_db_query_seconds', 'Duration of hot DB queries', ['query'])
+DB_POOL_WAIT_SECONDS = Histogram('tasksbot_db_pool_wait_seconds', 'Time waited for connection from pool', ['pool'])
+
+# several workers (processes) can work with the same DB - each claims rows it processes (due reminders,
+# outbox messages) for LEASE_TIME. Rows claimed by crashed worker are claimed by others after lease expires.
+WORKER_ID = os.environ.get('REMINDER_WORKER_ID') or f'{socket.gethostname()}:{os.getpid()}'
+LEASE_TIME = timedelta(seconds=int(os.environ.get('REMINDER_LEASE_SECONDS', 300)))
+
+# connection pool (the same settings for primary and replica), defaults are asyncpg's
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 10))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+# prepared statements kept by each connection
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 100))
+# connection is closed (and opened again when needed) after that many queries or that long idle,
+# asyncpg has no limit of connection age as such
+DB_CONNECTION_MAX_QUERIES = int(os.environ.get('DB_CONNECTION_MAX_QUERIES', 50000))
+DB_CONNECTION_MAX_IDLE = float(os.environ.get('DB_CONNECTION_MAX_IDLE', 300))
+
+# read-only queries which tolerate replication lag (menu pages, reminder schedule) go to replica if it's set
+replica: Optional[GinoEngine] = None
+
+_pools = {}
+
+
+class MeteredPool(Pool):
+    """
+    Pool which reports time waited for connection and its utilisation (see POOL_* gauges)
+    """
+
+    def __init__(self, url, loop, name='primary', **kwargs):
+        super().__init__(url, loop, **kwargs)
+        self.name = name
+
+    async def _init(self):
+        await super()._init()
+        _pools[self.name] = self.raw_pool
+        return self
+
+    async def acquire(self, *, timeout=None):
+        start = time.perf_counter()
+        try:
+            return await super().acquire(timeout=timeout)
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start, pool=self.name)
+
+    async def close(self):
+        _pools.pop(self.name, None)
+        await super().close()
+
+
+POOL_SIZE = GaugeCallback('tasksbot_db_pool_size', 'Open connections of pool',
+                          lambda: {name: pool.get_size() for name, pool in _pools.items()}, ['pool'])
+POOL_IN_USE = GaugeCallback('tasksbot_db_pool_in_use', 'Connections of pool in use',
+                            lambda: {name: pool.get_size() - pool.get_idle_size() for name, pool in _pools.items()},
+                            ['pool'])
+POOL_MAX_SIZE = GaugeCallback('tasksbot_db_pool_max_size', 'Max size of pool',
+                              lambda: {name: pool.get_max_size() for name, pool in _pools.items()}, ['pool'])
+
+
+def pool_options(name: str) -> dict:
+    return dict(
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        max_queries=DB_CONNECTION_MAX_QUERIES,
+        max_inactive_connection_lifetime=DB_CONNECTION_MAX_IDLE,
+        pool_class=partial(MeteredPool, name=name),
+    )
+
+
+@asynccontextmanager
+async def connect(url: str, replica_url: str = None):
+    """
+    Binds db to url (and read_bind() to replica_url) for the time of the context
+    """
+    global replica
+    async with db.with_bind(url, **pool_options('primary')):
+        if not replica_url:
+            yield
+            return
+        replica = await create_engine(replica_url, **pool_options('replica'))
+        try:
+            yield
+        finally:
+            engine, replica = replica, None
+            await engine.close()
+
+
+def read_bind():
+    return replica or db
+
+
+class Row(asyncpg.Record):
+    """
+    Row of Statement result, columns are accessible as attributes - as in rows of gino queries
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class Statement:
+    """
+    Hot query compiled to SQL once. It is executed right by asyncpg connection: SQL is not compiled
+    on every call, and asyncpg statement cache keeps it prepared (parsed, and planned by Postgres)
+    for the lifetime of the connection.
+    Parameters are given by name (db.bindparam() in query, :name in db.text()), literal values of query
+    are bound as compiled. Rows are loaded into `model` instances if it's given, otherwise they are Row
+    """
+    _dialect = AsyncpgDialect(dbapi=AsyncpgDialect.dbapi())
+
+    def __init__(self, query, model=None):
+        compiled = query.compile(dialect=self._dialect)
+        self.sql = str(compiled)
+        self.params = compiled.positiontup
+        self.defaults = compiled.params
+        self.model = model
+
+    def _args(self, params: dict) -> list:
+        params = {**self.defaults, **params}
+        return [params[name] for name in self.params]
+
+    def _load(self, row: Row):
+        instance = self.model()
+        instance.__values__.update(
+            (self.model._column_name_map.invert_get(key), value) for key, value in row.items()
+        )
+        return instance
+
+    async def all(self, bind=None, **params) -> list:
+        async with (bind or db).acquire(reuse=True) as conn:
+            rows = await conn.raw_connection.fetch(self.sql, *self._args(params), record_class=Row)
+        return [self._load(row) for row in rows] if self.model else rows
+
+    async def first(self, bind=None, **params):
+        async with (bind or db).acquire(reuse=True) as conn:
+            row = await conn.raw_connection.fetchrow(self.sql, *self._args(params), record_class=Row)
+        return self._load(row) if self.model and row is not None else row
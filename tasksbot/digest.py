@@ -0,0 +1,62 @@
+from datetime import datetime
+from typing import Optional
+
+from tasksbot.database import DB_QUERY_SECONDS
+from tasksbot.models import Task
+
+DIGEST_TITLE = 'Напоминания:'
+# Telegram limits: text of message and (reasonable) number of inline buttons
+MESSAGE_MAX_LENGTH = 4096
+DIGEST_MAX_TASKS = 20
+BUTTON_TEXT_LENGTH = 32
+
+
+def shorten(text: str, length: int = BUTTON_TEXT_LENGTH) -> str:
+    return text if len(text) <= length else text[:length - 1] + '…'
+
+
+def is_done(task: Task, done_since: Optional[datetime]) -> bool:
+    return done_since is not None and task.last_done_time is not None and task.last_done_time >= done_since
+
+
+def make_digest(tasks: list[Task], done_since: Optional[datetime] = None) -> tuple[str, dict]:
+    """
+    Text and inline keyboard of digest message: all tasks with their done status,
+    and "done" button for each task which is not done since `done_since` (time when digest was sent)
+    """
+    lines = [DIGEST_TITLE]
+    keyboard = []
+    for task in tasks:
+        done = is_done(task, done_since)
+        lines.append(f"{'✅' if done else '▫️'} {task.content}")
+        if not done:
+            keyboard.append([{
+                'text': f'✅ {shorten(task.content)}',
+                'callback_data': f'mark/{task.id}/digest'
+            }])
+    return '\n'.join(lines), {'inline_keyboard': keyboard}
+
+
+def digest_chunks(tasks: list[Task]):
+    """
+    Splits tasks of a chat into digests which fit into one message
+    """
+    chunk = []
+    length = len(DIGEST_TITLE)
+    for task in tasks:
+        line_length = len(task.content) + 3
+        if chunk and (len(chunk) >= DIGEST_MAX_TASKS or length + line_length > MESSAGE_MAX_LENGTH):
+            yield chunk
+            chunk = []
+            length = len(DIGEST_TITLE)
+        chunk.append(task)
+        length += line_length
+    if chunk:
+        yield chunk
+
+
+async def load_digest_tasks(bot_id: str, chat_id: str, message_id: str) -> list[Task]:
+    with DB_QUERY_SECONDS.time(query='digest_tasks'):
+        return await Task.query.where(
+            (Task.bot_id == bot_id) & (Task.chat_id == chat_id) & (Task.last_notify_id == message_id)
+        ).order_by(Task.id).gino.all()
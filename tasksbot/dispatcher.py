@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 100))
+
+
+def update_key(update: dict) -> Hashable:
+    """
+    Chat of the update - updates of the same chat have to be processed in order
+    """
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        message = value.get('message', value)
+        if 'chat' in message:
+            return message['chat']['id']
+        if 'from' in value:
+            return value['from']['id']
+    return update.get('update_id')
+
+
+class KeyedDispatcher:
+    """
+    Jobs with the same key run one by one in order of submitting,
+    jobs with different keys run in parallel, not more than `workers` at the same time.
+    """
+
+    def __init__(self, workers: int = UPDATE_WORKERS):
+        self.workers = workers
+        self._semaphore = None
+        self._queues = {}
+        self.running = 0
+        self.processed = 0
+        self.waits = deque(maxlen=1000)
+
+    def submit(self, key: Hashable, job: Callable[[], Awaitable]):
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            asyncio.ensure_future(self._drain(key, queue))
+        queue.append((job, time.monotonic()))
+
+    async def _drain(self, key: Hashable, queue: deque):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        try:
+            while queue:
+                job, enqueued = queue.popleft()
+                async with self._semaphore:
+                    self.waits.append(time.monotonic() - enqueued)
+                    self.running += 1
+                    try:
+                        await job()
+                    except Exception:
+                        logger.exception("Error in job of %s", key)
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+        finally:
+            del self._queues[key]
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {
+            'keys': len(self._queues),
+            'queued': sum(len(queue) for queue in self._queues.values()),
+            'running': self.running,
+            'processed': self.processed,
+            'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+            'wait_p99': waits[int(len(waits) * 0.99)] if waits else 0.0,
+        }
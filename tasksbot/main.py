@@ -1,38 +1,67 @@
+import argparse
 import asyncio
 import logging
 import os
 
-import aiohttp
 from aiotg import run_with_reloader
 
-from tasksbot.bot import bot
-from tasksbot.database import db
+from tasksbot.bot import bot, bots
+from tasksbot.completions import completions_loop, drain_completions
+from tasksbot.database import connect
+from tasksbot.metrics import start_metrics_server
+from tasksbot.outbox import outbox_loop
+from tasksbot.profiling import install_signal_handlers
 from tasksbot.reminder import reminder_loop
+from tasksbot.webhook import run_webhook, webhook_secret
 
 logger = logging.getLogger(__name__)
 
 DB_URL = os.environ.get('DB_URL', 'postgresql://localhost/tgbot')
-AIOHTTP_23 = aiohttp.__version__ > "2.3"
+DB_REPLICA_URL = os.environ.get('DB_REPLICA_URL')
 
 
-async def bot_loop():
-    async with db.with_bind(DB_URL):
+async def bot_loop(secret: str = ''):
+    """
+    Receives updates by webhook with `secret` token if it is given, by long polling otherwise
+    """
+    async with connect(DB_URL, DB_REPLICA_URL):
+        await start_metrics_server()
         reminder_loop()
-        return await bot.loop()
+        outbox_loop()
+        completions_loop()
+        try:
+            if secret:
+                return await run_webhook(list(bots.values()), secret)
+            return await asyncio.gather(*[tenant.loop() for tenant in bots.values()])
+        finally:
+            await drain_completions()
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--webhook', action='store_true',
+                        help='receive updates by webhook instead of long polling')
+    args = parser.parse_args()
+    secret = ''
+    if args.webhook:
+        try:
+            secret = webhook_secret()
+        except ValueError as e:
+            parser.error(str(e))
+
     from aiomisc.log import basic_config
     debug = True
     basic_config(logging.DEBUG, buffered=True)
 
     loop = asyncio.get_event_loop()
+    # SIGUSR1 - start/stop profiling, SIGUSR2 - dump slow calls (see tasksbot.profiling)
+    install_signal_handlers(loop)
 
     # logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
 
     reload = False
     while True:
-        bot_loop_task = asyncio.ensure_future(bot_loop())
+        bot_loop_task = asyncio.ensure_future(bot_loop(secret))
 
         try:
             if reload:
@@ -45,13 +74,15 @@ def main():
         except KeyboardInterrupt:
             logger.debug("User cancelled")
             bot_loop_task.cancel()
-            bot.stop()
+            for tenant in bots.values():
+                tenant.stop()
             break
 
         # Stop loop
         finally:
-            if AIOHTTP_23:
-                loop.run_until_complete(bot.session.close())
+            for tenant in bots.values():
+                tenant.sender.stop()
+                loop.run_until_complete(tenant.close())
 
     logger.debug("Closing loop")
     loop.stop()
@@ -1,2 +1,4 @@
 from .task import Task
-from .chat import Chat
\ No newline at end of file
+from .chat import Chat
+from .outbox import Outbox
+from .completion import TaskCompletion, CompletionStats
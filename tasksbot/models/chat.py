@@ -1,14 +1,25 @@
+from tasksbot import clock
 from tasksbot.database import db
 
 
 class Chat(db.Model):
     __tablename__ = 'chat'
 
+    # chats of different bots are different chats, even if it's the same Telegram chat
+    bot_id = db.Column(db.String(32), primary_key=True)
     chat_id = db.Column(db.String(255), primary_key=True)
     chat_name = db.Column(db.String(255), default='')
     chat_state = db.Column(db.Integer, default=0)
     editing_task_id = db.Column(db.ForeignKey("task.id"), index=True, nullable=True)
-    notify_next_date_time = db.Column(db.DateTime(), index=True)
+    # local time of the next notification, and the same instant in UTC (see scheduler)
+    notify_next_date_time = db.Column(db.DateTime())
+    fire_at = db.Column(db.DateTime(), index=True)
+    timezone = db.Column(db.String(64), default=clock.DEFAULT_TIMEZONE, server_default=clock.DEFAULT_TIMEZONE)
+    # send due tasks in one message instead of message per task
+    digest = db.Column(db.Boolean, default=False, server_default='false')
+    # reminder worker which processes the chat now, and until when
+    lease_owner = db.Column(db.String(255), nullable=True)
+    lease_until = db.Column(db.DateTime(), nullable=True)
 
     def __str__(self):
         return self.chat_name
@@ -0,0 +1,41 @@
+from tasksbot.database import db
+
+
+class TaskCompletion(db.Model):
+    """
+    Append-only log of done marks, partitioned by month of done_at (see completions.maintain_partitions)
+    """
+    __tablename__ = 'task_completion'
+
+    # primary key of partitioned table has to include the partition key
+    id = db.Column(db.BigInteger(), primary_key=True, autoincrement=True)
+    done_at = db.Column(db.DateTime(), primary_key=True)
+    bot_id = db.Column(db.String(32), nullable=False)
+    chat_id = db.Column(db.String(255), nullable=False)
+    # not a foreign key - history outlives deleted tasks
+    task_id = db.Column(db.Integer(), nullable=False)
+    user_id = db.Column(db.String(128), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_task_completion_bot_id_chat_id_done_at', 'bot_id', 'chat_id', 'done_at'),
+        {'postgresql_partition_by': 'RANGE (done_at)'},
+    )
+
+
+class CompletionStats(db.Model):
+    """
+    Rollup of task_completion: counters of the chat (user_id = '') and of each user in the chat.
+    Days are local days of the chat
+    """
+    __tablename__ = 'completion_stats'
+
+    bot_id = db.Column(db.String(32), primary_key=True)
+    chat_id = db.Column(db.String(255), primary_key=True)
+    user_id = db.Column(db.String(128), primary_key=True)
+    user_name = db.Column(db.String(255), default='', server_default='')
+    completions = db.Column(db.BigInteger(), default=0, server_default='0')
+    first_day = db.Column(db.Date())
+    last_day = db.Column(db.Date())
+    # days in a row with done marks, the last of them is last_day
+    streak = db.Column(db.Integer(), default=0, server_default='0')
+    best_streak = db.Column(db.Integer(), default=0, server_default='0')
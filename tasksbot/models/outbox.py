@@ -0,0 +1,33 @@
+from tasksbot import clock
+from tasksbot.database import db
+
+
+class Outbox(db.Model):
+    """
+    Notification queued to be sent to Telegram
+    """
+    __tablename__ = 'outbox'
+
+    id = db.Column(db.BigInteger(), primary_key=True)
+    # the same reminder is never queued twice
+    idempotency_key = db.Column(db.String(255), nullable=False, unique=True)
+    # bot which sends the message
+    bot_id = db.Column(db.String(32), nullable=False)
+    chat_id = db.Column(db.String(255), nullable=False)
+    text = db.Column(db.Text(), nullable=False)
+    reply_markup = db.Column(db.Text(), nullable=False)
+    # tasks notified by the message (several for digest), their last_notify_id is set after sending
+    task_ids = db.Column(db.ARRAY(db.Integer), nullable=False)
+    due_time = db.Column(db.DateTime(), nullable=False)
+    created_at = db.Column(db.DateTime(), default=clock.now)
+    attempts = db.Column(db.Integer, default=0, server_default='0')
+    message_id = db.Column(db.String(128), nullable=True)
+    sent_at = db.Column(db.DateTime(), nullable=True)
+    # flusher which sends the message now, and until when
+    lease_owner = db.Column(db.String(255), nullable=True)
+    lease_until = db.Column(db.DateTime(), nullable=True)
+
+    __table_args__ = (
+        # messages to be sent
+        db.Index('ix_outbox_pending', 'id', postgresql_where=db.text('sent_at IS NULL')),
+    )
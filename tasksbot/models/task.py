@@ -1,25 +1,39 @@
-from datetime import datetime, timedelta
-
+from tasksbot import clock
 from tasksbot.database import db
 
 
-def now_plus_day():
-    return datetime.now() + timedelta(days=1)
-
-
 class Task(db.Model):
     __tablename__ = 'task'
 
     id = db.Column(db.Integer(), primary_key=True)
-    chat_id = db.Column(db.ForeignKey("chat.chat_id"), index=True)
+    bot_id = db.Column(db.String(32), nullable=False)
+    chat_id = db.Column(db.String(255))
     content = db.Column(db.String(1024), default='')
     message_id = db.Column(db.String(128), default='', index=True)
     last_notify_id = db.Column(db.String(128), default='', index=True)
     period_days = db.Column(db.Integer, default=1)
-    last_done_time = db.Column(db.DateTime(), default=datetime.now)
-    notify_time = db.Column(db.DateTime(), default=now_plus_day)
+    last_done_time = db.Column(db.DateTime(), default=clock.now)
+    # local time of the next notification (in time zone of the chat), and UTC instant since which
+    # the task is due (see scheduler.task_fire_at)
+    notify_time = db.Column(db.DateTime())
+    fire_at = db.Column(db.DateTime())
     exact_in_time = db.Column(db.Boolean, default=False, server_default='false')
     done_mark_user_id = db.Column(db.String(128), default='', index=True)
+    # reminder worker which processes the task now, and until when
+    lease_owner = db.Column(db.String(255), nullable=True)
+    lease_until = db.Column(db.DateTime(), nullable=True)
+
+    __table_args__ = (
+        db.ForeignKeyConstraint(['bot_id', 'chat_id'], ['chat.bot_id', 'chat.chat_id']),
+        db.Index('ix_task_bot_id_chat_id', 'bot_id', 'chat_id'),
+        # due exact tasks
+        db.Index('ix_task_exact_in_time_fire_at', 'exact_in_time', 'fire_at'),
+        # due not exact tasks of chat
+        db.Index('ix_task_bot_id_chat_id_fire_at', 'bot_id', 'chat_id', 'fire_at',
+                 postgresql_where=db.text('NOT exact_in_time')),
+        # tasks claimed by reminder workers, see reminder.ReminderStore.iterate_claimed_tasks
+        db.Index('ix_task_lease_until', 'lease_until', postgresql_where=db.text('lease_until IS NOT NULL')),
+    )
 
     def __str__(self):
         return self.content
@@ -0,0 +1,249 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from aiotg import BotApiError
+from sqlalchemy.dialects.postgresql import insert
+
+from tasksbot import clock
+from tasksbot.async_logger import get_async_logger
+from tasksbot.bot import bot, bots, get_bot
+from tasksbot.database import db, DB_QUERY_SECONDS, WORKER_ID, LEASE_TIME
+from tasksbot.metrics import Histogram, LAG_BUCKETS, SIZE_BUCKETS
+from tasksbot.models import Outbox
+from tasksbot.sender import RetryAfter
+
+async_logger = get_async_logger(__name__)
+loop = asyncio.get_event_loop()
+
+REMINDER_LAG_SECONDS = Histogram('tasksbot_reminder_lag_seconds', 'Time between notification is due and sent',
+                                 buckets=LAG_BUCKETS)
+OUTBOX_BATCH = Histogram('tasksbot_outbox_batch_size', 'Messages sent by one outbox flush', buckets=SIZE_BUCKETS)
+
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 100))
+# concurrent flushes - next batch is sent while previous one waits for its slowest message
+OUTBOX_FLUSHERS = int(os.environ.get('OUTBOX_FLUSHERS', 4))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 5))
+# message which failed is sent again that long after, doubled on each attempt (30 sec, 1 min, 2 min...)
+OUTBOX_RETRY_DELAY = timedelta(seconds=float(os.environ.get('OUTBOX_RETRY_DELAY', 30)))
+# flusher checks outbox at least that often, and right away when reminder of this process queued something
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', 5))
+# sent (and given up) messages are kept that long - duplicates are not queued within this time
+OUTBOX_RETENTION = timedelta(hours=int(os.environ.get('OUTBOX_RETENTION_HOURS', 48)))
+CLEANUP_INTERVAL = timedelta(hours=1)
+# leases of messages still waiting to be sent are extended that often
+LEASE_RENEW_INTERVAL = LEASE_TIME / 3
+
+_wakeup: Optional[asyncio.Event] = None
+
+
+def idempotency_key(task_ids: list[int], due_time: datetime) -> str:
+    return f"{'-'.join(map(str, task_ids))}@{due_time:%Y%m%d%H%M%S}"
+
+
+def outbox_message(bot_id: str, chat_id: str, text: str, reply_markup: dict, task_ids: list[int], due_time: datetime,
+                   occurrence: datetime) -> dict:
+    """
+    Values of outbox row. `occurrence` is notify_time of the task the message is sent for.
+    The bot can be hosted by other process - the message is sent by the process which hosts it
+    """
+    return dict(
+        idempotency_key=idempotency_key(task_ids, occurrence),
+        bot_id=bot_id,
+        chat_id=chat_id,
+        text=text,
+        reply_markup=bot.json_serialize(reply_markup),
+        task_ids=task_ids,
+        due_time=due_time,
+        created_at=clock.now(),
+    )
+
+
+async def enqueue(messages: list[dict]):
+    """
+    Must be called in the same transaction which advances notify_time of the tasks
+    """
+    if not messages:
+        return
+    await db.status(
+        insert(Outbox.__table__).values(messages).on_conflict_do_nothing(index_elements=['idempotency_key'])
+    )
+
+
+def wakeup_flusher():
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+def outbox_loop():
+    return [
+        loop.create_task(run_outbox(cleanup_enabled=i == 0), name=f"outbox-{i}")
+        for i in range(OUTBOX_FLUSHERS)
+    ]
+
+
+async def run_outbox(cleanup_enabled=True):
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    cleanup_at = clock.now()
+    while True:
+        flushed = 0
+        try:
+            if cleanup_enabled and clock.now() >= cleanup_at:
+                await cleanup()
+                cleanup_at = clock.now() + CLEANUP_INTERVAL
+            flushed = await flush_outbox()
+        except Exception:
+            async_logger.exception("Outbox flush failed")
+        if flushed < OUTBOX_BATCH_SIZE:
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def flush_outbox() -> int:
+    """
+    Sends one batch of queued messages (at the rate allowed by sender of each bot) and writes back their message_id.
+    Messages are marked as sent as soon as they are sent, while the rest of the batch is still waiting for rate
+    limits, and their leases are extended meanwhile (a slow batch for a group can take longer than LEASE_TIME).
+    Message is sent at least once: if worker dies between sending and writing back,
+    the message is sent again by other worker after lease expires.
+    Only messages of bots hosted by this process are claimed.
+    Returns number of claimed messages
+    """
+    messages = await claim_messages(clock.now())
+    if not messages:
+        return 0
+    OUTBOX_BATCH.observe(len(messages))
+    pending = {asyncio.ensure_future(send(message)): message for message in messages}
+    renew_at = clock.now() + LEASE_RENEW_INTERVAL
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=max((renew_at - clock.now()).total_seconds(), 0),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            sent = []
+            failed = []
+            for future in done:
+                message = pending.pop(future)
+                error = asyncio.CancelledError() if future.cancelled() else future.exception()
+                if error is not None:
+                    async_logger.error("Outbox message %d (attempt %d): send failed: %r",
+                                       message.id, message.attempts, error)
+                    failed.append((message, error))
+                else:
+                    sent.append((message, future.result()))
+            if sent or failed:
+                with DB_QUERY_SECONDS.time(query='outbox_mark_sent'):
+                    async with db.transaction():
+                        await mark_sent(sent)
+                        await release(failed)
+            if pending and clock.now() >= renew_at:
+                renew_at = clock.now() + LEASE_RENEW_INTERVAL
+                with DB_QUERY_SECONDS.time(query='outbox_renew_lease'):
+                    await renew_lease([message.id for message in pending.values()], clock.now() + LEASE_TIME)
+    finally:
+        # not sent messages are sent again after their lease expires
+        for future in pending:
+            future.cancel()
+    return len(messages)
+
+
+async def claim_messages(now: datetime) -> list[Outbox]:
+    pending = db.select([Outbox.id]).where(
+        (Outbox.sent_at == None) &
+        Outbox.bot_id.in_(list(bots)) &
+        (Outbox.attempts < OUTBOX_MAX_ATTEMPTS) &
+        ((Outbox.lease_until == None) | (Outbox.lease_until < now))
+    ).order_by(Outbox.id).limit(OUTBOX_BATCH_SIZE).with_for_update(skip_locked=True)
+    with DB_QUERY_SECONDS.time(query='outbox_claim'):
+        return await Outbox.update.values(
+            lease_owner=WORKER_ID,
+            lease_until=now + LEASE_TIME,
+            attempts=Outbox.attempts + 1
+        ).where(Outbox.id.in_(pending)).returning(*Outbox).gino.all()
+
+
+async def send(message: Outbox) -> str:
+    bot = get_bot(message.bot_id)
+    result = await bot.send_message(message.chat_id, message.text, reply_markup=message.reply_markup)
+    REMINDER_LAG_SECONDS.observe((clock.now() - message.due_time).total_seconds())
+    return str(result['result']['message_id'])
+
+
+async def mark_sent(sent: list[tuple[Outbox, str]]):
+    if not sent:
+        return
+    await db.status(db.text(
+        'UPDATE outbox SET message_id = v.message_id, sent_at = :now, lease_until = NULL '
+        'FROM unnest(CAST(:ids AS bigint[]), CAST(:message_ids AS varchar[])) AS v(id, message_id) '
+        'WHERE outbox.id = v.id'
+    ), now=clock.now(), ids=[message.id for message, _ in sent], message_ids=[message_id for _, message_id in sent])
+    task_ids = [task_id for message, _ in sent for task_id in message.task_ids]
+    message_ids = [message_id for message, message_id in sent for _ in message.task_ids]
+    await db.status(db.text(
+        'UPDATE task SET last_notify_id = v.message_id '
+        'FROM unnest(CAST(:task_ids AS integer[]), CAST(:message_ids AS varchar[])) AS v(id, message_id) '
+        'WHERE task.id = v.id'
+    ), task_ids=task_ids, message_ids=message_ids)
+
+
+async def renew_lease(message_ids: list[int], lease_until: datetime):
+    await Outbox.update.values(lease_until=lease_until).where(
+        Outbox.id.in_(message_ids) & (Outbox.lease_owner == WORKER_ID)
+    ).gino.status()
+
+
+def retry_at(message: Outbox, error: Exception, now: datetime) -> Optional[datetime]:
+    """
+    When the failed message is sent again. None - never: Telegram refused it (bot is blocked, chat not found...),
+    and the same request gets the same answer
+    """
+    if isinstance(error, BotApiError):
+        return None
+    delay = OUTBOX_RETRY_DELAY * 2 ** (message.attempts - 1)
+    if isinstance(error, RetryAfter):
+        delay = max(delay, timedelta(seconds=error.retry_after))
+    return now + delay
+
+
+async def release(failed: list[tuple[Outbox, Exception]]):
+    """
+    Leases of failed messages are kept until their retry - the message is not claimed again right away.
+    Messages which are not retried are given up as if all attempts were spent
+    """
+    if not failed:
+        return
+    now = clock.now()
+    retried = []
+    given_up = []
+    for message, error in failed:
+        when = retry_at(message, error, now)
+        if when is None:
+            given_up.append(message.id)
+        else:
+            retried.append((message.id, when))
+    if retried:
+        ids, lease_untils = zip(*retried)
+        await db.status(db.text(
+            'UPDATE outbox SET lease_until = v.lease_until '
+            'FROM unnest(CAST(:ids AS bigint[]), CAST(:lease_untils AS timestamp[])) AS v(id, lease_until) '
+            'WHERE outbox.id = v.id'
+        ), ids=list(ids), lease_untils=list(lease_untils))
+    if given_up:
+        await Outbox.update.values(lease_until=None, attempts=OUTBOX_MAX_ATTEMPTS).where(
+            Outbox.id.in_(given_up)
+        ).gino.status()
+
+
+async def cleanup():
+    before = clock.now() - OUTBOX_RETENTION
+    with DB_QUERY_SECONDS.time(query='outbox_cleanup'):
+        status = await Outbox.delete.where(
+            (Outbox.created_at < before) &
+            ((Outbox.sent_at != None) | (Outbox.attempts >= OUTBOX_MAX_ATTEMPTS))
+        ).gino.status()
+    async_logger.debug("Outbox cleanup: %s", status[0])
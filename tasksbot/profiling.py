@@ -0,0 +1,240 @@
+"""
+Profiling of the running bot.
+
+On demand: SIGUSR1 (or /profile of admin) starts profiling session - cProfile of the event loop thread and
+tracemalloc, the next SIGUSR1 (/profile) stops it and writes reports to PROFILE_DIR:
+profile-<time>.pstats (for pstats, snakeviz), profile-<time>.txt (top functions by cumulative time)
+and memory-<time>.txt (allocations which grew during the session).
+
+Always: handler calls and remind_all rounds (see trace) slower than their threshold are kept in ring buffer
+of SLOW_CALLS_SIZE calls - with the stack the call was waiting at when it crossed the threshold, its DB queries
+and time spent in DB, in Telegram API calls and the rest. SIGUSR2 (/profile slow) writes the buffer to
+PROFILE_DIR/slow-<time>.json. The stack is taken on the event loop, so a call which blocks the loop is seen
+where it continued - such calls are found by the profiling session.
+"""
+import asyncio
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import signal
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+from typing import Optional
+
+from tasksbot import clock
+from tasksbot.metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+SLOW_CALLS = Counter('tasksbot_slow_calls_total', 'Calls slower than their threshold', ['route'])
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+# thresholds of slow calls, 0 - calls are not traced
+SLOW_HANDLER_SECONDS = float(os.environ.get('SLOW_HANDLER_SECONDS', 0.5))
+SLOW_REMIND_SECONDS = float(os.environ.get('SLOW_REMIND_SECONDS', 5))
+SLOW_CALLS_SIZE = int(os.environ.get('SLOW_CALLS_SIZE', 100))
+# DB queries and API calls listed for one call, the rest are only summed up
+TRACE_MAX_EVENTS = 100
+TRACEMALLOC_FRAMES = int(os.environ.get('TRACEMALLOC_FRAMES', 10))
+REPORT_TOP = 50
+
+
+class Trace:
+    """
+    Timing of one handler call (or remind_all round)
+    """
+    __slots__ = ('route', 'started_at', 'start', 'seconds', 'stack', 'events', 'db_seconds', 'db_queries',
+                 'api_seconds', 'api_calls')
+
+    def __init__(self, route: str):
+        self.route = route
+        self.started_at = None
+        self.start = time.perf_counter()
+        self.seconds = 0.0
+        self.stack = []
+        # DB queries and API calls: (kind, name, started after, seconds)
+        self.events = []
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.api_seconds = 0.0
+        self.api_calls = 0
+
+    def add(self, kind: str, name: str, seconds: float):
+        if kind == 'db':
+            self.db_seconds += seconds
+            self.db_queries += 1
+        else:
+            self.api_seconds += seconds
+            self.api_calls += 1
+        if len(self.events) < TRACE_MAX_EVENTS:
+            self.events.append((kind, name, round(time.perf_counter() - self.start - seconds, 4), round(seconds, 4)))
+
+    def as_dict(self) -> dict:
+        return {
+            'route': self.route,
+            'started_at': self.started_at.isoformat(),
+            'seconds': round(self.seconds, 4),
+            # concurrent queries and API calls (asyncio.gather) can sum up to more than the call itself
+            'breakdown': {
+                'db': round(self.db_seconds, 4),
+                'api': round(self.api_seconds, 4),
+                'other': round(max(self.seconds - self.db_seconds - self.api_seconds, 0), 4),
+            },
+            'db_queries': self.db_queries,
+            'api_calls': self.api_calls,
+            'events': self.events,
+            'stack': self.stack,
+        }
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar('trace', default=None)
+slow_calls: deque[Trace] = deque(maxlen=SLOW_CALLS_SIZE)
+
+
+def awaiting_stack(task: asyncio.Task) -> list[str]:
+    """
+    Chain of coroutines the task is waiting in, outermost first (Task.get_stack shows only the outermost one)
+    """
+    lines = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            lines.append(repr(coro)[:200])
+            break
+        lines.append(f'{frame.f_code.co_filename}:{frame.f_lineno} {frame.f_code.co_name}')
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return lines
+
+
+def _capture_stack(call: Trace, task: asyncio.Task):
+    if not task.done():
+        call.stack = awaiting_stack(task)
+
+
+@contextmanager
+def trace(route: str, threshold: float = None):
+    """
+    Keeps the call in slow_calls if it takes `threshold` (SLOW_HANDLER_SECONDS by default) seconds or longer
+    """
+    threshold = SLOW_HANDLER_SECONDS if threshold is None else threshold
+    task = asyncio.current_task() if threshold > 0 else None
+    if task is None:
+        yield
+        return
+    call = Trace(route)
+    token = _current.set(call)
+    watchdog = task.get_loop().call_later(threshold, _capture_stack, call, task)
+    try:
+        yield
+    finally:
+        watchdog.cancel()
+        _current.reset(token)
+        call.seconds = time.perf_counter() - call.start
+        if call.seconds >= threshold:
+            call.started_at = clock.now() - timedelta(seconds=call.seconds)
+            slow_calls.append(call)
+            SLOW_CALLS.inc(route=route)
+
+
+def note(kind: str, name: str, seconds: float):
+    """
+    Adds DB query or API call to the trace of the call it is made in, if it is traced
+    """
+    call = _current.get()
+    if call is not None:
+        call.add(kind, name, seconds)
+
+
+def report_path(kind: str, extension: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.join(PROFILE_DIR, f'{kind}-{clock.now():%Y%m%d-%H%M%S}.{extension}')
+
+
+def dump_slow_calls() -> Optional[str]:
+    """
+    Writes slow calls (the slowest first) to file, returns its path
+    """
+    if not slow_calls:
+        return None
+    path = report_path('slow', 'json')
+    calls = sorted(slow_calls, key=lambda call: call.seconds, reverse=True)
+    with open(path, 'w') as file:
+        json.dump([call.as_dict() for call in calls], file, ensure_ascii=False, indent=1)
+    return path
+
+
+class ProfilingSession:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.started_at = clock.now()
+        # tracemalloc can be started by PYTHONTRACEMALLOC already - then it is left running
+        self.own_tracemalloc = not tracemalloc.is_tracing()
+        if self.own_tracemalloc:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.snapshot = tracemalloc.take_snapshot()
+        self.profile.enable()
+
+    def stop(self) -> list[str]:
+        """
+        Stops profiling and writes the reports, returns their paths
+        """
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self.own_tracemalloc:
+            tracemalloc.stop()
+
+        pstats_path = report_path('profile', 'pstats')
+        self.profile.dump_stats(pstats_path)
+        text = io.StringIO()
+        text.write(f'Profiled {clock.now() - self.started_at} since {self.started_at.isoformat()}\n')
+        pstats.Stats(self.profile, stream=text).sort_stats('cumulative').print_stats(REPORT_TOP)
+        text_path = report_path('profile', 'txt')
+        with open(text_path, 'w') as file:
+            file.write(text.getvalue())
+
+        memory_path = report_path('memory', 'txt')
+        with open(memory_path, 'w') as file:
+            file.write(f'Traced memory: current {current / 2 ** 20:.1f}MB, peak {peak / 2 ** 20:.1f}MB\n')
+            file.write(f'Top {REPORT_TOP} allocations grown during the session:\n')
+            for stat in snapshot.compare_to(self.snapshot, 'lineno')[:REPORT_TOP]:
+                file.write(f'{stat}\n')
+        return [pstats_path, text_path, memory_path]
+
+
+_session: Optional[ProfilingSession] = None
+
+
+def toggle_profiling() -> tuple[bool, list[str]]:
+    """
+    Starts profiling session or stops the running one. Returns whether it runs now, and paths of written reports
+    """
+    global _session
+    if _session is None:
+        _session = ProfilingSession()
+        logger.warning("Profiling started")
+        return True, []
+    session, _session = _session, None
+    paths = session.stop()
+    logger.warning("Profiling stopped, reports: %s", ', '.join(paths))
+    return False, paths
+
+
+def _dump_slow_calls_logged():
+    path = dump_slow_calls()
+    logger.warning("Slow calls: %s", path or 'none')
+
+
+def install_signal_handlers(loop: asyncio.AbstractEventLoop):
+    # handlers run on the event loop - profiler is enabled in its thread
+    if hasattr(signal, 'SIGUSR1'):
+        loop.add_signal_handler(signal.SIGUSR1, toggle_profiling)
+        loop.add_signal_handler(signal.SIGUSR2, _dump_slow_calls_logged)
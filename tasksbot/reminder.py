@@ -1,85 +1,463 @@
 import asyncio
-from datetime import datetime, timedelta, time
-from functools import partial
+import os
+from datetime import datetime, timedelta
+from typing import Optional
 
+from tasksbot import clock
 from tasksbot.async_logger import get_async_logger
-from tasksbot.bot import bot
+from tasksbot.cache import chat_cache
+from tasksbot.database import db, DB_QUERY_SECONDS, WORKER_ID, LEASE_TIME, Statement, read_bind
+from tasksbot.digest import make_digest, digest_chunks
+from tasksbot.metrics import Histogram, GaugeCallback, SIZE_BUCKETS
 from tasksbot.models import Task, Chat
+from tasksbot.outbox import outbox_message, enqueue, wakeup_flusher
+from tasksbot.profiling import trace, SLOW_REMIND_SECONDS
+from tasksbot.scheduler import scheduler, RESYNC_INTERVAL, next_task_notify_time, next_chat_notify_time, \
+    task_fire_at, task_period, occurrences_count
 
 async_logger = get_async_logger(__name__)
 loop = asyncio.get_event_loop()
 
+REMIND_ALL_SECONDS = Histogram('tasksbot_remind_all_seconds', 'Duration of remind_all')
+REMINDER_BATCH_SIZE = Histogram('tasksbot_reminder_batch_size', 'Rows claimed by one reminder round', ['kind'],
+                                buckets=SIZE_BUCKETS)
 
-def reminder_loop(n=0):
-    loop.create_task(remind_all(n), name=f"reminder_{n}")
-    loop.call_later(60, reminder_loop, n + 1)
+# max rows in one bulk UPDATE
+BATCH_SIZE = int(os.environ.get('REMINDER_BATCH_SIZE', 1000))
+CLAIM_SIZE = int(os.environ.get('REMINDER_CLAIM_SIZE', 1000))
+
+# catch-up after downtime: when at startup at least CATCHUP_THRESHOLD tasks are overdue,
+# they are replayed by rounds of CATCHUP_BATCH chats/exact tasks at not more than CATCHUP_RATE messages per second
+CATCHUP_THRESHOLD = int(os.environ.get('REMINDER_CATCHUP_THRESHOLD', 1000))
+CATCHUP_BATCH = int(os.environ.get('REMINDER_CATCHUP_BATCH', 100))
+CATCHUP_RATE = float(os.environ.get('REMINDER_CATCHUP_RATE', 20))
+# oldest - oldest deadlines first, exact - exact in time tasks first, then chats
+CATCHUP_ORDER = os.environ.get('REMINDER_CATCHUP_ORDER', 'oldest')
+# several missed periods of a task: one notification (with number of missed ones) or one per period
+CATCHUP_COLLAPSE = os.environ.get('REMINDER_CATCHUP_COLLAPSE', '1') == '1'
+CATCHUP_MAX_REPLAY = int(os.environ.get('REMINDER_CATCHUP_MAX_REPLAY', 10))
+CATCHUP_REPORT_INTERVAL = timedelta(seconds=10)
+# due rows left by remind_all (leased by other workers, or being claimed by them) are rechecked
+# that long after the earliest of their leases expires - leases of crashed worker are taken over then
+LEASE_RECHECK_DELAY = timedelta(seconds=1)
+LEASE_RECHECK_KEY = ('leases', None)
+# after a failure (DB error, deadlock...) the schedule is reloaded from DB and reminding goes on that much later
+RETRY_DELAY = float(os.environ.get('REMINDER_RETRY_DELAY', 5))
+
+
+CLAIM_DUE = Statement(db.text(
+    'WITH claimed_chat AS ('
+    '  UPDATE chat SET lease_owner = :worker, lease_until = :lease_until'
+    '  WHERE (bot_id, chat_id) IN ('
+    '    SELECT bot_id, chat_id FROM chat'
+    '    WHERE fire_at <= :now AND (lease_until IS NULL OR lease_until < :now)'
+    '    ORDER BY fire_at LIMIT :chat_limit FOR UPDATE SKIP LOCKED'
+    '  )'
+    '  RETURNING bot_id, chat_id, fire_at, notify_next_date_time, timezone, digest'
+    '), due_exact_task AS ('
+    # exact tasks can be due even when no chat is
+    '  SELECT id FROM task'
+    '  WHERE exact_in_time AND fire_at <= :now AND (lease_until IS NULL OR lease_until < :now)'
+    '  ORDER BY fire_at LIMIT :task_limit FOR UPDATE SKIP LOCKED'
+    '), due_chat_task AS ('
+    '  SELECT task.id FROM task'
+    '  JOIN claimed_chat ON task.bot_id = claimed_chat.bot_id AND task.chat_id = claimed_chat.chat_id'
+    '  WHERE NOT task.exact_in_time AND task.fire_at <= :now'
+    '  AND (task.lease_until IS NULL OR task.lease_until < :now)'
+    '  FOR UPDATE OF task SKIP LOCKED'
+    '), claimed_task AS ('
+    '  UPDATE task SET lease_owner = :worker, lease_until = :lease_until'
+    '  WHERE id IN (SELECT id FROM due_exact_task UNION ALL SELECT id FROM due_chat_task)'
+    '  RETURNING exact_in_time'
+    ')'
+    'SELECT array(SELECT ROW(bot_id, chat_id, fire_at, notify_next_date_time, timezone, digest) FROM claimed_chat), '
+    '(SELECT count(*) FROM claimed_task WHERE exact_in_time)'
+))
+# rows claimed by this worker are released by now, so what is left is claimed by others (NULL - not claimed
+# yet, skipped as locked by the claim of other worker)
+EARLIEST_LEASE = Statement(db.text(
+    'SELECT least('
+    '  (SELECT min(coalesce(lease_until, :now)) FROM chat WHERE fire_at <= :now),'
+    '  (SELECT min(coalesce(lease_until, :now)) FROM task WHERE exact_in_time AND fire_at <= :now)'
+    ')'
+))
+LOAD_SCHEDULE_CHATS = Statement(
+    db.select([Chat.bot_id, Chat.chat_id, Chat.fire_at]).where(Chat.fire_at <= db.bindparam('horizon'))
+)
+LOAD_SCHEDULE_TASKS = Statement(
+    db.select([Task.id, Task.fire_at]).where((Task.fire_at <= db.bindparam('horizon')) & Task.exact_in_time)
+)
+
+
+class ReminderStore:
+    """
+    Rows the reminder engine works with - chats, tasks and outbox in DB. The engine reads and writes them
+    only through the store, set_store() replaces it (simulation keeps the rows in memory)
+    """
+
+    async def load_schedule(self, horizon: datetime) -> tuple[list[tuple], list[tuple]]:
+        """
+        Deadlines until horizon: chats (bot_id, chat_id, fire_at) and exact tasks (id, fire_at)
+        """
+        with DB_QUERY_SECONDS.time(query='load_schedule'):
+            chats = await LOAD_SCHEDULE_CHATS.all(read_bind(), horizon=horizon)
+            tasks = await LOAD_SCHEDULE_TASKS.all(read_bind(), horizon=horizon)
+        return chats, tasks
+
+    async def count_backlog(self, now: datetime) -> tuple[int, int]:
+        """
+        Numbers of overdue chats and tasks
+        """
+        with DB_QUERY_SECONDS.time(query='count_backlog'):
+            return await db.first(db.text(
+                'SELECT (SELECT count(*) FROM chat WHERE fire_at <= :now), '
+                '(SELECT count(*) FROM task WHERE exact_in_time AND fire_at <= :now) + '
+                '(SELECT count(*) FROM task JOIN chat ON task.bot_id = chat.bot_id AND task.chat_id = chat.chat_id '
+                ' WHERE NOT task.exact_in_time AND task.fire_at <= :now AND chat.fire_at <= :now)'
+            ), now=now)
+
+    async def claim_due(self, now: datetime, lease_until: datetime, chat_limit: int = CLAIM_SIZE,
+                        task_limit: int = CLAIM_SIZE) -> tuple[list[tuple], int]:
+        """
+        Claims due chats, not exact due tasks of these chats and exact due tasks in one statement,
+        the oldest deadlines first.
+        Claimed rows get lease_until - tasks are read later by it (see iterate_claimed_tasks).
+        Returns claimed chats (bot_id, chat_id, fire_at, notify_next_date_time, timezone, digest)
+        and number of claimed exact tasks
+        """
+        with DB_QUERY_SECONDS.time(query='claim_due'):
+            return await CLAIM_DUE.first(
+                worker=WORKER_ID, lease_until=lease_until, now=now, chat_limit=chat_limit, task_limit=task_limit
+            )
+
+    async def iterate_claimed_tasks(self, lease_until: datetime):
+        """
+        Yields tasks claimed with lease_until by batches of about BATCH_SIZE, using server-side cursor.
+        Tasks of one chat are never split between batches (so they can be sent in one digest).
+        Tasks get `timezone` of their chat
+        """
+        query = db.select([Task, Chat.timezone]).select_from(Task.join(
+            Chat, (Task.bot_id == Chat.bot_id) & (Task.chat_id == Chat.chat_id)
+        )).where(
+            (Task.lease_owner == WORKER_ID) & (Task.lease_until == lease_until)
+        ).order_by(Task.bot_id, Task.chat_id, Task.id).execution_options(loader=Task.load(timezone=Chat.timezone))
+        # cursor lives in its own transaction, connection is not reusable - so marking of the batches
+        # (done while the cursor is open) goes to other connection and is committed by batch
+        async with db.acquire(reusable=False) as conn:
+            async with conn.transaction():
+                cursor = await conn.iterate(query)
+                carry = []
+                while True:
+                    with DB_QUERY_SECONDS.time(query='fetch_claimed_tasks'):
+                        tasks = await cursor.many(BATCH_SIZE)
+                    if not tasks:
+                        if carry:
+                            yield carry
+                        return
+                    tasks = carry + tasks
+                    # tasks of the last chat may continue in the next fetch - they go with the next batch
+                    split = len(tasks)
+                    last = tasks[-1]
+                    while split and (tasks[split - 1].bot_id, tasks[split - 1].chat_id) == (last.bot_id, last.chat_id):
+                        split -= 1
+                    carry = tasks[split:]
+                    if split:
+                        yield tasks[:split]
+
+    async def earliest_lease(self, now: datetime) -> Optional[datetime]:
+        """
+        The earliest lease of due rows left claimed by other workers (now - if some are not claimed yet),
+        None if there are no due rows
+        """
+        with DB_QUERY_SECONDS.time(query='earliest_lease'):
+            earliest, = await EARLIEST_LEASE.first(now=now)
+        return earliest
+
+    async def save_notified(self, messages: list[dict], notified: list[tuple[int, datetime, datetime]]):
+        """
+        In one transaction queues the messages to outbox and moves the tasks (id, notify_time, fire_at)
+        to their next notification, releasing their leases
+        """
+        async_logger.debug("Mark tasks as notified (tasks count=%d)", len(notified))
+        with DB_QUERY_SECONDS.time(query='mark_processed'):
+            async with db.transaction():
+                for batch in batches(messages):
+                    await enqueue(batch)
+                for batch in batches(notified):
+                    ids, notify_times, fire_ats = zip(*batch)
+                    await db.status(db.text(
+                        'UPDATE task SET notify_time = v.notify_time, fire_at = v.fire_at, lease_until = NULL '
+                        'FROM unnest(CAST(:ids AS integer[]), CAST(:notify_times AS timestamp[]), '
+                        'CAST(:fire_ats AS timestamp[])) AS v(id, notify_time, fire_at) '
+                        'WHERE task.id = v.id'
+                    ), ids=list(ids), notify_times=list(notify_times), fire_ats=list(fire_ats))
+
+    async def save_chats(self, chats: list[tuple[str, str, datetime, datetime]]):
+        """
+        Moves the chats (bot_id, chat_id, notify_next_date_time, fire_at) to their next notification,
+        releasing their leases
+        """
+        with DB_QUERY_SECONDS.time(query='mark_processed'):
+            for batch in batches(chats):
+                bot_ids, chat_ids, notify_times, fire_ats = map(list, zip(*batch))
+                await db.status(db.text(
+                    'UPDATE chat SET notify_next_date_time = v.notify_time, fire_at = v.fire_at, lease_until = NULL '
+                    'FROM unnest(CAST(:bot_ids AS varchar[]), CAST(:chat_ids AS varchar[]), '
+                    'CAST(:notify_times AS timestamp[]), CAST(:fire_ats AS timestamp[])) '
+                    'AS v(bot_id, chat_id, notify_time, fire_at) '
+                    'WHERE chat.bot_id = v.bot_id AND chat.chat_id = v.chat_id'
+                ), bot_ids=bot_ids, chat_ids=chat_ids, notify_times=notify_times, fire_ats=fire_ats)
+
+
+_store = ReminderStore()
+
+
+def get_store() -> ReminderStore:
+    return _store
+
+
+def set_store(store: ReminderStore) -> ReminderStore:
+    """
+    Replaces the store of the reminder engine, returns the previous one
+    """
+    global _store
+    previous, _store = _store, store
+    return previous
+
+
+class CatchUpProgress:
+    def __init__(self):
+        self.backlog = 0
+        self.tasks = 0
+        self.messages = 0
+
+    @property
+    def remaining(self) -> int:
+        return max(self.backlog - self.tasks, 0)
+
+
+catch_up_progress = CatchUpProgress()
+
+CATCHUP_BACKLOG = GaugeCallback('tasksbot_reminder_catchup_backlog', 'Overdue tasks left to replay after startup',
+                                lambda: catch_up_progress.remaining)
+
+
+def reminder_loop():
+    return loop.create_task(run_reminder(), name="reminder")
+
+
+async def run_reminder():
+    try:
+        await catch_up()
+    except Exception:
+        # whatever is left is reminded by the regular loop
+        async_logger.exception("Catch-up failed")
+    n = 0
+    while True:
+        try:
+            resync_at = clock.now() + RESYNC_INTERVAL
+            await load_schedule(resync_at)
+            while clock.now() < resync_at:
+                if await scheduler.wait_due(resync_at):
+                    await remind_all(n)
+                    n += 1
+        except Exception:
+            # claimed rows are taken again when their leases expire
+            async_logger.exception("Reminder failed, retry in %g sec", RETRY_DELAY)
+            await clock.sleep(RETRY_DELAY)
+
+
+async def load_schedule(horizon: datetime):
+    scheduler.clear()
+    chats, tasks = await _store.load_schedule(horizon)
+    for bot_id, chat_id, fire_at in chats:
+        scheduler.schedule(('chat', (bot_id, chat_id)), fire_at)
+    for task_id, fire_at in tasks:
+        scheduler.schedule(('task', task_id), fire_at)
+    async_logger.debug("Loaded %d reminder deadlines until %s", len(scheduler), horizon.isoformat())
 
 
 def make_task_menu(task: Task):
-    return bot.json_serialize({
+    return {
         'inline_keyboard':
             [[{
                 'text': f'Сделано ️✅',
                 'callback_data': f'mark/{task.id}'
             }]]
-    })
+    }
+
 
+def task_notify_message(task: Task, due_time: datetime, occurrence: datetime = None, missed: int = 0) -> dict:
+    text = f'{task.content}\n\n(пропущено напоминаний: {missed})' if missed else task.content
+    return outbox_message(task.bot_id, task.chat_id, text, make_task_menu(task), [task.id], due_time,
+                          occurrence or task.notify_time)
 
-async def send_task_notify(task: Task, chat: Chat = None):
-    message = await bot.send_message(
-        task.chat_id, task.content,
-        reply_markup=make_task_menu(task)
-    )
-    notify_time = datetime.combine(
-        (datetime.now() + timedelta(days=task.period_days)).date(),
-        task.notify_time.time()
-    )
-    await task.update(
-        last_notify_id=str(message['result']['message_id']),
-        notify_time=notify_time
-    ).apply()
+
+def task_messages(task: Task, due_time: datetime, until: datetime) -> list[dict]:
+    """
+    Notification of the task which is due by `until`. If some periods were missed -
+    one notification with their number (CATCHUP_COLLAPSE) or notification for each of last CATCHUP_MAX_REPLAY
+    """
+    count = occurrences_count(task.fire_at, task.period_days, until)
+    if count == 1:
+        return [task_notify_message(task, due_time)]
+    if CATCHUP_COLLAPSE:
+        return [task_notify_message(task, due_time, missed=count - 1)]
+    period = task_period(task.period_days)
+    replayed = min(count, CATCHUP_MAX_REPLAY)
+    skipped = count - replayed
+    return [
+        task_notify_message(task, task.fire_at + i * period, task.notify_time + i * period)
+        for i in range(skipped, count)
+    ]
+
+
+def digest_message(tasks: list[Task], due_time: datetime) -> dict:
+    text, markup = make_digest(tasks)
+    return outbox_message(tasks[0].bot_id, tasks[0].chat_id, text, markup, [task.id for task in tasks], due_time,
+                          tasks[0].notify_time)
 
 
 async def remind_all(n=0):
     async_logger.info("Check tasks to remind (%5d)", n)
-    chats = await Chat.query.where(Chat.notify_next_date_time <= datetime.now()).gino.all()
-    if not chats:
-        return
-    chats_by_ids = {chat.chat_id: chat for chat in chats}
-    tasks = await Task.query.where(
-        Task.chat_id.in_(chats_by_ids.keys()) &
-        (Task.notify_time <= datetime.combine(datetime.now(), time(0, 0))) &
-        (Task.exact_in_time == False)
-    ).gino.all()
-    tasks += await Task.query.where(
-        (Task.notify_time <= datetime.now()) &
-        Task.exact_in_time
-    ).gino.all()
-    async_logger.debug("Number of tasks to remind = %5d", len(tasks))
-    if not tasks:
-        await mark_chats_as_processed(chats)
+    with REMIND_ALL_SECONDS.time(), trace('remind_all', SLOW_REMIND_SECONDS):
+        # each round claims not more than CLAIM_SIZE chats and exact tasks, the rest is left to other workers
+        while True:
+            chats_count, exact_tasks_count, _, _ = await remind_round(CLAIM_SIZE, CLAIM_SIZE)
+            if chats_count < CLAIM_SIZE and exact_tasks_count < CLAIM_SIZE:
+                break
+        await schedule_lease_recheck(clock.now())
+
+
+async def schedule_lease_recheck(now: datetime):
+    """
+    If due rows are left claimed by other workers, remind_all is run again when their leases expire - so rows
+    of a crashed worker don't wait for an unrelated wake-up or the next resync
+    """
+    earliest = await _store.earliest_lease(now)
+    if earliest is not None:
+        scheduler.schedule(LEASE_RECHECK_KEY, max(earliest, now) + LEASE_RECHECK_DELAY)
+
+
+async def catch_up():
+    """
+    Replays reminders missed while the bot was down, if there are many of them: by small rounds in priority order
+    (CATCHUP_ORDER) and at CATCHUP_RATE, instead of claiming and queueing everything at once.
+    Reminders which become due meanwhile are claimed by the same rounds
+    """
+    now = clock.now()
+    chats_backlog, tasks_backlog = await _store.count_backlog(now)
+    if tasks_backlog < max(CATCHUP_THRESHOLD, 1):
         return
+    progress = catch_up_progress
+    progress.backlog = tasks_backlog
+    async_logger.warning("Catch-up: %d overdue tasks in %d chats, replaying at %g messages/sec, %s first",
+                         tasks_backlog, chats_backlog, CATCHUP_RATE, CATCHUP_ORDER)
+    started = report_at = now
+    exact_first = CATCHUP_ORDER == 'exact'
+    while True:
+        round_start = clock.now()
+        chats_count, exact_tasks_count, tasks_count, messages_count = await remind_round(
+            0 if exact_first else CATCHUP_BATCH, CATCHUP_BATCH
+        )
+        progress.tasks += tasks_count
+        progress.messages += messages_count
+        if exact_first and exact_tasks_count < CATCHUP_BATCH:
+            exact_first = False
+        elif chats_count < CATCHUP_BATCH and exact_tasks_count < CATCHUP_BATCH:
+            break
+        now = clock.now()
+        if now >= report_at:
+            messages_per_task = progress.messages / max(progress.tasks, 1)
+            async_logger.info("Catch-up: %d/%d tasks (%d%%), %d messages, about %d sec left",
+                              progress.tasks, progress.backlog, progress.tasks * 100 // progress.backlog,
+                              progress.messages, progress.remaining * messages_per_task / CATCHUP_RATE)
+            report_at = now + CATCHUP_REPORT_INTERVAL
+        await clock.sleep(messages_count / CATCHUP_RATE - (now - round_start).total_seconds())
+    async_logger.warning("Catch-up done: %d tasks, %d messages in %d sec",
+                         progress.tasks, progress.messages, (clock.now() - started).total_seconds())
+    progress.backlog = progress.tasks = progress.messages = 0
 
-    await asyncio.gather(*[
-        send_task_notify(task, chats_by_ids[task.chat_id], )
-        for task in tasks
+
+async def remind_round(chat_limit: int, task_limit: int) -> tuple[int, int, int, int]:
+    """
+    Claims not more than chat_limit due chats (with their tasks) and task_limit exact tasks, queues their notifications.
+    Returns numbers of claimed chats, claimed exact tasks, all claimed tasks and queued messages
+    """
+    now = clock.now()
+    lease_until = now + LEASE_TIME
+    chats, exact_tasks_count = await _store.claim_due(now, lease_until, chat_limit, task_limit)
+    chats_due_times = {(bot_id, chat_id): fire_at for bot_id, chat_id, fire_at, _, _, _ in chats}
+    digest_chat_ids = {(bot_id, chat_id) for bot_id, chat_id, _, _, _, digest in chats if digest}
+    tasks_count = 0
+    messages_count = 0
+    async for tasks in _store.iterate_claimed_tasks(lease_until):
+        tasks_count += len(tasks)
+        messages_count += await remind(chats_due_times, digest_chat_ids, tasks)
+    await mark_chats_as_processed([
+        (bot_id, chat_id, notify_next_date_time, timezone)
+        for bot_id, chat_id, _, notify_next_date_time, timezone, _ in chats
     ])
-    await mark_chats_as_processed(chats)
+    async_logger.debug("Number of tasks to remind = %5d", tasks_count)
+    REMINDER_BATCH_SIZE.observe(len(chats), kind='chats')
+    REMINDER_BATCH_SIZE.observe(tasks_count, kind='tasks')
+    return len(chats), exact_tasks_count, tasks_count, messages_count
+
+
+async def remind(chats_due_times: dict[tuple[str, str], datetime], digest_chat_ids: set[tuple[str, str]],
+                 tasks: list[Task]) -> int:
+    """
+    Queues notifications of the tasks to outbox and advances their notify_time in one transaction,
+    messages are sent by outbox flusher. Chats are keyed by (bot_id, chat_id). Returns number of queued messages
+    """
+    now = clock.now()
+    messages = []
+    digests = {}
+    for task in tasks:
+        chat_key = task.bot_id, task.chat_id
+        if task.exact_in_time:
+            messages += task_messages(task, task.fire_at, now)
+        elif chat_key in digest_chat_ids:
+            # digest lists a task once, however many periods were missed
+            digests.setdefault(chat_key, []).append(task)
+        else:
+            messages += task_messages(task, chats_due_times.get(chat_key, task.fire_at), now)
+    for chat_key, chat_tasks in digests.items():
+        for chunk in digest_chunks(chat_tasks):
+            if len(chunk) == 1:
+                messages += task_messages(chunk[0], chats_due_times[chat_key], now)
+            else:
+                messages.append(digest_message(chunk, chats_due_times[chat_key]))
 
+    notified = []
+    for task in tasks:
+        notify_time = next_task_notify_time(task.notify_time, task.period_days, clock.to_local(now, task.timezone))
+        fire_at = task_fire_at(notify_time, task.exact_in_time, task.timezone)
+        notified.append((task.id, notify_time, fire_at))
+        if task.exact_in_time:
+            scheduler.schedule(('task', task.id), fire_at)
 
-async def mark_chats_as_processed(chats: list[Chat]):
-    chat: Chat = None
+    await _store.save_notified(messages, notified)
+    wakeup_flusher()
+    return len(messages)
+
+
+def batches(items: list, size: int = BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def mark_chats_as_processed(chats: list[tuple[str, str, datetime, str]]):
+    """
+    Moves notification of the chats (bot_id, chat_id, notify_next_date_time, timezone) to the next day
+    """
     async_logger.debug("Mark chats notify_next_date_time (chats count=%d)", len(chats))
-    for chat in chats:
-        notify_time = chat.notify_next_date_time.time()
-        await chat.update(
-            notify_next_date_time=datetime.combine(
-                (datetime.now() + timedelta(days=1)).date(),
-                notify_time
-            )
-        ).apply()
-        async_logger.debug(
-            "Chat %s: updated next notify time to '%s'",
-            chat.chat_name,
-            chat.notify_next_date_time.isoformat()
-        )
+    now = clock.now()
+    processed = []
+    for bot_id, chat_id, notify_next_date_time, timezone in chats:
+        notify_time, fire_at = next_chat_notify_time(notify_next_date_time, now, timezone)
+        processed.append((bot_id, chat_id, notify_time, fire_at))
+    await _store.save_chats(processed)
+    for bot_id, chat_id, _, fire_at in processed:
+        chat_cache.pop((bot_id, chat_id))
+        scheduler.schedule(('chat', (bot_id, chat_id)), fire_at)
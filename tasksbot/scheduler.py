@@ -0,0 +1,149 @@
+import asyncio
+import heapq
+import os
+from datetime import date, datetime, time, timedelta
+from typing import Hashable, Optional
+
+from tasksbot import clock
+from tasksbot.models import Chat, Task
+
+# how often in-memory schedule is reloaded from DB (catches changes done not by this process),
+# only deadlines until the next reload are kept in memory
+RESYNC_INTERVAL = timedelta(seconds=int(os.environ.get('REMINDER_RESYNC_INTERVAL', 3600)))
+
+
+class ReminderScheduler:
+    """
+    In-memory priority queue of the next fire times.
+    Entries are never removed from the heap directly - a newer deadline for the same key
+    (or discard of that key) makes the old heap entry stale, and stale entries are skipped on pop.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, key: Hashable, when: Optional[datetime]):
+        if when is None:
+            return self.discard(key)
+        earliest = self.next_deadline()
+        self._deadlines[key] = when
+        heapq.heappush(self._heap, (when, key))
+        if self._wakeup and (earliest is None or when < earliest):
+            self._wakeup.set()
+
+    def discard(self, key: Hashable):
+        self._deadlines.pop(key, None)
+
+    def clear(self):
+        self._heap.clear()
+        self._deadlines.clear()
+
+    def next_deadline(self) -> Optional[datetime]:
+        while self._heap:
+            when, key = self._heap[0]
+            if self._deadlines.get(key) == when:
+                return when
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now: datetime) -> list:
+        due = []
+        while True:
+            when = self.next_deadline()
+            if when is None or when > now:
+                return due
+            _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            due.append(key)
+
+    async def wait_due(self, until: datetime) -> list:
+        """
+        Sleep until the earliest deadline (or `until`, whichever comes first),
+        wakes up earlier if something with closer deadline was scheduled meanwhile.
+        Returns keys which are due (empty list if woke up by `until`).
+        """
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        while True:
+            now = clock.now()
+            due = self.pop_due(now)
+            if due or now >= until:
+                return due
+            deadline = min(self.next_deadline() or until, until)
+            self._wakeup.clear()
+            # sleep goes through the clock, so with virtual clock it doesn't wait in real time
+            sleep = asyncio.ensure_future(clock.sleep((deadline - now).total_seconds()))
+            wakeup = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait([sleep, wakeup], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                sleep.cancel()
+                wakeup.cancel()
+
+
+scheduler = ReminderScheduler()
+
+
+# Wall times (Chat.notify_next_date_time, Task.notify_time) are local times of the chat.
+# Instants the reminder selects by (Chat.fire_at, Task.fire_at) are UTC, they are computed from the wall times
+# whenever these are set or advanced - so selection of due rows is a plain range scan on fire_at.
+
+def task_period(period_days: int) -> timedelta:
+    # period_days < 1 can be only in rows stored before it was validated - such task is reminded daily
+    return timedelta(days=max(period_days, 1))
+
+
+def next_task_notify_time(notify_time: datetime, period_days: int, local_now: datetime) -> datetime:
+    # next notification is period_days after the sent one, at the task's time of day
+    return datetime.combine((local_now + task_period(period_days)).date(), notify_time.time())
+
+
+def task_fire_at(notify_time: datetime, exact_in_time: bool, zone: str) -> datetime:
+    """
+    UTC instant from which the task is due: exact task - its notify_time,
+    not exact task is sent with the first chat notification of the day after its notify_time
+    """
+    if not exact_in_time:
+        day_start = datetime.combine(notify_time.date(), time(0, 0))
+        notify_time = day_start if notify_time == day_start else day_start + timedelta(days=1)
+    return clock.to_utc(notify_time, zone)
+
+
+def occurrences_count(fire_at: datetime, period_days: int, until: datetime) -> int:
+    # occurrences of the task due by `until` - more than one when notifications were missed (bot was down)
+    if fire_at > until:
+        return 1
+    return (until - fire_at) // task_period(period_days) + 1
+
+
+def next_chat_notify_date(local_now: datetime) -> date:
+    return (local_now + timedelta(days=1)).date()
+
+
+def next_chat_notify_time(notify_next_date_time: datetime, now: datetime, zone: str) -> tuple[datetime, datetime]:
+    """
+    Wall time and UTC fire instant of the chat notification after the one due at notify_next_date_time
+    """
+    local_time = datetime.combine(next_chat_notify_date(clock.to_local(now, zone)), notify_next_date_time.time())
+    return local_time, clock.to_utc(local_time, zone)
+
+
+def schedule_chat(chat: Chat):
+    scheduler.schedule(('chat', (chat.bot_id, chat.chat_id)), chat.fire_at)
+
+
+def schedule_task(task: Task):
+    # not exact tasks are sent with chat's notification, so only chat deadline matters for them
+    if task.exact_in_time:
+        scheduler.schedule(('task', task.id), task.fire_at)
+    else:
+        discard_task(task.id)
+
+
+def discard_task(task_id: int):
+    scheduler.discard(('task', task_id))
@@ -0,0 +1,477 @@
+import asyncio
+import io
+import logging
+import os
+import random
+import ssl
+import time
+from collections import deque
+
+import aiohttp
+from aiotg import BotApiError
+from aiotg.bot import RETRY_CODES, RETRY_TIMEOUT
+
+from tasksbot.metrics import Counter, Histogram
+
+try:
+    import certifi
+except ImportError:
+    certifi = None
+
+logger = logging.getLogger(__name__)
+
+API_SECONDS = Histogram('tasksbot_telegram_api_seconds', 'Duration of Telegram Bot API requests', ['method'])
+API_ERRORS = Counter('tasksbot_telegram_api_errors_total', 'Failed Telegram Bot API requests', ['method', 'status'])
+SEND_SECONDS = Histogram('tasksbot_send_seconds', 'Time from queueing API call to its result', ['method'])
+EDITS_COALESCED = Counter('tasksbot_telegram_edits_coalesced_total', 'Message edits merged into a later edit')
+
+GLOBAL_RATE = float(os.environ.get('TG_GLOBAL_RATE', 30))
+CHAT_RATE = float(os.environ.get('TG_CHAT_RATE', 1))
+CHAT_BURST = int(os.environ.get('TG_CHAT_BURST', 3))
+GROUP_RATE = float(os.environ.get('TG_GROUP_RATE', 20 / 60))
+GROUP_BURST = int(os.environ.get('TG_GROUP_BURST', 5))
+SEND_QUEUE_SIZE = int(os.environ.get('TG_SEND_QUEUE_SIZE', 10000))
+SEND_WORKERS = int(os.environ.get('TG_SEND_WORKERS', 16))
+SEND_MAX_RETRIES = int(os.environ.get('TG_SEND_MAX_RETRIES', 5))
+RETRY_JITTER = 1.0
+MAX_CHAT_BUCKETS = 10000
+# edits of a message are held that long before sending - edits of the same message made meanwhile
+# (or while it waits for the chat's rate limit) are sent as one, the latest. 0 - every edit is sent and awaited
+EDIT_COALESCE_SECONDS = float(os.environ.get('TG_EDIT_COALESCE_SECONDS', 0.3))
+EDIT_METHODS = ('editMessageText', 'editMessageReplyMarkup')
+
+# HTTP connections to Bot API are shared by all bots of the process and kept alive between calls
+CONNECTION_LIMIT = int(os.environ.get('TG_CONNECTION_LIMIT', 100))
+KEEPALIVE_SECONDS = float(os.environ.get('TG_KEEPALIVE_SECONDS', 60))
+DNS_CACHE_SECONDS = int(os.environ.get('TG_DNS_CACHE_SECONDS', 300))
+CONNECT_TIMEOUT = float(os.environ.get('TG_CONNECT_TIMEOUT', 10))
+# timeout of API call, getUpdates gets its long polling timeout on top of it
+REQUEST_TIMEOUT = float(os.environ.get('TG_REQUEST_TIMEOUT', 30))
+
+# methods which post something into chat and so are limited by per chat/group limits
+CHAT_LIMITED_PREFIXES = ('send', 'edit', 'forward', 'copy')
+
+
+class RetryAfter(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Too Many Requests: retry after {retry_after}")
+        self.retry_after = retry_after
+
+
+class TemporaryError(Exception):
+    pass
+
+
+_connector = None
+
+
+def shared_connector() -> aiohttp.TCPConnector:
+    global _connector
+    if _connector is None or _connector.closed:
+        _connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT,
+            keepalive_timeout=KEEPALIVE_SECONDS,
+            ttl_dns_cache=DNS_CACHE_SECONDS,
+            ssl=ssl.create_default_context(cafile=certifi.where()) if certifi else True,
+        )
+    return _connector
+
+
+async def close_connector():
+    global _connector
+    if _connector is not None:
+        connector, _connector = _connector, None
+        await connector.close()
+
+
+def create_session(json_serialize) -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(
+        connector=shared_connector(),
+        connector_owner=False,
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+        json_serialize=json_serialize,
+    )
+
+
+def edit_key(method, params):
+    # edits of inline messages (no chat_id) are not coalesced
+    if method in EDIT_METHODS and 'chat_id' in params and 'message_id' in params:
+        return str(params['chat_id']), str(params['message_id'])
+    return None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def delay(self) -> float:
+        """
+        Seconds until a token is available, 0 - it is available now
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            delay = self.delay()
+            if not delay:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(delay)
+
+
+async def api_request(bot, method, **params):
+    """
+    Same as aiotg.Bot._api_call but without endless retrying inside - raises RetryAfter/TemporaryError instead
+    """
+    url = "{0}/bot{1}/{2}".format(bot.api_url, bot.api_token, method)
+    logger.debug("api_call %s, %s", method, params)
+    for value in params.values():
+        if isinstance(value, io.IOBase):
+            # uploaded file is read from the start on every retry
+            value.seek(0)
+
+    options = {}
+    if method == 'getUpdates':
+        options['timeout'] = aiohttp.ClientTimeout(
+            total=float(params.get('timeout', 0)) + REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT
+        )
+    try:
+        with API_SECONDS.time(method=method):
+            response = await bot.session.post(
+                url, data=params, proxy=bot.proxy, proxy_auth=bot.proxy_auth, **options
+            )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        API_ERRORS.inc(method=method, status=type(e).__name__)
+        raise
+    if response.status == 200:
+        return await response.json(loads=bot.json_deserialize)
+
+    API_ERRORS.inc(method=method, status=response.status)
+
+    json_resp = {}
+    if response.content_type == "application/json":
+        json_resp = await response.json(loads=bot.json_deserialize)
+    else:
+        await response.release()
+    if response.status == 429:
+        raise RetryAfter(json_resp.get('parameters', {}).get('retry_after', RETRY_TIMEOUT))
+    if response.status in RETRY_CODES:
+        raise TemporaryError(f"Server returned {response.status}")
+    err_msg = json_resp.get("description", f"Server returned {response.status}")
+    logger.error(err_msg)
+    raise BotApiError(err_msg, response=response)
+
+
+class ApiCall:
+    """
+    API call in the outbound queue. Edit of a message (`future` is None - nobody waits for it) takes in
+    later edits of the same message until it is sent
+    """
+    __slots__ = ('method', 'params', 'future', 'enqueued', 'edit_key', 'attempts')
+
+    def __init__(self, method, params, future=None):
+        self.method = method
+        self.params = params
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.edit_key = edit_key(method, params) if future is None else None
+        self.attempts = 0
+
+    def merge(self, method, params):
+        if method == 'editMessageReplyMarkup' and self.method == 'editMessageText':
+            # the new text stays, the keyboard is replaced (or removed if the edit has none)
+            params = {**{key: value for key, value in self.params.items() if key != 'reply_markup'}, **params}
+            method = self.method
+        self.method = method
+        self.params = params
+
+
+class ChatQueue:
+    """
+    Calls to one chat (or group) in order of queueing. `active` while the chat is waiting for a worker,
+    for a timer or is being sent - one call of the chat at a time
+    """
+    __slots__ = ('chat_id', 'calls', 'active', 'timer', 'retry_at')
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.calls = deque()
+        self.active = False
+        self.timer = None
+        self.retry_at = 0.0
+
+
+class Sender:
+    """
+    Outbound queue of Telegram API calls.
+    Calls to a chat are queued per chat and sent one by one in order. Workers get a chat only when
+    its bucket has a token (chats without tokens wait on timers, not in workers), so a busy group doesn't hold
+    up other chats. Calls not limited per chat go to workers right away. Every call waits for the global bucket.
+    """
+
+    def __init__(self, request, queue_size=SEND_QUEUE_SIZE, workers=SEND_WORKERS,
+                 edit_window=EDIT_COALESCE_SECONDS):
+        self._request = request
+        self._queue_size = queue_size
+        self._workers_count = workers
+        # chats whose call can be sent now (ChatQueue) and calls not limited per chat (ApiCall)
+        self._ready = None
+        # limits number of queued calls
+        self._slots = None
+        self._queued = 0
+        self._idle = None
+        self._chats = {}
+        self._workers = []
+        self.edit_window = edit_window
+        # edits waiting to be sent: (chat_id, message_id) -> ApiCall
+        self._edits = {}
+        self._delayed = set()
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.latencies = deque(maxlen=1000)
+
+    def start(self):
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self._queue_size)
+            self._idle = asyncio.Event()
+            self._idle.set()
+        while len(self._workers) < self._workers_count:
+            self._workers.append(asyncio.ensure_future(self._worker()))
+
+    def stop(self):
+        for task in [*self._workers, *self._delayed]:
+            task.cancel()
+        pending = []
+        for chat in self._chats.values():
+            if chat.timer is not None:
+                chat.timer.cancel()
+            pending.extend(chat.calls)
+        while self._ready is not None and not self._ready.empty():
+            item = self._ready.get_nowait()
+            if isinstance(item, ApiCall):
+                pending.append(item)
+        for call in pending:
+            if call.future is not None:
+                call.future.cancel()
+        self._workers = []
+        self._delayed = set()
+        self._edits = {}
+        self._chats = {}
+        self._ready = None
+        self._queued = 0
+
+    async def submit(self, method, params):
+        self.start()
+        future = asyncio.get_event_loop().create_future()
+        await self._put(ApiCall(method, params, future))
+        return await future
+
+    def can_coalesce(self, method, params) -> bool:
+        return self.edit_window > 0 and edit_key(method, params) is not None
+
+    def submit_edit(self, method, params):
+        """
+        Queues edit of a message (see can_coalesce) without waiting for it to be sent.
+        The edit is merged into a queued edit of the same message if there is one.
+        Errors are only logged - message state is defined by the latest edit anyway
+        """
+        call = ApiCall(method, params)
+        queued = self._edits.get(call.edit_key)
+        if queued is not None:
+            queued.merge(method, params)
+            self.coalesced += 1
+            EDITS_COALESCED.inc()
+            return
+        self._edits[call.edit_key] = call
+        task = asyncio.ensure_future(self._put_later(call))
+        self._delayed.add(task)
+        task.add_done_callback(self._delayed.discard)
+
+    async def drain(self):
+        """
+        Waits until queued calls (edits held for coalescing too) are done
+        """
+        while self._delayed:
+            await asyncio.gather(*self._delayed, return_exceptions=True)
+        if self._idle is not None:
+            await self._idle.wait()
+
+    async def _put_later(self, call: ApiCall):
+        await asyncio.sleep(self.edit_window)
+        self.start()
+        await self._put(call)
+
+    async def _put(self, call: ApiCall):
+        await self._slots.acquire()
+        self._queued += 1
+        self._idle.clear()
+        chat_id = call.params.get('chat_id') if call.method.startswith(CHAT_LIMITED_PREFIXES) else None
+        if chat_id is None:
+            self._ready.put_nowait(call)
+            return
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = ChatQueue(chat_id)
+        chat.calls.append(call)
+        if not chat.active:
+            chat.active = True
+            self._schedule(chat)
+
+    def _schedule(self, chat: ChatQueue):
+        """
+        Passes the chat to workers when its next call can be sent: right away or by timer
+        """
+        delay = max(self.chat_bucket(chat.chat_id).delay(), chat.retry_at - time.monotonic())
+        if delay > 0:
+            chat.timer = asyncio.get_event_loop().call_later(delay, self._ready.put_nowait, chat)
+        else:
+            chat.timer = None
+            self._ready.put_nowait(chat)
+
+    def _done(self, call: ApiCall):
+        latency = time.monotonic() - call.enqueued
+        self.latencies.append(latency)
+        SEND_SECONDS.observe(latency, method=call.method)
+        self._slots.release()
+        self._queued -= 1
+        if not self._queued:
+            self._idle.set()
+
+    def chat_bucket(self, chat_id):
+        if chat_id is None:
+            return None
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                # full buckets are the same as new ones - no need to keep them
+                self.chat_buckets = {
+                    key: bucket for key, bucket in self.chat_buckets.items() if not bucket.is_full()
+                }
+            if str(chat_id).startswith('-'):
+                bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+            else:
+                bucket = TokenBucket(CHAT_RATE, CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _worker(self):
+        while True:
+            item = await self._ready.get()
+            if isinstance(item, ChatQueue):
+                await self._send_chat(item)
+                continue
+            # not limited per chat - nothing else waits for its retries
+            delay = await self._send(item)
+            while delay is not None:
+                await asyncio.sleep(delay)
+                delay = await self._send(item)
+
+    async def _send_chat(self, chat: ChatQueue):
+        bucket = self.chat_bucket(chat.chat_id)
+        if bucket.delay():
+            # paused by 429 of a call which was being sent when the chat was scheduled
+            self._schedule(chat)
+            return
+        bucket.tokens -= 1
+        delay = await self._send(chat.calls[0], bucket)
+        if delay is None:
+            chat.calls.popleft()
+        else:
+            chat.retry_at = time.monotonic() + delay
+        if chat.calls:
+            self._schedule(chat)
+        else:
+            chat.active = False
+            del self._chats[chat.chat_id]
+
+    async def _send(self, call: ApiCall, chat_bucket: TokenBucket = None):
+        """
+        Makes one attempt of the call. Returns None if the call is done (or has failed),
+        otherwise seconds to wait before the next attempt
+        """
+        future = call.future
+        try:
+            if future is not None and future.done():
+                self._done(call)
+                return None
+            await self.global_bucket.acquire()
+            if call.edit_key:
+                if call.attempts and call.edit_key in self._edits:
+                    # retried edit is outdated by the one queued meanwhile
+                    self._done(call)
+                    return None
+                # edits from now on go to a new call
+                if self._edits.get(call.edit_key) is call:
+                    del self._edits[call.edit_key]
+            call.attempts += 1
+            result = await self._request(call.method, **call.params)
+        except asyncio.CancelledError:
+            if future is not None and not future.done():
+                future.cancel()
+            raise
+        except (RetryAfter, TemporaryError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if call.attempts > SEND_MAX_RETRIES:
+                self._fail(call, e)
+                return None
+            self.retried += 1
+            if isinstance(e, RetryAfter):
+                logger.info("%s: %s", call.method, e)
+                (chat_bucket or self.global_bucket).pause(e.retry_after)
+                return random.uniform(0, RETRY_JITTER)
+            delay = 2 ** (call.attempts - 1) + random.uniform(0, RETRY_JITTER)
+            logger.info("%s: %r, retrying in %.1f sec.", call.method, e, delay)
+            return delay
+        except Exception as e:
+            self._fail(call, e)
+            return None
+        self.sent += 1
+        if future is not None and not future.done():
+            future.set_result(result)
+        self._done(call)
+        return None
+
+    def _fail(self, call: ApiCall, error: Exception):
+        self.failed += 1
+        if call.future is None:
+            logger.error("%s %s: %r", call.method, call.edit_key, error)
+        elif not call.future.done():
+            call.future.set_exception(error)
+        self._done(call)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            'queue_depth': self._queued,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'coalesced': self.coalesced,
+            'chat_buckets': len(self.chat_buckets),
+            'latency_p50': latencies[len(latencies) // 2] if latencies else 0.0,
+            'latency_p99': latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+        }
@@ -0,0 +1,205 @@
+import asyncio
+import inspect
+import logging
+import os
+import time
+from functools import partial, wraps
+
+import aiohttp
+import aiotg
+from aiotg.bot import API_URL, MESSAGE_UPDATES, RETRY_TIMEOUT
+
+from tasksbot.dispatcher import KeyedDispatcher, update_key
+from tasksbot.metrics import Counter, Histogram
+from tasksbot.profiling import trace, note
+from tasksbot.sender import RetryAfter, Sender, TemporaryError, api_request, create_session, close_connector, \
+    CONNECT_TIMEOUT, REQUEST_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+HANDLER_SECONDS = Histogram('tasksbot_handler_seconds', 'Duration of update handlers', ['route'])
+HANDLER_ERRORS = Counter('tasksbot_handler_errors_total', 'Exceptions raised by update handlers', ['route'])
+
+
+def instrument(fn, route: str):
+    @wraps(fn)
+    async def handler(*args):
+        start = time.perf_counter()
+        try:
+            with trace(route):
+                result = fn(*args)
+                if inspect.isawaitable(result):
+                    result = await result
+            return result
+        except Exception:
+            HANDLER_ERRORS.inc(route=route)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, route=route)
+
+    return handler
+
+
+class TasksBot(aiotg.Bot):
+    """
+    All API calls (except long polling) go through rate limited outbound queue.
+    Message edits are not waited for: handler returns (and the next update of the chat is processed)
+    while the edit is queued, so quick taps in a row are sent as one edit (see Sender.submit_edit).
+    Updates of the same chat are processed one by one, updates of different chats - in parallel.
+    Several bots can be served by one process: tenant() makes a bot with the same handlers and dispatcher.
+    Updates of getUpdates batch wait for one prefetch of the rows they need (see prefetch), the next getUpdates
+    is sent right away - while the batch is processed.
+    """
+
+    def __init__(self, *args, dispatcher: KeyedDispatcher = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # numeric id of the bot is the first part of its token
+        self.bot_id = self.api_token.split(':', 1)[0]
+        self.api_url = os.environ.get('TG_API_URL', API_URL)
+        # rate limits of Telegram are per bot
+        self.sender = Sender(partial(api_request, self))
+        self.dispatcher = dispatcher or KeyedDispatcher()
+        self._prefetch = None
+
+    def tenant(self, api_token: str) -> 'TasksBot':
+        """
+        Bot with other token which has the same handlers (registered so far) and shares dispatcher with this one
+        """
+        bot = TasksBot(
+            api_token, api_timeout=self.api_timeout, name=self.name, json_serialize=self.json_serialize,
+            json_deserialize=self.json_deserialize, default_in_groups=self.default_in_groups, proxy=self.proxy,
+            dispatcher=self.dispatcher,
+        )
+        bot.api_url = self.api_url
+        bot._commands = self._commands
+        bot._callbacks = self._callbacks
+        bot._inlines = self._inlines
+        bot._checkouts = self._checkouts
+        bot._handlers = self._handlers
+        bot._default = self._default
+        bot._default_callback = self._default_callback
+        bot._default_inline = self._default_inline
+        bot._prefetch = self._prefetch
+        return bot
+
+    @property
+    def session(self):
+        if self._proxy_is_socks:
+            return super().session
+        if not self._session or self._session.closed:
+            self._session = create_session(self.json_serialize)
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        await close_connector()
+
+    def add_command(self, regexp, fn):
+        super().add_command(regexp, instrument(fn, f'command:{regexp}'))
+
+    def add_callback(self, regexp, fn):
+        super().add_callback(regexp, instrument(fn, f'callback:{regexp}'))
+
+    def prefetch(self, fn):
+        """
+        fn(bot_id, updates) loads what handlers of the getUpdates batch need (into caches) ahead of them
+        """
+        self._prefetch = fn
+        return fn
+
+    def default(self, callback):
+        self._default = instrument(callback, 'default')
+        return callback
+
+    def handle(self, msg_type):
+        def wrap(callback):
+            self._handlers[msg_type] = instrument(callback, f'handle:{msg_type}')
+            return callback
+
+        return wrap
+
+    def download_file(self, file_path, range=None):
+        # same as aiotg.Bot.download_file, but from self.api_url
+        headers = {"range": range} if range else None
+        url = "{0}/file/bot{1}/{2}".format(self.api_url, self.api_token, file_path)
+        # big file may take longer than REQUEST_TIMEOUT, only stalls are limited
+        timeout = aiohttp.ClientTimeout(connect=CONNECT_TIMEOUT, sock_read=REQUEST_TIMEOUT)
+        return self.session.get(
+            url, headers=headers, proxy=self.proxy, proxy_auth=self.proxy_auth, timeout=timeout
+        )
+
+    async def _api_call(self, method, **params):
+        if method == 'getUpdates':
+            return await self._get_updates(**params)
+        if self.sender.can_coalesce(method, params):
+            self.sender.submit_edit(method, params)
+            return {'ok': True, 'result': True}
+        start = time.perf_counter()
+        try:
+            return await self.sender.submit(method, params)
+        finally:
+            note('api', method, time.perf_counter() - start)
+
+    async def _get_updates(self, **params):
+        while True:
+            try:
+                return await api_request(self, 'getUpdates', **params)
+            except RetryAfter as e:
+                delay = e.retry_after
+            except (TemporaryError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                delay = RETRY_TIMEOUT
+                logger.info("getUpdates: %r, retrying in %d sec.", e, delay)
+            await asyncio.sleep(delay)
+
+    def _route_update(self, update):
+        # same as aiotg.Bot._process_update, but returns handler's result instead of scheduling it
+        logger.debug("update %s", update)
+
+        for ut in MESSAGE_UPDATES:
+            if ut in update:
+                return self._process_message(update[ut])
+        if "inline_query" in update:
+            return self._process_inline_query(update["inline_query"])
+        elif "callback_query" in update:
+            return self._process_callback_query(update["callback_query"])
+        elif "pre_checkout_query" in update:
+            return self._process_pre_checkout_query(update["pre_checkout_query"])
+        logger.error("don't know how to handle update: %s", update)
+
+    async def _prefetch_batch(self, updates: list):
+        try:
+            await self._prefetch(self.bot_id, updates)
+        except Exception:
+            # handlers load what they need themselves
+            logger.exception("Prefetch of %d updates failed", len(updates))
+
+    def _process_updates(self, updates):
+        if not updates["ok"]:
+            logger.error("getUpdates error: %s", updates.get("description"))
+            return
+        batch = updates["result"]
+        prefetched = None
+        if self._prefetch is not None and batch:
+            prefetched = asyncio.ensure_future(self._prefetch_batch(batch))
+        for update in batch:
+            self._process_update(update, prefetched)
+
+    async def process_update(self, update, prefetched: asyncio.Future = None):
+        """
+        Run handler of the update (after prefetch of its batch) and wait until it's done
+        """
+        try:
+            if prefetched is not None:
+                # shared by the batch - not cancelled with one of its handlers
+                await asyncio.shield(prefetched)
+            result = self._route_update(update)
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            logger.exception("Error while processing update %s", update.get("update_id"))
+
+    def _process_update(self, update, prefetched: asyncio.Future = None):
+        # the next getUpdates is sent before handlers of this batch start
+        self._offset = max(self._offset, update["update_id"])
+        self.dispatcher.submit((self.bot_id, update_key(update)), partial(self.process_update, update, prefetched))
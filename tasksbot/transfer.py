@@ -0,0 +1,225 @@
+"""
+Import and export of chat tasks as CSV or JSON documents.
+
+Columns (CSV header / JSON keys):
+    content        - text of the task (required)
+    period_days    - period in days (default 1)
+    notify_time    - next notification in time zone of the chat, "YYYY-MM-DD HH:MM[:SS]" or just "HH:MM"
+                     (default - tomorrow, now)
+    exact_in_time  - notify exactly at notify_time instead of chat's time: 1/0, true/false (default false)
+JSON is a list of objects or objects one per line.
+
+Files are read and written by chunks - memory does not depend on number of tasks.
+"""
+import asyncio
+import csv
+import io
+import json
+import os
+from datetime import datetime, time, timedelta
+from typing import AsyncIterator, BinaryIO, Iterator, TextIO
+
+from tasksbot import clock
+from tasksbot.database import db, DB_QUERY_SECONDS
+from tasksbot.models import Task
+from tasksbot.scheduler import task_fire_at
+
+COLUMNS = ('content', 'period_days', 'notify_time', 'exact_in_time')
+COPY_COLUMNS = ('bot_id', 'chat_id', 'content', 'message_id', 'last_notify_id', 'period_days', 'last_done_time',
+                'notify_time', 'fire_at', 'exact_in_time', 'done_mark_user_id')
+IMPORT_MAX_ROWS = int(os.environ.get('IMPORT_MAX_ROWS', 100000))
+# Telegram doesn't let bots download files larger than 20MB
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# longer JSON object is taken as malformed (or not closed) - not buffered up to the end of the file
+JSON_MAX_OBJECT_SIZE = 64 * 1024
+# rows parsed between yields to event loop
+YIELD_EVERY = 1000
+EXPORT_BATCH_SIZE = 1000
+MAX_ERRORS_REPORTED = 5
+CONTENT_MAX_LENGTH = 1024
+TRUE_VALUES = ('1', 'true', 'yes', 'да', '+')
+
+
+class TasksFileError(ValueError):
+    pass
+
+
+def is_json(file_name: str, mime_type: str) -> bool:
+    return (file_name or '').lower().endswith(('.json', '.jsonl')) or 'json' in (mime_type or '')
+
+
+def iter_csv_rows(file: TextIO) -> Iterator[dict]:
+    reader = csv.DictReader(file)
+    if not reader.fieldnames or 'content' not in reader.fieldnames:
+        raise TasksFileError('в первой строке CSV должны быть названия колонок, как минимум content')
+    yield from reader
+
+
+def iter_json_rows(file: TextIO) -> Iterator[dict]:
+    """
+    Objects of JSON list (or JSON lines) one by one, file is read by chunks
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    # position of the buffer start in the file, characters
+    offset = 0
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), ''):
+        buffer += chunk
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,[]':
+                pos += 1
+            if pos == len(buffer):
+                break
+            try:
+                row, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # object is not complete yet - wait for the next chunk
+                if len(buffer) - pos > JSON_MAX_OBJECT_SIZE:
+                    raise TasksFileError(f'не понял JSON с символа {offset + pos}: {buffer[pos:pos + 50]}')
+                break
+            if not isinstance(row, dict):
+                raise TasksFileError(f'ожидался объект, а не {row!r:.50}')
+            yield row
+        buffer = buffer[pos:]
+        offset += pos
+    if buffer.strip():
+        pos = len(buffer) - len(buffer.lstrip())
+        raise TasksFileError(f'не понял JSON с символа {offset + pos}: {buffer.strip()[:50]}')
+
+
+def parse_notify_time(value: str, now: datetime) -> datetime:
+    value = value.strip()
+    if len(value) <= 5:
+        hours, minutes = map(int, value.split(':'))
+        notify_time = datetime.combine(now.date(), time(hours, minutes))
+        return notify_time if notify_time > now else notify_time + timedelta(days=1)
+    return datetime.fromisoformat(value)
+
+
+def task_record(row: dict, bot_id: str, chat_id: str, timezone: str, now: datetime, local_now: datetime) -> tuple:
+    """
+    Row of file -> record for COPY (in COPY_COLUMNS order), raises ValueError if row is wrong
+    """
+    content = str(row.get('content') or '').strip()
+    if not content:
+        raise ValueError('пустое content')
+    if len(content) > CONTENT_MAX_LENGTH:
+        raise ValueError(f'content длиннее {CONTENT_MAX_LENGTH}')
+    try:
+        period_days = int(row.get('period_days') or 1)
+    except ValueError:
+        raise ValueError(f'period_days не число: {row.get("period_days")!r:.20}')
+    if period_days < 1:
+        raise ValueError('period_days меньше 1')
+    notify_time = row.get('notify_time')
+    notify_time = parse_notify_time(str(notify_time), local_now) if notify_time else local_now + timedelta(days=1)
+    exact_in_time = row.get('exact_in_time')
+    if not isinstance(exact_in_time, bool):
+        exact_in_time = str(exact_in_time or '').strip().lower() in TRUE_VALUES
+    if notify_time.tzinfo is not None:
+        notify_time = notify_time.astimezone(clock.get_zone(timezone)).replace(tzinfo=None)
+    fire_at = task_fire_at(notify_time, exact_in_time, timezone)
+    return bot_id, chat_id, content, '', '', period_days, now, notify_time, fire_at, exact_in_time, ''
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.errors = []
+        self.error_count = 0
+
+    def error(self, line: int, message: str):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS_REPORTED:
+            self.errors.append(f'{line}: {message}')
+
+
+async def records(rows: Iterator[dict], bot_id: str, chat_id: str, timezone: str,
+                  result: ImportResult) -> AsyncIterator[tuple]:
+    now = clock.now()
+    local_now = clock.to_local(now, timezone)
+    for line, row in enumerate(rows, 1):
+        if line % YIELD_EVERY == 0:
+            await asyncio.sleep(0)
+        if result.imported >= IMPORT_MAX_ROWS:
+            result.error(line, f'больше {IMPORT_MAX_ROWS} задач за раз не загружаю')
+            return
+        try:
+            record = task_record(row, bot_id, chat_id, timezone, now, local_now)
+        except (ValueError, TypeError) as e:
+            result.error(line, str(e))
+            continue
+        result.imported += 1
+        yield record
+
+
+async def download(bot, file_id: str, file: BinaryIO):
+    info = await bot.get_file(file_id)
+    async with bot.download_file(info['file_path']) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            file.write(chunk)
+    file.seek(0)
+
+
+async def import_tasks(bot_id: str, chat_id: str, timezone: str, file: BinaryIO, json_format: bool) -> ImportResult:
+    """
+    Streams tasks from the file into task table by COPY.
+    Wrong rows are skipped (and reported), wrong file (raises TasksFileError) imports nothing
+    """
+    result = ImportResult()
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    rows = iter_json_rows(text) if json_format else iter_csv_rows(text)
+    with DB_QUERY_SECONDS.time(query='tasks_import'):
+        async with db.acquire() as conn:
+            await conn.raw_connection.copy_records_to_table(
+                Task.__tablename__, columns=COPY_COLUMNS, records=records(rows, bot_id, chat_id, timezone, result)
+            )
+    text.detach()
+    return result
+
+
+async def imported_exact_tasks(bot_id: str, chat_id: str, until: datetime) -> list[tuple[int, datetime]]:
+    return await db.select([Task.id, Task.fire_at]).where(
+        (Task.bot_id == bot_id) & (Task.chat_id == chat_id) & Task.exact_in_time & (Task.fire_at <= until)
+    ).gino.all()
+
+
+def export_row(content: str, period_days: int, notify_time: datetime, exact_in_time: bool) -> list:
+    return [content, period_days, f'{notify_time:%Y-%m-%d %H:%M:%S}', int(exact_in_time)]
+
+
+async def export_tasks(bot_id: str, chat_id: str, file: TextIO, json_format: bool) -> int:
+    """
+    Writes tasks of the chat into the file, tasks are read from DB by server-side cursor
+    """
+    query = db.select([Task.content, Task.period_days, Task.notify_time, Task.exact_in_time]).where(
+        (Task.bot_id == bot_id) & (Task.chat_id == chat_id)
+    ).order_by(Task.id)
+    writer = None if json_format else csv.writer(file)
+    if writer:
+        writer.writerow(COLUMNS)
+    else:
+        file.write('[\n')
+    count = 0
+    async with db.acquire(reusable=False) as conn:
+        async with conn.transaction():
+            cursor = await conn.iterate(query)
+            while True:
+                with DB_QUERY_SECONDS.time(query='tasks_export'):
+                    rows = await cursor.many(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                for values in rows:
+                    row = export_row(*values)
+                    if writer:
+                        writer.writerow(row)
+                    else:
+                        file.write(',\n' if count else '')
+                        file.write(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False))
+                    count += 1
+    if not writer:
+        file.write('\n]\n')
+    return count
@@ -0,0 +1,87 @@
+import asyncio
+import hmac
+import logging
+import os
+import secrets
+
+from aiohttp import web
+
+from tasksbot.telegram import TasksBot
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8080))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def bot_path(bot: TasksBot, bots_count: int, path: str = WEBHOOK_PATH) -> str:
+    """
+    Path (and suffix of WEBHOOK_URL) of the bot's webhook: one bot is served right on WEBHOOK_PATH,
+    several bots - each on WEBHOOK_PATH/<bot_id>
+    """
+    return path if bots_count == 1 else f"{path.rstrip('/')}/{bot.bot_id}"
+
+
+def webhook_secret(url: str = WEBHOOK_URL, secret: str = WEBHOOK_SECRET) -> str:
+    """
+    Secret token which updates must come with: WEBHOOK_SECRET, or a random one when the bot registers
+    the webhook itself (WEBHOOK_URL is set). Raises ValueError if there is neither - updates
+    of a webhook registered by someone else can't be told from forged ones without a secret
+    """
+    if secret:
+        return secret
+    if url:
+        return secrets.token_urlsafe(32)
+    raise ValueError('webhook mode needs WEBHOOK_SECRET, or WEBHOOK_URL to register the webhook with a generated one')
+
+
+class WebhookHandler:
+    """
+    Acknowledges update at once and passes it to bot's dispatcher to process in background
+    """
+
+    def __init__(self, bot: TasksBot, secret: str):
+        if not secret:
+            raise ValueError('webhook secret is empty')
+        self.bot = bot
+        self.secret = secret
+
+    async def handle(self, request: web.Request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            raise web.HTTPForbidden()
+        try:
+            update = await request.json(loads=self.bot.json_deserialize)
+        except ValueError:
+            raise web.HTTPBadRequest()
+        # not an update - Telegram would retry 500 of the dispatcher forever
+        if not isinstance(update, dict) or 'update_id' not in update:
+            raise web.HTTPBadRequest()
+        self.bot._process_update(update)
+        return web.Response()
+
+
+def create_webhook_app(bots: list[TasksBot], secret: str, path=WEBHOOK_PATH) -> web.Application:
+    app = web.Application()
+    for bot in bots:
+        app.router.add_route("POST", bot_path(bot, len(bots), path), WebhookHandler(bot, secret).handle)
+    return app
+
+
+async def run_webhook(bots: list[TasksBot], secret: str):
+    runner = web.AppRunner(create_webhook_app(bots, secret))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info("Listening for updates of %d bots on %s:%d%s", len(bots), WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        if WEBHOOK_URL:
+            for bot in bots:
+                await bot.set_webhook(bot_path(bot, len(bots), WEBHOOK_URL), secret_token=secret)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
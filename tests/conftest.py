@@ -0,0 +1,31 @@
+import asyncio
+import os
+
+import pytest
+
+import tasksbot.models  # noqa: F401 - tables of all models are created
+from tasksbot.database import db, connect
+
+# SQL is tested against this DB, all rows of its tables are deleted. Tests which need DB are skipped without it
+TEST_DB_URL = os.environ.get('TEST_DB_URL')
+
+
+@pytest.fixture
+def run_db():
+    """
+    Runs coroutine function with db bound to TEST_DB_URL, tables are created (if needed) and emptied before
+    """
+    if not TEST_DB_URL:
+        pytest.skip('TEST_DB_URL is not set')
+
+    def run(test):
+        async def main():
+            async with connect(TEST_DB_URL):
+                await db.gino.create_all()
+                tables = ', '.join(db.tables)
+                await db.status(db.text(f'TRUNCATE {tables} RESTART IDENTITY CASCADE'))
+                return await test()
+
+        return asyncio.run(main())
+
+    return run
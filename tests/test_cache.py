@@ -0,0 +1,101 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from tasksbot import cache
+from tasksbot.cache import LRUCache, chat_cache, prefetch_chats
+
+
+@pytest.fixture
+def now(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_expired_item_is_miss(now):
+    lru = LRUCache(10, ttl=60)
+    lru.put('a', 1)
+    now[0] += 60
+    assert lru.get('a') == 1
+    assert 'a' in lru
+    now[0] += 1
+    assert 'a' not in lru
+    assert lru.get('a') is None
+    assert len(lru) == 0
+    assert lru.stats() == {'size': 0, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_put_renews_ttl(now):
+    lru = LRUCache(10, ttl=60)
+    lru.put('a', 1)
+    now[0] += 50
+    lru.put('a', 2)
+    now[0] += 50
+    assert lru.get('a') == 2
+
+
+def test_least_recently_used_is_evicted(now):
+    lru = LRUCache(2, ttl=60)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+    lru.put('c', 3)
+    assert lru.get('b') is None
+    assert (lru.get('a'), lru.get('c')) == (1, 3)
+    assert lru.stats()['evictions'] == 1
+
+
+def test_pop(now):
+    lru = LRUCache(10, ttl=60)
+    lru.put('a', 1)
+    assert lru.pop('a') == 1
+    assert lru.pop('a') is None
+    assert lru.get('a') is None
+
+
+def test_loaded_value_doesnt_overwrite_later_change(now):
+    lru = LRUCache(10, ttl=60)
+    lru.put('a', 'cached')
+    generation = lru.generation
+    lru.pop('a')
+    lru.put('b', 'newer')
+    assert not lru.put_loaded('a', 'loaded before pop', generation)
+    assert not lru.put_loaded('b', 'loaded before put', generation)
+    assert lru.put_loaded('c', 'loaded', generation)
+    assert (lru.get('a'), lru.get('b'), lru.get('c')) == (None, 'newer', 'loaded')
+    assert lru.put_loaded('a', 'loaded after pop', lru.generation)
+    assert lru.get('a') == 'loaded after pop'
+
+
+def test_changes_of_forgotten_keys_are_assumed_later(now):
+    lru = LRUCache(2, ttl=60)
+    generation = lru.generation
+    for key in 'abc':
+        lru.pop(key)
+    # changes of `a` are not tracked any more - it could have been changed after the load
+    assert not lru.put_loaded('a', 1, generation)
+    assert not lru.put_loaded('d', 1, generation)
+    assert lru.put_loaded('d', 1, lru.generation)
+    generation = lru.generation
+    lru.clear()
+    assert not lru.put_loaded('e', 1, generation)
+
+
+def test_prefetch_doesnt_bring_back_chat_popped_meanwhile(monkeypatch):
+    async def all(bot_id, chat_ids):
+        # reminder invalidates the chat while the query runs
+        chat_cache.pop((bot_id, '1'))
+        await asyncio.sleep(0)
+        return [SimpleNamespace(chat_id=chat_id) for chat_id in sorted(chat_ids)]
+
+    monkeypatch.setattr(cache, 'CHATS_GET', SimpleNamespace(all=all))
+    chat_cache.clear()
+    try:
+        chats = asyncio.run(prefetch_chats('b', {'1', '2'}))
+        assert [db_chat.chat_id for db_chat in chats] == ['1', '2']
+        assert ('b', '1') not in chat_cache
+        assert ('b', '2') in chat_cache
+    finally:
+        chat_cache.clear()
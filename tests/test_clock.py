@@ -0,0 +1,33 @@
+from datetime import datetime
+
+from tasksbot.clock import to_local, to_utc
+from tasksbot.scheduler import next_chat_notify_time
+
+BERLIN = 'Europe/Berlin'
+
+
+def test_to_utc():
+    assert to_utc(datetime(2026, 1, 15, 9, 0), BERLIN) == datetime(2026, 1, 15, 8, 0)
+    assert to_utc(datetime(2026, 7, 15, 9, 0), BERLIN) == datetime(2026, 7, 15, 7, 0)
+    assert to_utc(datetime(2026, 7, 15, 9, 0), 'UTC') == datetime(2026, 7, 15, 9, 0)
+
+
+def test_skipped_time_is_moved_forward():
+    # 2026-03-29 clocks go from 02:00 to 03:00 - 02:30 doesn't happen, it is 03:30 CEST
+    utc = to_utc(datetime(2026, 3, 29, 2, 30), BERLIN)
+    assert utc == datetime(2026, 3, 29, 1, 30)
+    assert to_local(utc, BERLIN) == datetime(2026, 3, 29, 3, 30)
+
+
+def test_repeated_time_is_the_first_one():
+    # 2026-10-25 clocks go from 03:00 back to 02:00 - 02:30 happens twice, CEST and then CET
+    assert to_utc(datetime(2026, 10, 25, 2, 30), BERLIN) == datetime(2026, 10, 25, 0, 30)
+    assert to_local(datetime(2026, 10, 25, 0, 30), BERLIN) == datetime(2026, 10, 25, 2, 30)
+    assert to_local(datetime(2026, 10, 25, 1, 30), BERLIN) == datetime(2026, 10, 25, 2, 30)
+
+
+def test_chat_notification_keeps_local_time_over_dst_change():
+    local, utc = next_chat_notify_time(datetime(2026, 10, 24, 9, 0), datetime(2026, 10, 24, 7, 0), BERLIN)
+    assert (local, utc) == (datetime(2026, 10, 25, 9, 0), datetime(2026, 10, 25, 8, 0))
+    local, utc = next_chat_notify_time(datetime(2026, 3, 28, 9, 0), datetime(2026, 3, 28, 8, 0), BERLIN)
+    assert (local, utc) == (datetime(2026, 3, 29, 9, 0), datetime(2026, 3, 29, 7, 0))
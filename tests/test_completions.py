@@ -0,0 +1,33 @@
+from datetime import date, datetime
+
+from tasksbot.completions import stats_by_day
+
+DAY1 = date(2026, 1, 1)
+DAY2 = date(2026, 1, 2)
+
+
+def mark(chat_id, user_id, user_name, day):
+    return 'bot', chat_id, 1, user_id, user_name, datetime(day.year, day.month, day.day, 12), day
+
+
+def test_counters_of_chat_and_users_by_day():
+    batch = [
+        mark('c', 'u1', 'one', DAY2),
+        mark('c', 'u1', '', DAY1),
+        mark('c', 'u2', 'two', DAY1),
+        mark('c', 'u1', 'uno', DAY1),
+        mark('d', 'u1', 'one', DAY1),
+    ]
+    assert stats_by_day(batch) == [
+        (DAY1, {
+            ('bot', 'c', ''): [3, ''],
+            ('bot', 'c', 'u1'): [2, 'uno'],
+            ('bot', 'c', 'u2'): [1, 'two'],
+            ('bot', 'd', ''): [1, ''],
+            ('bot', 'd', 'u1'): [1, 'one'],
+        }),
+        (DAY2, {
+            ('bot', 'c', ''): [1, ''],
+            ('bot', 'c', 'u1'): [1, 'one'],
+        }),
+    ]
@@ -0,0 +1,24 @@
+from tasksbot import digest
+from tasksbot.digest import digest_chunks
+from tasksbot.models import Task
+
+
+def tasks(*lengths):
+    return [Task(id=i, content='x' * length) for i, length in enumerate(lengths)]
+
+
+def test_chunks_by_number_of_tasks(monkeypatch):
+    monkeypatch.setattr(digest, 'DIGEST_MAX_TASKS', 3)
+    chunks = list(digest_chunks(tasks(*[1] * 7)))
+    assert [[task.id for task in chunk] for chunk in chunks] == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_chunks_by_message_length(monkeypatch):
+    monkeypatch.setattr(digest, 'MESSAGE_MAX_LENGTH', len(digest.DIGEST_TITLE) + 20)
+    # each line is content + 3
+    chunks = list(digest_chunks(tasks(5, 5, 1, 2, 30)))
+    assert [[task.id for task in chunk] for chunk in chunks] == [[0, 1, 2], [3], [4]]
+
+
+def test_no_tasks():
+    assert list(digest_chunks([])) == []
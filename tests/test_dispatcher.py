@@ -0,0 +1,75 @@
+import asyncio
+
+from tasksbot.dispatcher import KeyedDispatcher, update_key
+
+
+def run_jobs(dispatcher: KeyedDispatcher, jobs: list[tuple[str, float]]) -> list[tuple[str, int]]:
+    """
+    Submits jobs (key, seconds to run), returns (key, number of the job) in order of finishing
+    """
+    finished = []
+
+    async def run():
+        done = asyncio.Event()
+
+        def job(key, number, seconds):
+            async def run_job():
+                await asyncio.sleep(seconds)
+                finished.append((key, number))
+                if len(finished) == len(jobs):
+                    done.set()
+            return run_job
+
+        for number, (key, seconds) in enumerate(jobs):
+            dispatcher.submit(key, job(key, number, seconds))
+        await asyncio.wait_for(done.wait(), 5)
+
+    asyncio.run(run())
+    return finished
+
+
+def test_jobs_of_key_run_in_order():
+    finished = run_jobs(KeyedDispatcher(), [('a', 0.05), ('a', 0), ('a', 0.01), ('b', 0)])
+    assert [number for key, number in finished if key == 'a'] == [0, 1, 2]
+
+
+def test_keys_run_in_parallel():
+    finished = run_jobs(KeyedDispatcher(), [('a', 0.05), ('b', 0)])
+    assert finished == [('b', 1), ('a', 0)]
+
+
+def test_workers_limit():
+    # with one worker the slow job of `a` holds up `b`
+    finished = run_jobs(KeyedDispatcher(workers=1), [('a', 0.05), ('b', 0)])
+    assert finished == [('a', 0), ('b', 1)]
+
+
+def test_failed_job_doesnt_stop_the_key():
+    calls = []
+
+    async def run():
+        dispatcher = KeyedDispatcher()
+
+        async def fail():
+            calls.append('fail')
+            raise ValueError
+
+        async def ok():
+            calls.append('ok')
+
+        dispatcher.submit('a', fail)
+        dispatcher.submit('a', ok)
+        await asyncio.sleep(0.01)
+        return dispatcher.stats()
+
+    stats = asyncio.run(run())
+    assert calls == ['fail', 'ok']
+    assert stats['keys'] == 0 and stats['processed'] == 2
+
+
+def test_update_key():
+    chat = {'id': 5}
+    assert update_key({'update_id': 1, 'message': {'chat': chat}}) == 5
+    assert update_key({'update_id': 1, 'callback_query': {'from': {'id': 7}, 'message': {'chat': chat}}}) == 5
+    assert update_key({'update_id': 1, 'inline_query': {'from': {'id': 7}}}) == 7
+    assert update_key({'update_id': 1}) == 1
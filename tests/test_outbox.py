@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+from aiotg import BotApiError
+
+from tasksbot import clock, outbox
+from tasksbot.bot import bot
+from tasksbot.clock import VirtualClock
+from tasksbot.database import WORKER_ID, LEASE_TIME
+from tasksbot.models import Chat, Outbox, Task
+from tasksbot.outbox import claim_messages, enqueue, mark_sent, outbox_message, release, OUTBOX_RETRY_DELAY
+from tasksbot.sender import RetryAfter, TemporaryError
+
+T0 = datetime(2026, 1, 1, 12, 0)
+
+
+def message(task_ids, due_time=T0, bot_id=bot.bot_id):
+    return outbox_message(bot_id, '1', 'text', {}, task_ids, due_time, due_time)
+
+
+async def with_clock(test):
+    previous = clock.set_clock(VirtualClock(T0))
+    try:
+        return await test()
+    finally:
+        clock.set_clock(previous)
+
+
+def test_same_reminder_is_queued_once(run_db):
+    async def test():
+        await enqueue([message([1]), message([2])])
+        await enqueue([message([1]), message([1], T0 + timedelta(days=1))])
+        return await Outbox.query.order_by(Outbox.id).gino.all()
+
+    rows = run_db(test)
+    assert [row.task_ids for row in rows] == [[1], [2], [1]]
+
+
+def test_claimed_message_is_leased(run_db, monkeypatch):
+    monkeypatch.setattr(outbox, 'OUTBOX_BATCH_SIZE', 2)
+
+    async def test():
+        await enqueue([message([1]), message([2]), message([3]), message([4], bot_id='not hosted')])
+        first = await claim_messages(T0)
+        second = await claim_messages(T0)
+        nothing = await claim_messages(T0)
+        expired = await claim_messages(T0 + LEASE_TIME + timedelta(seconds=1))
+        return first, second, nothing, expired
+
+    first, second, nothing, expired = run_db(test)
+    assert [message.task_ids for message in first] == [[1], [2]]
+    assert [(message.lease_owner, message.lease_until, message.attempts) for message in first] == \
+        [(WORKER_ID, T0 + LEASE_TIME, 1)] * 2
+    # message of bot hosted by other process is left to it
+    assert [message.task_ids for message in second] == [[3]]
+    assert nothing == []
+    assert [(message.task_ids, message.attempts) for message in expired] == [([1], 2), ([2], 2)]
+
+
+def test_sent_message_is_not_claimed_again(run_db):
+    async def test():
+        await Chat.create(bot_id=bot.bot_id, chat_id='1')
+        tasks = [await Task.create(bot_id=bot.bot_id, chat_id='1') for _ in range(3)]
+        await enqueue([message([tasks[0].id, tasks[1].id]), message([tasks[2].id])])
+        digest, single = await claim_messages(T0)
+        await mark_sent([(digest, '77')])
+        again = await claim_messages(T0 + LEASE_TIME + timedelta(seconds=1))
+        sent = await Outbox.get(digest.id)
+        notify_ids = [task.last_notify_id for task in await Task.query.order_by(Task.id).gino.all()]
+        return single, again, sent, notify_ids
+
+    single, again, sent, notify_ids = run_db(lambda: with_clock(test))
+    assert [message.id for message in again] == [single.id]
+    assert (sent.message_id, sent.sent_at, sent.lease_until) == ('77', T0, None)
+    assert notify_ids == ['77', '77', '']
+
+
+def test_failed_message_is_retried_after_backoff(run_db):
+    async def test():
+        await enqueue([message([1]), message([2]), message([3])])
+        temporary, limited, refused = await claim_messages(T0)
+        await release([
+            (temporary, TemporaryError('Server returned 502')),
+            (limited, RetryAfter(3600)),
+            (refused, BotApiError('Forbidden: bot was blocked by the user', response=None)),
+        ])
+        released = await Outbox.query.order_by(Outbox.id).gino.all()
+        early = await claim_messages(T0 + OUTBOX_RETRY_DELAY - timedelta(seconds=1))
+        again, = await claim_messages(T0 + OUTBOX_RETRY_DELAY + timedelta(seconds=1))
+        await release([(again, TemporaryError('Server returned 502'))])
+        again = await Outbox.get(again.id)
+        return released, early, again
+
+    released, early, again = run_db(lambda: with_clock(test))
+    assert [(message.attempts, message.lease_until) for message in released] == [
+        (1, T0 + OUTBOX_RETRY_DELAY),
+        (1, T0 + timedelta(hours=1)),
+        # refused by Telegram - never retried
+        (outbox.OUTBOX_MAX_ATTEMPTS, None),
+    ]
+    assert early == []
+    # the next failure doubles the delay
+    assert (again.task_ids, again.attempts, again.lease_until) == ([1], 2, T0 + 2 * OUTBOX_RETRY_DELAY)
@@ -0,0 +1,105 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from tasksbot import clock, reminder
+from tasksbot.clock import VirtualClock
+from tasksbot.database import LEASE_TIME
+from tasksbot.models import Chat, Outbox, Task
+from tasksbot.scheduler import scheduler
+
+T0 = datetime(2026, 1, 1, 12, 0)
+
+
+def test_reminder_goes_on_after_failure(monkeypatch):
+    loads = []
+
+    async def catch_up():
+        pass
+
+    async def load_schedule(horizon):
+        loads.append(clock.now())
+        if len(loads) == 1:
+            raise RuntimeError('deadlock detected')
+        raise asyncio.CancelledError()
+
+    monkeypatch.setattr(reminder, 'catch_up', catch_up)
+    monkeypatch.setattr(reminder, 'load_schedule', load_schedule)
+    previous = clock.set_clock(VirtualClock(T0))
+    try:
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(reminder.run_reminder())
+    finally:
+        clock.set_clock(previous)
+    assert loads == [T0, T0 + timedelta(seconds=reminder.RETRY_DELAY)]
+
+
+async def create_rows():
+    minute = timedelta(minutes=1)
+    for chat_id, fire_at in (('due', T0 - minute), ('later', T0 + minute)):
+        await Chat.create(bot_id='b', chat_id=chat_id, notify_next_date_time=fire_at, fire_at=fire_at, timezone='UTC')
+    rows = [
+        ('due', False, T0 - timedelta(days=1)),
+        ('due', False, T0 + timedelta(days=1)),
+        ('later', False, T0 - timedelta(days=1)),
+        ('later', True, T0 - minute),
+        ('later', True, T0 + minute),
+    ]
+    return [
+        await Task.create(bot_id='b', chat_id=chat_id, content=f'task {i}', exact_in_time=exact, notify_time=fire_at,
+                          fire_at=fire_at)
+        for i, (chat_id, exact, fire_at) in enumerate(rows)
+    ]
+
+
+def test_due_rows_are_claimed_by_one_worker(run_db):
+    async def test():
+        tasks = await create_rows()
+        lease_until = T0 + LEASE_TIME
+        claimed = await reminder.get_store().claim_due(T0, lease_until)
+        leased = [task.id for task in await Task.query.where(Task.lease_until == lease_until).gino.all()]
+        # the rows are leased by the first claim
+        again = await reminder.get_store().claim_due(T0, lease_until)
+        # lease of crashed worker expires
+        expired = await reminder.get_store().claim_due(lease_until + timedelta(seconds=1), lease_until + LEASE_TIME)
+        return tasks, claimed, leased, again, expired
+
+    tasks, (chats, exact_count), leased, again, expired = run_db(test)
+    assert [(bot_id, chat_id, fire_at) for bot_id, chat_id, fire_at, _, _, _ in chats] == \
+        [('b', 'due', T0 - timedelta(minutes=1))]
+    assert exact_count == 1
+    # not exact task is due with its chat only
+    assert sorted(leased) == [tasks[0].id, tasks[3].id]
+    assert again == ([], 0)
+    # with rows which became due meanwhile
+    assert sorted(chat_id for _, chat_id, _, _, _, _ in expired[0]) == ['due', 'later']
+    assert expired[1] == 2
+
+
+def test_remind_round_queues_notifications_and_advances_rows(run_db):
+    async def test():
+        tasks = await create_rows()
+        counts = await reminder.remind_round(100, 100)
+        messages = await Outbox.query.order_by(Outbox.id).gino.all()
+        rows = await Task.query.order_by(Task.id).gino.all()
+        chat = await Chat.get(('b', 'due'))
+        return tasks, counts, messages, rows, chat
+
+    previous = clock.set_clock(VirtualClock(T0))
+    try:
+        tasks, counts, messages, rows, chat = run_db(test)
+    finally:
+        clock.set_clock(previous)
+        scheduler.clear()
+    # chats, exact tasks, all tasks, messages
+    assert counts == (1, 1, 2, 2)
+    assert sorted((message.task_ids[0], message.due_time) for message in messages) == [
+        (tasks[0].id, T0 - timedelta(minutes=1)),
+        (tasks[3].id, T0 - timedelta(minutes=1)),
+    ]
+    assert [row.lease_until for row in rows] == [None] * 5
+    assert rows[0].notify_time == T0 - timedelta(days=1) + timedelta(days=2)
+    assert rows[3].notify_time == rows[3].fire_at == T0 - timedelta(minutes=1) + timedelta(days=1)
+    assert [row.notify_time for row in rows[1:3] + rows[4:]] == [task.notify_time for task in tasks[1:3] + tasks[4:]]
+    assert (chat.fire_at, chat.lease_until) == (T0 - timedelta(minutes=1) + timedelta(days=1), None)
@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+from tasksbot.scheduler import ReminderScheduler, next_task_notify_time, occurrences_count, task_fire_at
+
+T0 = datetime(2026, 1, 1, 12, 0)
+
+
+def test_rescheduled_key_is_popped_once_at_new_deadline():
+    scheduler = ReminderScheduler()
+    scheduler.schedule('a', T0 + timedelta(minutes=10))
+    scheduler.schedule('a', T0 + timedelta(minutes=5))
+    scheduler.schedule('b', T0 + timedelta(minutes=7))
+    assert scheduler.next_deadline() == T0 + timedelta(minutes=5)
+    assert scheduler.pop_due(T0 + timedelta(minutes=6)) == ['a']
+    # the stale entry of `a` is skipped
+    assert scheduler.pop_due(T0 + timedelta(minutes=20)) == ['b']
+    assert len(scheduler) == 0
+
+
+def test_discarded_key_is_not_popped():
+    scheduler = ReminderScheduler()
+    scheduler.schedule('a', T0)
+    scheduler.schedule('b', T0 + timedelta(minutes=1))
+    scheduler.discard('a')
+    scheduler.schedule('c', None)
+    assert scheduler.next_deadline() == T0 + timedelta(minutes=1)
+    assert scheduler.pop_due(T0 + timedelta(hours=1)) == ['b']
+    assert scheduler.next_deadline() is None
+
+
+def test_not_exact_task_fires_at_next_midnight():
+    assert task_fire_at(T0, False, 'UTC') == datetime(2026, 1, 2)
+    assert task_fire_at(datetime(2026, 1, 2), False, 'UTC') == datetime(2026, 1, 2)
+    assert task_fire_at(T0, True, 'Europe/Berlin') == T0 - timedelta(hours=1)
+
+
+def test_occurrences_count():
+    assert occurrences_count(T0, 2, T0 - timedelta(days=1)) == 1
+    assert occurrences_count(T0, 2, T0) == 1
+    assert occurrences_count(T0, 2, T0 + timedelta(days=5)) == 3
+
+
+def test_period_less_than_day_is_daily():
+    assert occurrences_count(T0, 0, T0 + timedelta(days=2)) == 3
+    assert occurrences_count(T0, -1, T0 + timedelta(days=2)) == 3
+    assert next_task_notify_time(T0, 0, T0 + timedelta(hours=1)) == T0 + timedelta(days=1)
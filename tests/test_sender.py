@@ -0,0 +1,99 @@
+import asyncio
+
+from tasksbot import sender
+from tasksbot.sender import ApiCall, Sender, TokenBucket
+
+
+def edit(text=None, reply_markup=None, message_id=2):
+    params = {'chat_id': 1, 'message_id': message_id}
+    if text is not None:
+        params['text'] = text
+    if reply_markup is not None:
+        params['reply_markup'] = reply_markup
+    return params
+
+
+class Recorder:
+    def __init__(self, delay=0.0):
+        self.calls = []
+        self.delay = delay
+
+    async def __call__(self, method, **params):
+        await asyncio.sleep(self.delay)
+        self.calls.append((method, params))
+        return {'ok': True}
+
+
+def test_merge_keeps_text_and_replaces_keyboard():
+    call = ApiCall('editMessageText', edit('a', 'm1'))
+    call.merge('editMessageReplyMarkup', edit(reply_markup='m2'))
+    assert call.method == 'editMessageText'
+    assert call.params == edit('a', 'm2')
+
+
+def test_merge_removes_keyboard():
+    call = ApiCall('editMessageText', edit('a', 'm1'))
+    call.merge('editMessageReplyMarkup', edit())
+    assert call.method == 'editMessageText'
+    assert call.params == edit('a')
+
+
+def test_merge_later_text_replaces_everything():
+    call = ApiCall('editMessageReplyMarkup', edit(reply_markup='m1'))
+    call.merge('editMessageText', edit('b'))
+    assert call.method == 'editMessageText'
+    assert call.params == edit('b')
+
+
+def test_edits_of_message_are_sent_as_one():
+    async def run():
+        request = Recorder()
+        queue = Sender(request, workers=2, edit_window=0.01)
+        queue.submit_edit('editMessageText', edit('a', 'm1'))
+        queue.submit_edit('editMessageReplyMarkup', edit(reply_markup='m2'))
+        queue.submit_edit('editMessageText', edit('other', message_id=3))
+        queue.submit_edit('editMessageText', edit('b', 'm3'))
+        await queue.drain()
+        queue.stop()
+        return request.calls, queue.coalesced
+
+    calls, coalesced = asyncio.run(run())
+    assert sorted(calls, key=lambda call: call[1]['message_id']) == [
+        ('editMessageText', edit('b', 'm3')),
+        ('editMessageText', edit('other', message_id=3)),
+    ]
+    assert coalesced == 2
+
+
+def test_busy_group_keeps_order_and_doesnt_block_other_chats(monkeypatch):
+    monkeypatch.setattr(sender, 'GROUP_RATE', 20.0)
+    monkeypatch.setattr(sender, 'GROUP_BURST', 2)
+
+    async def run():
+        request = Recorder(delay=0.001)
+        queue = Sender(request, workers=2, edit_window=0)
+        sends = [queue.submit('sendMessage', {'chat_id': -100, 'text': f'g{i}'}) for i in range(6)]
+        sends.append(queue.submit('sendMessage', {'chat_id': 5, 'text': 'p'}))
+        await asyncio.gather(*sends)
+        queue.stop()
+        return [params['text'] for _, params in request.calls]
+
+    texts = asyncio.run(run())
+    assert [text for text in texts if text.startswith('g')] == [f'g{i}' for i in range(6)]
+    # the group has 2 tokens - the private chat is not queued behind the rest of the group
+    assert texts.index('p') < texts.index('g2')
+
+
+def test_token_bucket_delay():
+    async def run():
+        bucket = TokenBucket(rate=10, capacity=2)
+        assert bucket.delay() == 0
+        await bucket.acquire()
+        await bucket.acquire()
+        after_burst = bucket.delay()
+        bucket.pause(5)
+        return after_burst, bucket.delay()
+
+    after_burst, paused = asyncio.run(run())
+    assert 0 < after_burst <= 0.1
+    assert 4.9 < paused <= 5
@@ -0,0 +1,44 @@
+import io
+
+import pytest
+
+from tasksbot import transfer
+from tasksbot.transfer import TasksFileError, iter_json_rows
+
+ROWS = [{'content': 'first'}, {'content': 'второе', 'period_days': 2}, {'content': 'x, [y]'}]
+JSON_LIST = '[{"content": "first"}, {"content": "второе", "period_days": 2},\n {"content": "x, [y]"}]'
+JSON_LINES = '{"content": "first"}\n{"content": "второе", "period_days": 2}\n{"content": "x, [y]"}\n'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 64 * 1024])
+@pytest.mark.parametrize('text', [JSON_LIST, JSON_LINES])
+def test_objects_split_between_chunks(monkeypatch, chunk_size, text):
+    monkeypatch.setattr(transfer, 'CHUNK_SIZE', chunk_size)
+    assert list(iter_json_rows(io.StringIO(text))) == ROWS
+
+
+def test_not_object():
+    with pytest.raises(TasksFileError, match='ожидался объект'):
+        list(iter_json_rows(io.StringIO('[{"content": "a"}, 5]')))
+
+
+def test_not_closed_object_reports_its_offset():
+    with pytest.raises(TasksFileError, match='с символа 19'):
+        list(iter_json_rows(io.StringIO('[{"content": "a"}, {"content": "b"')))
+
+
+def test_malformed_object_is_not_buffered_to_the_end(monkeypatch):
+    monkeypatch.setattr(transfer, 'CHUNK_SIZE', 10)
+    monkeypatch.setattr(transfer, 'JSON_MAX_OBJECT_SIZE', 100)
+    read = []
+
+    class File(io.StringIO):
+        def read(self, size=-1):
+            chunk = super().read(size)
+            read.append(len(chunk))
+            return chunk
+
+    text = '[{"content": "a"}, {"content" 1}, ' + '{"content": "b"}, ' * 1000 + ']'
+    with pytest.raises(TasksFileError, match='с символа 19'):
+        list(iter_json_rows(File(text)))
+    assert sum(read) < 200
@@ -0,0 +1,59 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import test_utils
+
+from tasksbot.webhook import SECRET_HEADER, WebhookHandler, create_webhook_app, webhook_secret
+
+
+class Bot:
+    json_deserialize = staticmethod(json.loads)
+
+    def __init__(self, bot_id):
+        self.bot_id = bot_id
+        self.updates = []
+
+    def _process_update(self, update):
+        self.updates.append(update)
+
+
+def post(bots, path, body, secret='s3cret'):
+    async def run():
+        async with test_utils.TestClient(test_utils.TestServer(create_webhook_app(bots, 's3cret', '/hook'))) as client:
+            headers = {SECRET_HEADER: secret} if secret is not None else {}
+            response = await client.post(path, data=body, headers=headers)
+            return response.status
+
+    return asyncio.run(run())
+
+
+def test_update_is_passed_to_its_bot():
+    bots = [Bot('1'), Bot('2')]
+    assert post(bots, '/hook/2', '{"update_id": 7}') == 200
+    assert bots[0].updates == []
+    assert bots[1].updates == [{'update_id': 7}]
+
+
+@pytest.mark.parametrize('secret', [None, '', 'wrong'])
+def test_update_without_secret_is_refused(secret):
+    bot = Bot('1')
+    assert post([bot], '/hook', '{"update_id": 7}', secret) == 403
+    assert bot.updates == []
+
+
+@pytest.mark.parametrize('body', ['{"update_id": ', '[1]', '{"message": {}}', '"text"'])
+def test_not_update_is_bad_request(body):
+    bot = Bot('1')
+    assert post([bot], '/hook', body) == 400
+    assert bot.updates == []
+
+
+def test_secret_is_required():
+    assert webhook_secret('', 'given') == 'given'
+    assert webhook_secret('https://example.org/hook', '')
+    assert webhook_secret('https://example.org/hook', '') != webhook_secret('https://example.org/hook', '')
+    with pytest.raises(ValueError):
+        webhook_secret('', '')
+    with pytest.raises(ValueError):
+        WebhookHandler(Bot('1'), '')